@@ -1,14 +1,42 @@
+import csv
+import io
+import json
 import os
+import threading
+from datetime import datetime, timedelta
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+import click
+from flask import Flask, Response, render_template, request, flash, redirect, session, g, abort, jsonify, url_for, stream_with_context
+from flask.cli import AppGroup
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import contains_eager
 import pdb
 
+import jobs
+import partitions
+from cache import cache
 from forms import UserAddForm, LoginForm, MessageForm, UserProfileForm
-from models import db, connect_db, User, Message, Likes
+from loadshed import shedder
+from metrics import metrics
+from markupsafe import Markup, escape
+from models import db, connect_db, User, Message, Likes, Follows, MessageTag, Mention
+from profiling import RequestProfiler
+from pubsub import make_broker
+from ratelimit import limiter
+from slow_queries import slow_query_log
+from snowflake import snowflakes
+from templating import init_templating, stream_template
+from trending import trending, WINDOWS
+from viewcounts import viewcounter
+from writebehind import writebehind
 
 CURR_USER_KEY = "curr_user"
+FOLLOW_PAGE_SIZE = 30
+BULK_FOLLOW_LIMIT = 5000
+EXPORT_BATCH_SIZE = 1000
+EXPORT_FIELDS = ('type', 'id', 'username', 'text', 'timestamp')
+MESSAGE_PAGE_SIZE = 50
 
 app = Flask(__name__)
 
@@ -21,9 +49,58 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+app.config['SLOW_QUERY_THRESHOLD_MS'] = float(
+    os.environ.get('SLOW_QUERY_THRESHOLD_MS', 200))
+app.config['SLOW_QUERY_EXPLAIN_SAMPLE_RATE'] = float(
+    os.environ.get('SLOW_QUERY_EXPLAIN_SAMPLE_RATE', 0.1))
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', 'profiles')
+app.config['PROFILE_SAMPLE_RATE'] = float(
+    os.environ.get('PROFILE_SAMPLE_RATE', 0.0))
+if 'TEMPLATE_CACHE_DIR' in os.environ:
+    app.config['TEMPLATE_CACHE_DIR'] = os.environ['TEMPLATE_CACHE_DIR']
+init_templating(app)
+app.config['CACHE_TTL'] = int(os.environ.get('CACHE_TTL', 60))
+app.config['PUBSUB_BROKER'] = os.environ.get(
+    'PUBSUB_BROKER', 'pubsub:InProcessBroker')
+app.config['STREAM_HEARTBEAT_SECONDS'] = 15
+app.config['STREAM_MAX_CONNECTIONS'] = int(
+    os.environ.get('STREAM_MAX_CONNECTIONS', 50))
+app.config['HIGH_WATER_MARK_TTL'] = 5
+app.config['RATELIMIT_ENABLED'] = (
+    os.environ.get('RATELIMIT_ENABLED', '1') != '0')
+app.config['RATELIMIT_STORAGE_URL'] = os.environ.get('RATELIMIT_STORAGE_URL')
+app.config['SQLALCHEMY_POOL_TIMEOUT'] = int(
+    os.environ.get('DB_POOL_TIMEOUT', 5))
+app.config['STATEMENT_TIMEOUTS'] = dict.fromkeys(
+    ('homepage', 'users_show', 'list_users', 'show_following',
+     'users_followers', 'messages_show', 'show_liked_messages'),
+    int(os.environ.get('READ_STATEMENT_TIMEOUT_MS', 2000)))
+app.config['STALE_ROUTES'] = ('homepage', 'users_show')
+app.config['JOBS_IN_PROCESS'] = os.environ.get('JOBS_IN_PROCESS') == '1'
+app.config['JOBS_CONCURRENCY'] = int(os.environ.get('JOBS_CONCURRENCY', 4))
+app.config['JOBS_RETENTION_DAYS'] = int(
+    os.environ.get('JOBS_RETENTION_DAYS', 7))
+app.config['WRITE_BEHIND'] = os.environ.get('WRITE_BEHIND') == '1'
+app.config['SNOWFLAKE_IDS'] = os.environ.get('SNOWFLAKE_IDS') == '1'
+app.config['SNOWFLAKE_HOST_ID'] = int(os.environ.get('SNOWFLAKE_HOST_ID', 0))
+app.config['FEED_WINDOW_DAYS'] = int(os.environ.get('FEED_WINDOW_DAYS', 7))
+app.config['ARCHIVE_TABLESPACE'] = os.environ.get('ARCHIVE_TABLESPACE')
+app.config['VIEW_COUNTS'] = os.environ.get('VIEW_COUNTS') == '1'
+app.config['VIEW_UNIQUES'] = os.environ.get('VIEW_UNIQUES') == '1'
+app.config['VIEW_FLUSH_SECONDS'] = int(os.environ.get('VIEW_FLUSH_SECONDS', 10))
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+cache.ttl = app.config['CACHE_TTL']
+slow_query_log.init_app(app)
+profiler = RequestProfiler(app)
+broker = make_broker(app)
+stream_slots = threading.BoundedSemaphore(app.config['STREAM_MAX_CONNECTIONS'])
+limiter.init_app(app)
+shedder.init_app(app)
+writebehind.init_app(app)
+snowflakes.init_app(app, Message)
+viewcounter.init_app(app)
 
 
 ##############################################################################
@@ -36,11 +113,21 @@ def add_user_to_g():
 
     if CURR_USER_KEY in session:
         g.user = User.query.get(session[CURR_USER_KEY])
+        if g.user and g.user.deleted_at:
+            g.user = None
 
     else:
         g.user = None
 
 
+def viewer_key():
+    """Who is viewing, for unique view counts: user id, or IP address."""
+
+    if g.user:
+        return f"user:{g.user.id}"
+    return f"ip:{request.remote_addr}"
+
+
 def do_login(user):
     """Log in user."""
 
@@ -54,6 +141,25 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
+def wants_json():
+    """Did the client ask for JSON rather than a page?
+
+    Scripts updating a button in place send `Accept: application/json`;
+    plain form posts from browsers prefer HTML and get the redirect.
+    """
+
+    best = request.accept_mimetypes.best_match(['text/html',
+                                                'application/json'])
+    return best == 'application/json'
+
+
+def flash_unless_json(message, category):
+    """Flash `message` for the next page, unless answering with JSON."""
+
+    if not wants_json():
+        flash(message, category)
+
+
 @app.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
@@ -123,6 +229,29 @@ def logout():
 ##############################################################################
 # General user routes:
 
+def with_follow_state(users, viewer, batch_size=FOLLOW_PAGE_SIZE):
+    """Yield (user, viewer follows user) for each of `users`, lazily.
+
+    Follow state is looked up for a batch of users at a time, so a long
+    list costs one follows query per batch rather than one per user.
+    """
+
+    batch = []
+
+    def flush():
+        following = viewer.follow_state(batch)[0] if viewer else set()
+        for user in batch:
+            yield user, user.id in following
+        batch.clear()
+
+    for user in users:
+        batch.append(user)
+        if len(batch) == batch_size:
+            yield from flush()
+
+    yield from flush()
+
+
 @app.route('/users')
 def list_users():
     """Page with listing of users.
@@ -132,29 +261,40 @@ def list_users():
 
     search = request.args.get('q')
 
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+    users = User.active().order_by(User.id)
+    if search:
+        users = users.filter(User.username.like(f"%{search}%"))
+
+    return Response(stream_template(
+        'users/index.html', users=with_follow_state(users, g.user)))
+
+
+def profile_header(user):
+    """Context for the profile header of users/detail.html.
+
+    Loaded before the response starts, so a database error here still
+    gets the error handlers, and the header renders without a query.
+    """
 
-    return render_template('users/index.html', users=users)
+    following_user = bool(g.user) and g.user.is_following(user)
+    return dict(stats=user.stats(), following_user=following_user)
 
 
 @app.route('/users/<int:user_id>')
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
+    user = User.active().filter_by(id=user_id).first_or_404()
 
-    # snagging messages in order from the database;
-    # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
+    # snagging messages newest first (ids are time-ordered);
+    # user.messages won't be in order by default. Read lazily, so the
+    # header and profile card are sent before the messages are queried;
+    # LoadShedder cuts the page short if that query fails.
+    messages = viewcounter.counted(newest_messages(
+        Message.query.filter(Message.user_id == user_id), 100), viewer_key())
+    return Response(stream_template('users/show.html', user=user,
+                                    messages=messages,
+                                    **profile_header(user)))
 
 
 @app.route('/users/<int:user_id>/following')
@@ -165,8 +305,13 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user = User.active().filter_by(id=user_id).first_or_404()
+    rows, next_cursor = user.following_page(
+        g.user, after=request.args.get('after', type=int),
+        limit=FOLLOW_PAGE_SIZE)
+    return Response(stream_template('users/following.html', user=user,
+                                    rows=rows, next_cursor=next_cursor,
+                                    **profile_header(user)))
 
 
 @app.route('/users/<int:user_id>/followers')
@@ -177,8 +322,63 @@ def users_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    user = User.active().filter_by(id=user_id).first_or_404()
+    rows, next_cursor = user.followers_page(
+        g.user, after=request.args.get('after', type=int),
+        limit=FOLLOW_PAGE_SIZE)
+    return Response(stream_template('users/followers.html', user=user,
+                                    rows=rows, next_cursor=next_cursor,
+                                    **profile_header(user)))
+
+
+@app.route('/users/<int:user_id>/mentions')
+def users_mentions(user_id):
+    """Show the newest messages mentioning this user, a page at a time."""
+
+    user = User.active().filter_by(id=user_id).first_or_404()
+    query = (Message
+             .visible()
+             .join(Mention, Mention.message_id == Message.id)
+             .filter(Mention.user_id == user_id))
+
+    messages, next_cursor = newest_first(query, Mention.message_id)
+    return render_template('users/mentions.html', user=user,
+                           messages=messages, next_cursor=next_cursor,
+                           **profile_header(user))
+
+
+def set_follow(user, other_user, following):
+    """Follow or unfollow `other_user` as `user`.
+
+    Goes through the write-behind buffer when WRITE_BEHIND is on, and
+    straight to the database otherwise. Returns False if `user` already
+    was (or wasn't) following.
+    """
+
+    if writebehind.enabled:
+        return writebehind.set_follow(user.id, other_user.id, following)
+
+    if user.is_following(other_user) == following:
+        return False
+
+    if following:
+        user.following.append(other_user)
+    else:
+        user.following.remove(other_user)
+    db.session.commit()
+    return True
+
+
+def set_like(user, message, liked):
+    """Like or unlike `message` as `user`; see `set_follow`."""
+
+    if writebehind.enabled:
+        return writebehind.set_like(user.id, message.id, liked)
+
+    changed = user.add_like(message) if liked else user.remove_like(message)
+    if changed:
+        db.session.commit()
+    return changed
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -186,12 +386,16 @@ def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
     if not g.user:
+        if wants_json():
+            return jsonify(error="Access unauthorized."), 401
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
+    followed_user = User.active().filter_by(id=follow_id).first_or_404()
+    set_follow(g.user, followed_user, True)
+
+    if wants_json():
+        return jsonify(user_id=follow_id, following=True)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -201,16 +405,63 @@ def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
     if not g.user:
+        if wants_json():
+            return jsonify(error="Access unauthorized."), 401
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
+    followed_user = User.active().filter_by(id=follow_id).first_or_404()
+    set_follow(g.user, followed_user, False)
+
+    if wants_json():
+        return jsonify(user_id=follow_id, following=False)
 
     return redirect(f"/users/{g.user.id}/following")
 
 
+@app.route('/api/follows', methods=['POST'])
+def follow_many():
+    """Follow many users at once.
+
+    Takes JSON {"user_ids": [...], "usernames": [...]}, up to
+    BULK_FOLLOW_LIMIT entries in all, and returns the ids newly
+    followed, those already followed, and the entries that matched no
+    user.
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    data = request.get_json(silent=True) or {}
+    user_ids = data.get('user_ids', [])
+    usernames = data.get('usernames', [])
+
+    if not isinstance(user_ids, list) or not isinstance(usernames, list) or \
+            not all(isinstance(user_id, int) for user_id in user_ids) or \
+            not all(isinstance(name, str) for name in usernames):
+        return jsonify(error="Expected lists of user_ids and usernames."), 400
+
+    if len(user_ids) + len(usernames) > BULK_FOLLOW_LIMIT:
+        return jsonify(
+            error=f"At most {BULK_FOLLOW_LIMIT} users at a time."), 400
+
+    if writebehind.enabled:
+        # so buffered unfollows can't undo these follows afterwards
+        writebehind.flush()
+
+    found, added = g.user.follow_many(user_ids, usernames)
+    db.session.commit()
+
+    known_names = set(found.values())
+    added_set = set(added)
+    return jsonify(
+        followed=added,
+        already_following=[user_id for user_id in found
+                           if user_id not in added_set],
+        not_found=([user_id for user_id in user_ids if user_id not in found] +
+                   [name for name in usernames if name not in known_names]))
+
+
 @app.route('/users/profile', methods=["GET", "POST"])
 def profile():
     """Update profile for current user."""
@@ -236,6 +487,7 @@ def profile():
         g.user.bio = form.bio.data
 
         db.session.commit()
+        cache.delete(f"user_card:{g.user.id}")
         flash('Profile updated.', 'success')
         return redirect(f'/users/{g.user.id}')
     
@@ -252,8 +504,13 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    # Hidden at once; the purge_user job removes the rows.
+    g.user.soft_delete()
+    jobs.enqueue('purge_user', key=f"purge_user:{g.user.id}",
+                 user_id=g.user.id)
     db.session.commit()
+    # again, in case a read cached the card before the commit
+    cache.delete(f"user_card:{g.user.id}")
 
     return redirect("/signup")
 
@@ -263,17 +520,24 @@ def add_like(message_id):
     """Like a message."""
 
     if not g.user:
+        if wants_json():
+            return jsonify(error="Access unauthorized."), 401
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
     message = Message.query.get_or_404(message_id)
 
-    if message in g.user.likes:
-        flash("You have already liked this message.", "info")
+    if not set_like(g.user, message, True):
+        flash_unless_json("You have already liked this message.", "info")
     else:
-        g.user.likes.append(message)
-        db.session.commit()
-        flash("Message liked!", "success")
+        cache.delete(f"message:{message_id}")
+        trending.add(message_id)
+        flash_unless_json("Message liked!", "success")
+
+    if wants_json():
+        return jsonify(message_id=message_id, liked=True,
+                       like_count=(message.like_count +
+                                   writebehind.like_delta(message_id)))
 
     return redirect(request.referrer or '/')  # Redirect back to the previous page
 
@@ -283,34 +547,266 @@ def remove_like(message_id):
     """Unlike a message."""
 
     if not g.user:
+        if wants_json():
+            return jsonify(error="Access unauthorized."), 401
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
     message = Message.query.get_or_404(message_id)
 
-    if message not in g.user.likes:
-        flash("You have not liked this message.", "info")
+    if not set_like(g.user, message, False):
+        flash_unless_json("You have not liked this message.", "info")
     else:
-        g.user.likes.remove(message)
-        db.session.commit()
-        flash("Message unliked!", "success")
+        cache.delete(f"message:{message_id}")
+        trending.add(message_id, -1)
+        flash_unless_json("Message unliked!", "success")
+
+    if wants_json():
+        return jsonify(message_id=message_id, liked=False,
+                       like_count=(message.like_count +
+                                   writebehind.like_delta(message_id)))
 
     return redirect(request.referrer or '/')  # Redirect back to the previous pag
 
 
+def export_records(user_id, after=None):
+    """Yield everything a user has, one record dict at a time.
+
+    Records come in sections (messages, likes, following, followers),
+    each in key order, read through server-side cursors EXPORT_BATCH_SIZE
+    rows at a time. `after` is a (type, id) pair from an earlier export;
+    records up to and including it are skipped.
+    """
+
+    sections = [
+        ('message', Message.id, (db.session
+         .query(Message.id, Message.text, Message.timestamp)
+         .filter(Message.user_id == user_id))),
+        ('like', Likes.message_id, (db.session
+         .query(Likes.message_id)
+         .filter(Likes.user_id == user_id))),
+        ('following', User.id, (db.session
+         .query(User.id, User.username)
+         .join(Follows, Follows.user_being_followed_id == User.id)
+         .filter(Follows.user_following_id == user_id))),
+        ('follower', User.id, (db.session
+         .query(User.id, User.username)
+         .join(Follows, Follows.user_following_id == User.id)
+         .filter(Follows.user_being_followed_id == user_id))),
+    ]
+
+    names = [name for name, key, query in sections]
+    start = names.index(after[0]) if after else 0
+
+    for name, key, query in sections[start:]:
+        if after and name == after[0]:
+            query = query.filter(key > after[1])
+
+        for row in query.order_by(key).yield_per(EXPORT_BATCH_SIZE):
+            record = dict(type=name, **row._asdict())
+            if 'message_id' in record:
+                record['id'] = record.pop('message_id')
+            if 'timestamp' in record:
+                record['timestamp'] = record['timestamp'].isoformat()
+            yield record
+
+
+@app.route('/users/export')
+def export_user():
+    """Download the logged-in user's messages, likes and follows.
+
+    `format` is ndjson (one JSON object per line, the default) or csv.
+    Each record has a `type` and `id`; to resume a download that broke
+    off, pass the last complete record as `after=<type>:<id>`.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    fmt = request.args.get('format', 'ndjson')
+    if fmt not in ('ndjson', 'csv'):
+        abort(400)
+
+    after = None
+    if request.args.get('after'):
+        section, _, key = request.args['after'].partition(':')
+        if section not in ('message', 'like', 'following', 'follower') or \
+                not key.isdigit():
+            abort(400)
+        after = (section, int(key))
+
+    records = export_records(g.user.id, after)
+
+    def ndjson():
+        for record in records:
+            yield json.dumps(record) + '\n'
+
+    def csv_rows():
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, EXPORT_FIELDS)
+        if after is None:
+            writer.writeheader()
+
+        for record in records:
+            writer.writerow(record)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+        yield buffer.getvalue()
+
+    body, mimetype = ((ndjson(), 'application/x-ndjson') if fmt == 'ndjson'
+                      else (csv_rows(), 'text/csv'))
+
+    return Response(stream_with_context(body), mimetype=mimetype, headers={
+        # named by id: usernames aren't limited to what's safe in a header
+        'Content-Disposition':
+            f'attachment; filename="warbler-{g.user.id}.{fmt}"',
+        # resume with ?after= rather than byte ranges; the body is
+        # generated, so byte offsets aren't stable between downloads
+        'Accept-Ranges': 'none',
+    })
+
+
+def parse_like_cursor(value):
+    """Parse a liked-page cursor, `<liked_at ISO timestamp>~<message id>`.
+
+    Returns a (liked_at, message_id) pair, or None if `value` is missing
+    or malformed.
+    """
+
+    liked_at, _, message_id = (value or '').rpartition('~')
+    try:
+        return datetime.fromisoformat(liked_at), int(message_id)
+    except ValueError:
+        return None
+
+
 @app.route('/users/<int:user_id>/liked')
 def show_liked_messages(user_id):
-    """Show messages liked by a user."""
+    """Show messages liked by a user, most recently liked first."""
+
+    user = User.active().filter_by(id=user_id).first_or_404()
+    rows, next_cursor = user.liked_page(
+        before=parse_like_cursor(request.args.get('before')),
+        limit=MESSAGE_PAGE_SIZE)
+    if next_cursor:
+        liked_at, message_id = next_cursor
+        next_cursor = f"{liked_at.isoformat()}~{message_id}"
 
-    user = User.query.get_or_404(user_id)
-    liked_messages = user.liked_messages()
-    return render_template('messages/liked_messages.html', user=user, messages=liked_messages)
+    likes = set()
+    if g.user and rows:
+        message_ids = [message.id for message, liked_at in rows]
+        likes = {message_id for (message_id,) in (db.session
+                 .query(Likes.message_id)
+                 .filter(Likes.user_id == g.user.id,
+                         Likes.message_id.in_(message_ids)))}
+        added, removed = writebehind.overlay('like', g.user.id)
+        likes = likes - removed | added
+
+    return render_template('messages/liked_messages.html', user=user,
+                           rows=rows, likes=likes, next_cursor=next_cursor)
 
 
 
 ##############################################################################
 # Messages routes:
 
+def newest_first(query, id_column):
+    """Return one page of `query`, newest message id first.
+
+    `query` comes from Message.visible(), whose join loads the authors.
+
+    Pages are keyed by the `before` query string parameter, so each page
+    is an index scan down `id_column` from the cursor. Returns (messages,
+    next_cursor); next_cursor is None on the last page.
+    """
+
+    before = request.args.get('before', type=int)
+    if before is not None:
+        query = query.filter(id_column < before)
+
+    messages = (query
+                .options(contains_eager(Message.user))
+                .order_by(id_column.desc())
+                .limit(MESSAGE_PAGE_SIZE + 1)
+                .all())
+
+    if len(messages) > MESSAGE_PAGE_SIZE:
+        messages = messages[:MESSAGE_PAGE_SIZE]
+        return messages, messages[-1].id
+
+    return messages, None
+
+
+def newest_messages(query, limit):
+    """The newest `limit` messages of `query`, newest first, as an iterable.
+
+    With snowflake ids, the last FEED_WINDOW_DAYS are read first, so on
+    a partitioned messages table a busy feed never scans old partitions;
+    see partitions.recent_first.
+    """
+
+    if not snowflakes.enabled:
+        return query.order_by(Message.id.desc()).limit(limit)
+
+    window = timedelta(days=app.config['FEED_WINDOW_DAYS'])
+    return partitions.recent_first(query, limit, window)
+
+
+@app.template_filter('link_tags')
+def link_tags(text):
+    """Escape message text and turn each #tag in it into a link."""
+
+    pieces = []
+    last = 0
+
+    for match in Message.TAG_PATTERN.finditer(text):
+        tag = match.group(1)
+        pieces.append(escape(text[last:match.start()]))
+        pieces.append(Markup('<a href="{}">#{}</a>').format(
+            url_for('messages_tagged', tag=tag.lower()), tag))
+        last = match.end()
+
+    pieces.append(escape(text[last:]))
+    return Markup('').join(pieces)
+
+
+def cached_message(message_id):
+    """Return a message as a dict, read through the cache.
+
+    Returns None (also cached, briefly) if there is no such message.
+    """
+
+    def load():
+        msg = Message.query.get(message_id)
+        if msg is None:
+            return None
+
+        return dict(id=msg.id, text=msg.text, timestamp=msg.timestamp,
+                    user_id=msg.user_id, like_count=msg.like_count)
+
+    return cache.get_or_load(f"message:{message_id}", load)
+
+
+def cached_user_card(user_id):
+    """Return the public card of a user as a dict, read through the cache.
+
+    Returns None (also cached, briefly) for deleted and unknown users.
+    """
+
+    def load():
+        user = User.active().filter_by(id=user_id).first()
+        if user is None:
+            return None
+
+        return dict(id=user.id, username=user.username,
+                    image_url=user.image_url)
+
+    return cache.get_or_load(f"user_card:{user_id}", load)
+
+
 @app.route('/messages/new', methods=["GET", "POST"])
 def messages_add():
     """Add a message:
@@ -328,7 +824,15 @@ def messages_add():
         
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        db.session.flush()
+        Message.index_text([msg])
         db.session.commit()
+        cache.delete(f"message:{msg.id}")
+        cache.set(f"hwm:{g.user.id}", msg.id,
+                  ttl=app.config['HIGH_WATER_MARK_TTL'])
+        broker.publish(f"user:{g.user.id}",
+                       dict(id=msg.id, id_str=str(msg.id),
+                            user_id=g.user.id))
 
         return redirect(f"/users/{g.user.id}")
 
@@ -337,10 +841,49 @@ def messages_add():
 
 @app.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
-    """Show a message."""
+    """Show a message.
 
-    msg = Message.query.get(message_id)
-    return render_template('messages/show.html', message=msg)
+    The message and its author card come from the cache; the viewer's
+    like/follow state is two index probes, and the view count (with
+    VIEW_COUNTS on) one more.
+    """
+
+    message = cached_message(message_id)
+    if message is None:
+        abort(404)
+
+    author = cached_user_card(message['user_id'])
+    if author is None:
+        abort(404)
+
+    liked = following = False
+    if g.user:
+        liked = writebehind.likes(g.user.id, message_id)
+        following = writebehind.follows(g.user.id, author['id'])
+
+    views = viewers = None
+    if viewcounter.enabled:
+        viewcounter.record(message_id, viewer_key())
+        views, viewers = viewcounter.stats(message_id)
+
+    return render_template('messages/show.html', message=message,
+                           author=author, liked=liked, following=following,
+                           views=views, viewers=viewers)
+
+
+@app.route('/tags/<tag>')
+def messages_tagged(tag):
+    """Show the newest messages using #tag, a page at a time."""
+
+    tag = tag.lower()
+    query = (Message
+             .visible()
+             .join(MessageTag, MessageTag.message_id == Message.id)
+             .filter(MessageTag.tag == tag))
+
+    messages, next_cursor = newest_first(query, MessageTag.message_id)
+    return render_template('messages/tagged.html', tag=tag,
+                           messages=messages, next_cursor=next_cursor)
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
@@ -359,10 +902,276 @@ def messages_destroy(message_id):
     
     db.session.delete(msg)
     db.session.commit()
+    cache.delete(f"message:{message_id}")
+    trending.forget(message_id)
 
     return redirect(f"/users/{g.user.id}")
 
 
+def message_json(msg):
+    """Return the public JSON fields of a message."""
+
+    return dict(id=msg.id,
+                # snowflake ids don't fit in a JavaScript number
+                id_str=str(msg.id),
+                text=msg.text,
+                timestamp=msg.timestamp.isoformat(),
+                user_id=msg.user_id,
+                like_count=msg.like_count)
+
+
+def trending_messages(window):
+    """Return (message, likes) pairs for the top messages in `window`."""
+
+    top = trending.top(window)
+    messages = {msg.id: msg
+                for msg in (Message
+                            .visible()
+                            .options(contains_eager(Message.user))
+                            .filter(Message.id.in_(
+                                [message_id for message_id, _ in top])))}
+
+    return [(messages[message_id], likes)
+            for message_id, likes in top if message_id in messages]
+
+
+@app.route('/trending')
+def show_trending():
+    """Show the most liked messages of the last hour or day."""
+
+    window = request.args.get('window', 'hour')
+    if window not in WINDOWS:
+        abort(404)
+
+    return render_template('messages/trending.html', window=window,
+                           windows=WINDOWS, trending=trending_messages(window))
+
+
+@app.route('/api/trending')
+def api_trending():
+    """Return the most liked messages of the last hour or day as JSON."""
+
+    window = request.args.get('window', 'hour')
+    if window not in WINDOWS:
+        abort(404)
+
+    return jsonify(
+        window=window,
+        messages=[dict(message_json(msg), likes=likes)
+                  for msg, likes in trending_messages(window)])
+
+
+@app.route('/api/messages/<int:message_id>')
+def api_messages_show(message_id):
+    """Return a message as JSON."""
+
+    message = cached_message(message_id)
+    if message is None or cached_user_card(message['user_id']) is None:
+        abort(404)
+
+    return jsonify(dict(message, timestamp=message['timestamp'].isoformat()))
+
+
+##############################################################################
+# Admin routes:
+
+@app.route('/admin/slow-queries')
+def admin_slow_queries():
+    """Show the most expensive slow queries seen by this process."""
+
+    if not g.user or not g.user.is_admin:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    return render_template('admin/slow_queries.html',
+                           queries=slow_query_log.top(),
+                           threshold_ms=slow_query_log.threshold_ms)
+
+
+@app.route('/admin/metrics')
+def admin_metrics():
+    """Show SQL, template and block timings for this process."""
+
+    if not g.user or not g.user.is_admin:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    jobs.queue_depth()
+
+    return render_template('admin/metrics.html',
+                           timers=metrics.timers(),
+                           counters=metrics.counters(),
+                           gauges=metrics.gauges())
+
+
+##############################################################################
+# Live updates
+
+
+@app.route('/stream/home')
+def stream_home():
+    """Server-Sent Events stream of new messages for the home timeline.
+
+    Sends a `message` event with the id and author of each new message
+    from a followed user (or the viewer), and a `reset` event if the
+    client fell so far behind that events were dropped.
+
+    Each open stream holds a worker thread (unless the server runs
+    under gevent), so at most STREAM_MAX_CONNECTIONS are open per
+    process; past that, clients get a 503 and poll /api/timeline/new.
+    """
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    if not stream_slots.acquire(blocking=False):
+        metrics.incr("stream:rejected")
+        return Response(status=503, headers={'Retry-After': '30'})
+
+    topics = [f"user:{user_id}" for user_id in g.user.following_ids()]
+    topics.append(f"user:{g.user.id}")
+    heartbeat = app.config['STREAM_HEARTBEAT_SECONDS']
+
+    def events():
+        # subscribed only once the stream is being sent, so a response
+        # that is never iterated has nothing to clean up
+        subscription = None
+        try:
+            subscription = broker.subscribe(topics)
+            yield "retry: 5000\n\n"
+            while True:
+                messages, overflowed = subscription.get(timeout=heartbeat)
+
+                if overflowed:
+                    yield "event: reset\ndata: {}\n\n"
+
+                for message in messages:
+                    yield (f"id: {message['id']}\n"
+                           f"event: message\n"
+                           f"data: {json.dumps(message)}\n\n")
+
+                if not messages and not overflowed:
+                    yield ": keep-alive\n\n"
+        finally:
+            if subscription is not None:
+                broker.unsubscribe(subscription)
+
+    resp = Response(events(), mimetype='text/event-stream',
+                    headers={'X-Accel-Buffering': 'no'})
+    # on close, not in events(), so a stream never sent still frees it
+    resp.call_on_close(stream_slots.release)
+    return resp
+
+
+def author_high_water_marks(user_ids):
+    """Return {user_id: newest message id} for `user_ids`, via the cache.
+
+    Authors missing from the cache are looked up together in one
+    grouped query over the (user_id, id) index. Authors without
+    messages map to 0. Entries expire after HIGH_WATER_MARK_TTL seconds,
+    which bounds how stale another worker's view can be.
+    """
+
+    marks = {}
+    missing = []
+    for user_id in user_ids:
+        mark = cache.get(f"hwm:{user_id}")
+        if mark is None:
+            missing.append(user_id)
+        else:
+            marks[user_id] = mark
+
+    if missing:
+        found = dict(db.session
+                     .query(Message.user_id, db.func.max(Message.id))
+                     .filter(Message.user_id.in_(missing))
+                     .group_by(Message.user_id))
+
+        for user_id in missing:
+            marks[user_id] = found.get(user_id, 0)
+            cache.set(f"hwm:{user_id}", marks[user_id],
+                      ttl=app.config['HIGH_WATER_MARK_TTL'])
+
+    return marks
+
+
+@app.route('/api/timeline/new')
+def api_timeline_new():
+    """Count home timeline messages newer than the `since` message id.
+
+    Pass `ids=1` to also get their ids (newest first, at most
+    MESSAGE_PAGE_SIZE). Responses carry an ETag, and a matching
+    If-None-Match gets an empty 304.
+    """
+
+    if not g.user:
+        return jsonify(error="Access unauthorized."), 401
+
+    since = request.args.get('since', 0, type=int)
+    want_ids = request.args.get('ids') == '1'
+
+    authors = g.user.following_ids()
+    authors.append(g.user.id)
+    newest = max(author_high_water_marks(authors).values())
+
+    etag = "{}-{}-{}-{}".format(since, newest, int(want_ids),
+                                hash(frozenset(authors)))
+    if request.if_none_match.contains_weak(etag):
+        resp = Response(status=304)
+        resp.set_etag(etag, weak=True)
+        return resp
+
+    ids = []
+    if newest > since:
+        ids = [message_id for (message_id,) in (db.session
+               .query(Message.id)
+               .filter(Message.user_id.in_(authors), Message.id > since)
+               .order_by(Message.id.desc())
+               .limit(MESSAGE_PAGE_SIZE + 1))]
+
+    result = dict(count=min(len(ids), MESSAGE_PAGE_SIZE),
+                  more=len(ids) > MESSAGE_PAGE_SIZE,
+                  newest=newest)
+    if want_ids:
+        result['ids'] = ids[:MESSAGE_PAGE_SIZE]
+
+    resp = jsonify(result)
+    resp.set_etag(etag, weak=True)
+    return resp
+
+
+##############################################################################
+# Background jobs
+
+
+@jobs.handler('purge_user')
+def purge_user_job(user_id):
+    """Remove a deleted account's rows."""
+
+    User.purge(user_id)
+
+
+@jobs.handler('recount_likes')
+def recount_likes_job():
+    """Repair drift in messages.like_count."""
+
+    Message.recount_likes()
+
+
+@jobs.every(3600)
+def create_partitions_task():
+    """Keep message partitions ready ahead of new ids, even if cron lapses."""
+
+    if partitions.is_partitioned():
+        partitions.create_partitions()
+
+
+if app.config['JOBS_IN_PROCESS']:
+    jobs.Worker(app, concurrency=app.config['JOBS_CONCURRENCY'],
+                retention_days=app.config['JOBS_RETENTION_DAYS']).start()
+
+
 ##############################################################################
 # Homepage and error pages
 
@@ -377,19 +1186,25 @@ def homepage():
 
     if g.user:
         # Get list of user IDs that the logged-in user is following
-        followed_user_ids = [user.id for user in g.user.following]
+        followed_user_ids = g.user.following_ids()
         followed_user_ids.append(g.user.id) # Include the logged in user
 
+        # Count follows still waiting in the write-behind buffer
+        added, removed = writebehind.overlay('follow', g.user.id)
+        followed_user_ids = list(set(followed_user_ids) - removed | added)
+
         # Query for the last 100 messages from followed user and the logged-in user.
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(followed_user_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        messages = list(viewcounter.counted(newest_messages(
+            Message.visible().filter(Message.user_id.in_(followed_user_ids)),
+            100),
+            viewer_key()))
         
         likes = {like.message_id for like in Likes.query.filter_by(user_id=g.user.id).all()}
-        return render_template('home.html', messages=messages, likes=likes)
+        added, removed = writebehind.overlay('like', g.user.id)
+        likes = likes - removed | added
+        suggestions = g.user.follow_suggestions()
+        return render_template('home.html', messages=messages, likes=likes,
+                               suggestions=suggestions)
 
     else:
         return render_template('home-anon.html')
@@ -398,9 +1213,126 @@ def homepage():
 @app.errorhandler(404)
 def page_not_found(e):
     """Custom 404 page."""
+    if wants_json():
+        return jsonify(error="Not found."), 404
     return render_template('404.html'), 404
 
 
+##############################################################################
+# Command line tools, run like:
+#
+#    flask warbler recommend
+
+warbler_cli = AppGroup('warbler', help="Warbler maintenance commands.")
+
+
+@warbler_cli.command('recommend')
+@click.option('--top-k', default=5, show_default=True,
+              help="Suggestions to store per user.")
+def recommend_command(top_k):
+    """Recompute "who to follow" suggestions for every user."""
+
+    from recommendations import rebuild_suggestions
+
+    stored = rebuild_suggestions(k=top_k)
+    click.echo(f"Stored {stored} suggestions.")
+
+
+@warbler_cli.command('recount-likes')
+@click.option('--batch-size', default=10000, show_default=True,
+              help="Messages to recount per transaction.")
+def recount_likes_command(batch_size):
+    """Repair every message's like_count from the likes table."""
+
+    corrected = Message.recount_likes(batch_size=batch_size)
+    click.echo(f"Corrected {corrected} messages.")
+
+
+@warbler_cli.command('backfill-tags')
+@click.option('--chunk-size', default=1000, show_default=True,
+              help="Messages to index per transaction.")
+def backfill_tags_command(chunk_size):
+    """Index #tags and @mentions of all existing messages."""
+
+    processed = Message.backfill_text_index(chunk_size=chunk_size)
+    click.echo(f"Indexed {processed} messages.")
+
+
+@warbler_cli.command('purge-deleted')
+@click.option('--batch-size', default=1000, show_default=True,
+              help="Rows to delete per transaction.")
+def purge_deleted_command(batch_size):
+    """Remove the rows of deleted accounts."""
+
+    purged = User.purge_deleted(batch_size=batch_size)
+    click.echo(f"Purged {purged} accounts.")
+
+
+@warbler_cli.command('worker')
+@click.option('--concurrency', default=4, show_default=True,
+              help="Jobs to run at once.")
+def worker_command(concurrency):
+    """Run background jobs until interrupted."""
+
+    worker = jobs.Worker(app, concurrency=concurrency,
+                         retention_days=app.config['JOBS_RETENTION_DAYS'])
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        worker.stop()
+
+
+@warbler_cli.command('partition-messages')
+@click.option('--months-ahead', default=3, show_default=True,
+              help="Monthly partitions to create past this one.")
+def partition_messages_command(months_ahead):
+    """Convert the messages table to monthly partitions (needs snowflake ids)."""
+
+    if not app.config['SNOWFLAKE_IDS']:
+        raise click.ClickException("Partitioning needs SNOWFLAKE_IDS=1.")
+    if partitions.is_partitioned():
+        raise click.ClickException("Messages are already partitioned.")
+
+    partitions.partition_messages(months_ahead=months_ahead)
+    db.session.commit()
+    click.echo(f"Partitioned messages into {len(partitions.partitions())} "
+               f"partitions.")
+
+
+@warbler_cli.command('create-partitions')
+@click.option('--months-ahead', default=3, show_default=True,
+              help="Monthly partitions to keep ready past this one.")
+def create_partitions_command(months_ahead):
+    """Create the coming months' message partitions."""
+
+    if not partitions.is_partitioned():
+        raise click.ClickException("Messages aren't partitioned.")
+
+    created = partitions.create_partitions(months_ahead=months_ahead)
+    db.session.commit()
+    click.echo(f"Created {len(created)} partitions.")
+
+
+@warbler_cli.command('archive-messages')
+@click.option('--older-than', default=12, show_default=True,
+              help="Archive partitions at least this many months old.")
+@click.option('--tablespace', default=None,
+              help="Tablespace to move them to [default: ARCHIVE_TABLESPACE].")
+def archive_messages_command(older_than, tablespace):
+    """Compact and freeze old message partitions."""
+
+    if not partitions.is_partitioned():
+        raise click.ClickException("Messages aren't partitioned.")
+
+    archived = partitions.archive_partitions(
+        older_than_months=older_than,
+        tablespace=tablespace or app.config['ARCHIVE_TABLESPACE'])
+    click.echo(f"Archived {len(archived)} partitions.")
+
+
+app.cli.add_command(warbler_cli)
+
+
 ##############################################################################
 # Turn off all caching in Flask
 #   (useful for dev; in production, this kind of stuff is typically
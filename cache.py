@@ -0,0 +1,85 @@
+"""In-process read-through cache for Warbler.
+
+A bounded, thread-safe LRU cache with per-entry expiry. Values are plain
+data (dicts, lists, strings), never ORM objects, since those are bound to
+the session of the request that loaded them.
+
+A loader returning None is cached too ("negative caching"), for a shorter
+time, so repeated requests for a missing id don't each reach the database.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+_MISSING = object()
+
+
+class Cache:
+    """Bounded LRU cache with time-based expiry."""
+
+    def __init__(self, maxsize=10000, ttl=60, negative_ttl=10):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return the cached value for `key`, or `default`."""
+
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is _MISSING:
+                return default
+
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return default
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Cache `value` under `key` for `ttl` seconds."""
+
+        if ttl is None:
+            ttl = self.ttl if value is not None else self.negative_ttl
+
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get_or_load(self, key, loader, ttl=None):
+        """Return the cached value for `key`, calling `loader()` on a miss.
+
+        The loader runs outside the lock; two concurrent misses may both
+        load, which is harmless for idempotent reads.
+        """
+
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = loader()
+            self.set(key, value, ttl)
+
+        return value
+
+    def delete(self, key):
+        """Forget `key`."""
+
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Forget everything."""
+
+        with self._lock:
+            self._entries.clear()
+
+
+cache = Cache()
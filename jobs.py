@@ -0,0 +1,357 @@
+"""Background jobs for Warbler, queued in Postgres.
+
+Work that doesn't need to finish before a response is sent (purging a
+deleted account, recounting likes, ...) is queued as a row in the `jobs`
+table with `enqueue`, inside the same transaction as the change that
+calls for it, and run later by a `Worker`:
+
+    @jobs.handler('purge_user')
+    def purge_user_job(user_id):
+        ...
+
+    jobs.enqueue('purge_user', key=f"purge_user:{user.id}",
+                 user_id=user.id)
+    db.session.commit()
+
+Workers claim due jobs with SELECT ... FOR UPDATE SKIP LOCKED, so any
+number of them (threads in the web process, or `flask warbler worker`
+processes) can share the queue without handing out a job twice. A failed
+job is retried with exponential backoff up to its `max_attempts`; a job
+whose worker died is picked up again once its lease runs out. Handlers
+should be idempotent, since a job can run more than once in that case.
+
+Each claim is fenced by the job's attempt number: a worker that outlived
+its lease, and lost the job to another, can't overwrite the outcome of
+the later attempt.
+
+Workers sample the queue depth gauges every `depth_seconds`, and delete
+done jobs older than `retention_days`, which frees their idempotency
+keys. They also run the maintenance tasks registered with `every`:
+
+    @jobs.every(3600)
+    def create_partitions_task():
+        ...
+
+Every worker runs each task on its own schedule, so a task has to be
+safe to run concurrently.
+"""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy.dialects.postgresql import insert
+
+from metrics import metrics
+from models import db, Job
+
+
+_handlers = {}
+_periodic = {}
+
+
+def handler(name):
+    """Register the decorated function to run jobs called `name`.
+
+    The job's args are passed as keyword arguments.
+    """
+
+    def register(func):
+        _handlers[name] = func
+        return func
+
+    return register
+
+
+def every(seconds):
+    """Have workers run the decorated function every `seconds` seconds.
+
+    It runs in an app context; its changes are committed if it returns,
+    and rolled back (and logged) if it raises.
+    """
+
+    def register(func):
+        _periodic[func.__name__] = (seconds, func)
+        return func
+
+    return register
+
+
+def enqueue(name, key=None, delay=0, max_attempts=5, **args):
+    """Queue job `name` with keyword `args`, to run after `delay` seconds.
+
+    If `key` is given and a job with that idempotency key was already
+    queued, nothing is added. The caller commits.
+    """
+
+    stmt = insert(Job.__table__).values(
+        name=name,
+        args=args,
+        idempotency_key=key,
+        status='queued',
+        attempts=0,
+        max_attempts=max_attempts,
+        run_at=datetime.utcnow() + timedelta(seconds=delay),
+    )
+    if key is not None:
+        stmt = stmt.on_conflict_do_nothing(index_elements=['idempotency_key'])
+
+    db.session.execute(stmt)
+
+
+def queue_depth():
+    """Returns {status: number of jobs}, and sets matching gauges."""
+
+    depth = dict(db.session
+                 .query(Job.status, db.func.count())
+                 .group_by(Job.status))
+
+    for status in ('queued', 'running', 'failed'):
+        metrics.set_gauge(f"jobs:{status}", depth.get(status, 0))
+
+    return depth
+
+
+def prune(retention_days, batch_size=1000):
+    """Delete jobs done more than `retention_days` ago, in batches.
+
+    Each batch is its own transaction. Returns how many were deleted.
+    """
+
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    deleted = 0
+
+    while True:
+        batch = (db.session
+                 .query(Job.id)
+                 .filter(Job.status == 'done', Job.finished_at < cutoff)
+                 .limit(batch_size)
+                 .subquery())
+        count = (Job
+                 .query
+                 .filter(Job.id.in_(batch))
+                 .delete(synchronize_session=False))
+        db.session.commit()
+
+        deleted += count
+        if count < batch_size:
+            return deleted
+
+
+def backoff(attempts, base=5, cap=3600):
+    """Seconds to wait before retrying a job that failed `attempts` times."""
+
+    return min(cap, base * 2 ** (attempts - 1))
+
+
+class Worker:
+    """Claims due jobs and runs them on a pool of threads."""
+
+    def __init__(self, app, concurrency=4, poll_seconds=1.0,
+                 lease_seconds=300, depth_seconds=30, retention_days=7,
+                 prune_seconds=3600):
+        self.app = app
+        self.concurrency = concurrency
+        self.poll_seconds = poll_seconds
+        self.lease_seconds = lease_seconds
+        self.depth_seconds = depth_seconds
+        self.retention_days = retention_days
+        self.prune_seconds = prune_seconds
+        self._next_depth = self._next_prune = 0.0
+        self._next_periodic = {}
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def run(self):
+        """Run jobs until `stop` is called.
+
+        Keeps going through database errors (a restart or failover),
+        polling again with backoff until the database is back.
+        """
+
+        with ThreadPoolExecutor(self.concurrency) as pool:
+            running = set()
+            failures = 0
+
+            while not self._stopping.is_set():
+                running = {future for future in running if not future.done()}
+                free = self.concurrency - len(running)
+
+                try:
+                    claimed = self.claim(free) if free else []
+                    for job_id, attempt in claimed:
+                        running.add(pool.submit(self.run_job, job_id, attempt))
+
+                    self.housekeeping()
+
+                except Exception:
+                    failures += 1
+                    self.app.logger.exception("Polling for jobs failed")
+                    metrics.incr("jobs:poll_failed")
+                    with self.app.app_context():
+                        db.session.rollback()
+                    self._stopping.wait(backoff(
+                        failures, base=self.poll_seconds, cap=60))
+                    continue
+
+                failures = 0
+                if not claimed:
+                    self._stopping.wait(self.poll_seconds)
+
+    def run_once(self):
+        """Claim and run due jobs in this thread. Returns how many ran."""
+
+        claimed = self.claim(self.concurrency)
+        for job_id, attempt in claimed:
+            self.run_job(job_id, attempt)
+
+        return len(claimed)
+
+    def housekeeping(self, now=None):
+        """Sample the queue depth, prune done jobs and run periodic tasks,
+        when they're due."""
+
+        now = time.monotonic() if now is None else now
+        due = [name for name in _periodic
+               if now >= self._next_periodic.get(name, 0.0)]
+        if not due and now < min(self._next_depth, self._next_prune):
+            return
+
+        with self.app.app_context():
+            if now >= self._next_depth:
+                self._next_depth = now + self.depth_seconds
+                queue_depth()
+
+            if now >= self._next_prune:
+                self._next_prune = now + self.prune_seconds
+                pruned = prune(self.retention_days)
+                if pruned:
+                    metrics.incr("jobs:pruned", pruned)
+
+            for name in due:
+                seconds, func = _periodic[name]
+                self._next_periodic[name] = now + seconds
+                try:
+                    func()
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+                    self.app.logger.exception("Periodic task %s failed", name)
+                    metrics.incr(f"jobs:{name}:failed")
+
+    def start(self):
+        """Run jobs on a background thread of this process."""
+
+        self._thread = threading.Thread(target=self.run, name='jobs',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def claim(self, limit):
+        """Mark up to `limit` due jobs as running.
+
+        Returns (job id, attempt number) pairs; pass both to `run_job`.
+        """
+
+        with self.app.app_context():
+            now = datetime.utcnow()
+            lease_expired = now - timedelta(seconds=self.lease_seconds)
+
+            jobs = (Job
+                    .query
+                    .filter(db.or_(
+                        db.and_(Job.status == 'queued', Job.run_at <= now),
+                        db.and_(Job.status == 'running',
+                                Job.locked_at < lease_expired)))
+                    .order_by(Job.run_at)
+                    .limit(limit)
+                    .with_for_update(skip_locked=True)
+                    .all())
+
+            claimed = []
+            for job in jobs:
+                if job.attempts >= job.max_attempts:
+                    # its worker died on every attempt
+                    job.status = 'failed'
+                    job.finished_at = now
+                    continue
+
+                job.status = 'running'
+                job.locked_at = now
+                job.attempts += 1
+                claimed.append((job.id, job.attempts))
+
+            db.session.commit()
+
+            return claimed
+
+    def fenced(self, job_id, attempt):
+        """Load and lock job `job_id`, if `attempt` still holds it.
+
+        Returns None, after logging it, if the lease ran out and the job
+        was claimed again (or finished) since.
+        """
+
+        job = (Job
+               .query
+               .filter_by(id=job_id, attempts=attempt, status='running')
+               .with_for_update()
+               .first())
+
+        if job is None:
+            self.app.logger.warning(
+                "Job %s lost its lease during attempt %s", job_id, attempt)
+            metrics.incr("jobs:fenced")
+
+        return job
+
+    def run_job(self, job_id, attempt):
+        """Run one claimed job and record how it went."""
+
+        with self.app.app_context():
+            job = Job.query.get(job_id)
+            if job is None:
+                return  # deleted since it was claimed
+
+            name, args = job.name, job.args
+            started = time.perf_counter()
+
+            try:
+                func = _handlers.get(name)
+                if func is None:
+                    raise LookupError(f"No handler for job {name!r}")
+
+                func(**args)
+                db.session.commit()
+
+            except Exception as exc:
+                db.session.rollback()
+                self.app.logger.exception("Job %s (%s) failed", job_id, name)
+                metrics.incr(f"jobs:{name}:failed")
+
+                job = self.fenced(job_id, attempt)
+                if job is not None:
+                    job.last_error = repr(exc)[:1000]
+                    if job.attempts >= job.max_attempts:
+                        job.status = 'failed'
+                        job.finished_at = datetime.utcnow()
+                    else:
+                        job.status = 'queued'
+                        job.run_at = (datetime.utcnow() +
+                                      timedelta(seconds=backoff(job.attempts)))
+
+            else:
+                metrics.incr(f"jobs:{name}:done")
+                job = self.fenced(job_id, attempt)
+                if job is not None:
+                    job.status = 'done'
+                    job.finished_at = datetime.utcnow()
+
+            metrics.observe(f"job:{name}",
+                            (time.perf_counter() - started) * 1000)
+            db.session.commit()
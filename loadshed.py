@@ -0,0 +1,260 @@
+"""Load shedding for when the database is slow or down.
+
+Read-heavy routes run with a per-route Postgres statement timeout, so a
+slow query fails fast instead of holding a pool connection. Database
+errors (timeouts, refused connections, an exhausted pool) trip a circuit
+breaker; while it is open, requests are answered without touching the
+database: the homepage and profile pages from the last copy this process
+rendered for that user, marked as stale, and everything else with a 503.
+After `reset_seconds` one request is let through to probe the database,
+and its outcome closes or re-opens the breaker.
+
+A streamed page that hits a database error part way through can't be
+answered with a fallback any more; it is cut short with STREAM_ERROR
+instead, and counted against the breaker like any other failure.
+
+GET /health reports the breaker state and pool usage, and answers 503
+while either is saturated so a load balancer can back off.
+"""
+
+import threading
+import time
+
+from flask import Response, current_app, g, jsonify, request, session
+from sqlalchemy import exc
+
+from cache import Cache
+from metrics import metrics
+from models import db
+
+
+STALE_MARKER = "<!-- stale-notice -->"
+STALE_NOTICE = ('<div class="alert alert-warning">Warbler is busy right now; '
+                'this is a copy of the page from earlier.</div>')
+STREAM_ERROR = ('<div class="alert alert-danger">Warbler is busy right now, so '
+                'this page is incomplete. Please try again shortly.</div>')
+
+DATABASE_ERRORS = (exc.OperationalError, exc.TimeoutError)
+
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` consecutive failures."""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_seconds=30):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self, now=None):
+        """May a request use the database?
+
+        Once the breaker has been open for `reset_seconds`, the next
+        caller is allowed through as a probe; others are refused until
+        it reports back, or for another `reset_seconds` if it never does.
+        """
+
+        now = time.monotonic() if now is None else now
+
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+
+            if self._opened_at + self.reset_seconds <= now:
+                self.state = self.HALF_OPEN
+                self._opened_at = now
+                return True
+
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self.state = self.CLOSED
+
+    def record_failure(self, now=None):
+        now = time.monotonic() if now is None else now
+
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or \
+                    self._failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self._opened_at = now
+
+
+class LoadShedder:
+    """Statement timeouts, a database circuit breaker and stale pages."""
+
+    def __init__(self, app=None, session_key='curr_user'):
+        self.session_key = session_key
+        self.breaker = None
+        self.stale = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Hook into `app`.
+
+        Call this before registering the hook that loads the current
+        user, so requests shed while the breaker is open make no query.
+        """
+
+        app.config.setdefault('STATEMENT_TIMEOUTS', {})
+        app.config.setdefault('STALE_ROUTES', ('homepage', 'users_show'))
+        app.config.setdefault('STALE_TTL', 24 * 60 * 60)
+        app.config.setdefault('BREAKER_FAILURE_THRESHOLD', 5)
+        app.config.setdefault('BREAKER_RESET_SECONDS', 30)
+
+        self.breaker = CircuitBreaker(app.config['BREAKER_FAILURE_THRESHOLD'],
+                                      app.config['BREAKER_RESET_SECONDS'])
+        self.stale = Cache(maxsize=1000, ttl=app.config['STALE_TTL'])
+
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        for error in DATABASE_ERRORS:
+            app.register_error_handler(error, self.database_error)
+        app.add_url_rule('/health', 'health', self.health)
+
+    def before_request(self):
+        if request.endpoint in (None, 'static', 'health'):
+            return None
+
+        if not self.breaker.allow():
+            metrics.incr("loadshed:shed")
+            return self.fallback()
+
+        g.db_admitted = True
+
+        timeout = current_app.config['STATEMENT_TIMEOUTS'].get(request.endpoint)
+        if timeout:
+            # set_config(..., true) is SET LOCAL: it ends with the transaction
+            db.session.execute(
+                "SELECT set_config('statement_timeout', :ms, true)",
+                {'ms': str(timeout)})
+
+        return None
+
+    def after_request(self, response):
+        if not g.get('db_admitted') or response.status_code >= 500:
+            return response
+
+        if response.is_streamed:
+            # only a success once the whole body has been produced
+            keep = (self._stale_key() if self._keeps_stale(response)
+                    else None)
+            response.response = self._guard_stream(
+                response.response, keep, request.endpoint,
+                current_app._get_current_object())
+            return response
+
+        self.breaker.record_success()
+
+        if self._keeps_stale(response):
+            self.stale.set(self._stale_key(), response.get_data(as_text=True))
+
+        return response
+
+    def database_error(self, error):
+        """Count a database failure and answer without the database."""
+
+        db.session.rollback()
+        self.breaker.record_failure()
+        metrics.incr("loadshed:db_error")
+        current_app.logger.warning("Database error on %s: %s",
+                                   request.endpoint, error)
+        return self.fallback()
+
+    def fallback(self):
+        """The stale copy of this page if there is one, or else a 503."""
+
+        page = None
+        if request.method == 'GET' and \
+                request.endpoint in current_app.config['STALE_ROUTES']:
+            page = self.stale.get(self._stale_key())
+
+        if page is not None:
+            metrics.incr("loadshed:stale")
+            resp = Response(page.replace(STALE_MARKER, STALE_NOTICE),
+                            mimetype='text/html')
+            resp.headers['Warning'] = '110 - "Response is Stale"'
+            return resp
+
+        return Response("Warbler is busy, please try again shortly.\n", 503,
+                        {'Retry-After': str(self.breaker.reset_seconds)},
+                        mimetype='text/plain')
+
+    def health(self):
+        """Breaker state and connection pool usage, for load balancers."""
+
+        pool = db.engine.pool
+        status = dict(breaker=self.breaker.state)
+
+        if hasattr(pool, 'checkedout'):
+            status.update(pool_size=pool.size(),
+                          checked_out=pool.checkedout(),
+                          overflow=pool.overflow(),
+                          max_overflow=pool._max_overflow)
+            metrics.set_gauge("db_pool_checked_out", status['checked_out'])
+            saturated = (status['max_overflow'] >= 0 and
+                         status['checked_out'] >=
+                         status['pool_size'] + status['max_overflow'])
+        else:
+            saturated = False
+
+        status['saturated'] = saturated
+        healthy = not saturated and self.breaker.state == CircuitBreaker.CLOSED
+
+        return jsonify(status), 200 if healthy else 503
+
+    def _keeps_stale(self, response):
+        return (request.method == 'GET' and response.status_code == 200 and
+                request.endpoint in current_app.config['STALE_ROUTES'] and
+                response.mimetype == 'text/html')
+
+    def _guard_stream(self, chunks, stale_key, endpoint, app):
+        """Pass a streamed body through, settling with the breaker at the end.
+
+        Runs outside the request context. A database error cuts the page
+        short with STREAM_ERROR; a complete page is kept as the stale
+        copy if `stale_key` is given.
+        """
+
+        parts = []
+        try:
+            for chunk in chunks:
+                if stale_key is not None:
+                    parts.append(chunk.decode() if isinstance(chunk, bytes)
+                                 else chunk)
+                yield chunk
+
+        except DATABASE_ERRORS as error:
+            # the request context has been torn down by now, which rolled
+            # back its session; only the breaker is left to tell
+            self.breaker.record_failure()
+            metrics.incr("loadshed:stream_error")
+            app.logger.warning("Database error streaming %s: %s",
+                               endpoint, error)
+            yield STREAM_ERROR
+            return
+
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+        self.breaker.record_success()
+        if stale_key is not None:
+            self.stale.set(stale_key, ''.join(parts))
+
+    def _stale_key(self):
+        return f"{session.get(self.session_key)}:{request.path}"
+
+
+shedder = LoadShedder()
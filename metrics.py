@@ -0,0 +1,83 @@
+"""In-process metrics for Warbler.
+
+A deliberately small registry of timers, counters and gauges, kept per
+process. Timers record count/total/max in milliseconds, so e.g. the
+`sql:homepage` and `template:home.html` timers can be compared directly.
+"""
+
+import threading
+
+
+class Timer:
+    """Running totals for one timed operation."""
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    @property
+    def mean_ms(self):
+        return self.total_ms / self.count if self.count else 0.0
+
+
+class Metrics:
+    """Registry of named timers, counters and gauges."""
+
+    def __init__(self):
+        self._timers = {}
+        self._counters = {}
+        self._gauges = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, elapsed_ms):
+        """Record one timing for `name`."""
+
+        with self._lock:
+            timer = self._timers.get(name)
+            if timer is None:
+                timer = self._timers[name] = Timer(name)
+
+            timer.count += 1
+            timer.total_ms += elapsed_ms
+            timer.max_ms = max(timer.max_ms, elapsed_ms)
+
+    def incr(self, name, amount=1):
+        """Increase counter `name` by `amount`."""
+
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def set_gauge(self, name, value):
+        """Set gauge `name` to `value`."""
+
+        with self._lock:
+            self._gauges[name] = value
+
+    def timers(self):
+        """Return timers, most total time first."""
+
+        with self._lock:
+            timers = list(self._timers.values())
+
+        return sorted(timers, key=lambda t: t.total_ms, reverse=True)
+
+    def counters(self):
+        with self._lock:
+            return dict(self._counters)
+
+    def gauges(self):
+        with self._lock:
+            return dict(self._gauges)
+
+    def reset(self):
+        """Forget everything recorded so far."""
+
+        with self._lock:
+            self._timers.clear()
+            self._counters.clear()
+            self._gauges.clear()
+
+
+metrics = Metrics()
@@ -1,9 +1,13 @@
 """SQLAlchemy models for Warbler."""
 
+import re
 from datetime import datetime
 
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.postgresql import JSONB, insert
+
+from cache import cache
 
 bcrypt = Bcrypt()
 db = SQLAlchemy()
@@ -26,29 +30,237 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # The primary key serves "who follows X"; this serves "who does X follow".
+    __table_args__ = (
+        db.Index('ix_follows_following_followed',
+                 'user_following_id', 'user_being_followed_id'),
+    )
+
+    @classmethod
+    def exists(cls, follower_id, followed_id):
+        """Does `follower_id` follow `followed_id`? One primary key probe."""
+
+        query = cls.query.filter_by(user_following_id=follower_id,
+                                    user_being_followed_id=followed_id)
+        return db.session.query(query.exists()).scalar()
+
 
 class Likes(db.Model):
-    """Mapping user likes to warbles."""
+    """Mapping user likes to warbles.
+
+    The primary key (user_id, message_id) is the only uniqueness index
+    the table needs; (user_id, created_at, message_id) serves a user's
+    liked messages newest first.
+    """
 
-    __tablename__ = 'likes' 
+    __tablename__ = 'likes'
 
-    id = db.Column(
+    user_id = db.Column(
         db.Integer,
-        primary_key=True
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.BigInteger,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    # Set by the database (in UTC, like the other timestamps), so likes
+    # written in bulk by the write-behind buffer get one too.
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        server_default=db.text("(now() AT TIME ZONE 'utc')"),
+    )
+
+    __table_args__ = (
+        db.Index('ix_likes_user_id_created_at', 'user_id',
+                 created_at.desc(), message_id.desc()),
     )
 
+    @classmethod
+    def exists(cls, user_id, message_id):
+        """Has `user_id` liked `message_id`? One unique index probe."""
+
+        query = cls.query.filter_by(user_id=user_id, message_id=message_id)
+        return db.session.query(query.exists()).scalar()
+
+
+class MessageTag(db.Model):
+    """A #tag used in a message.
+
+    The primary key (tag, message_id) is the index for "newest messages
+    with this tag".
+    """
+
+    __tablename__ = 'message_tags'
+
+    tag = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.BigInteger,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+
+class Mention(db.Model):
+    """An @mention of a user in a message.
+
+    The primary key (user_id, message_id) is the index for "newest
+    messages mentioning this user".
+    """
+
+    __tablename__ = 'mentions'
+
     user_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id', ondelete='cascade')
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
     )
 
     message_id = db.Column(
-        db.Integer,
+        db.BigInteger,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        # unique=True
+        primary_key=True,
+    )
+
+
+class MessageStats(db.Model):
+    """View counts of a message, written in batches by viewcounts.py."""
+
+    __tablename__ = 'message_stats'
+
+    message_id = db.Column(
+        db.BigInteger,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    views = db.Column(
+        db.BigInteger,
+        nullable=False,
+        default=0,
+    )
+
+    # HyperLogLog registers of who viewed it, when unique viewers are
+    # counted (VIEW_UNIQUES)
+    viewers = db.Column(
+        db.LargeBinary,
+    )
+
+
+class FollowSuggestion(db.Model):
+    """Precomputed "who to follow" suggestion for a user.
+
+    Rows are rebuilt in batch by `flask warbler recommend`; see
+    recommendations.py.
+    """
+
+    __tablename__ = 'follow_suggestions'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    rank = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    suggested_user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    suggested_user = db.relationship('User', foreign_keys=[suggested_user_id])
+
+
+class Job(db.Model):
+    """A unit of background work, queued in the database; see jobs.py."""
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    name = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    args = db.Column(
+        JSONB,
+        nullable=False,
+        default=dict,
+    )
+
+    # At most one job is ever queued per key.
+    idempotency_key = db.Column(
+        db.Text,
+        unique=True,
+    )
+
+    # queued, running, done or failed
+    status = db.Column(
+        db.Text,
+        nullable=False,
+        default='queued',
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    max_attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=5,
+    )
+
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    locked_at = db.Column(
+        db.DateTime,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    # Workers look for due jobs by status, oldest first, and prune done
+    # jobs by when they finished.
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+        db.Index('ix_jobs_done_finished_at', 'finished_at',
+                 postgresql_where=db.text("status = 'done'")),
     )
 
-    __table_args__ = (db.UniqueConstraint('user_id', 'message_id', name='_user_message_uc'),)
 
 class User(db.Model):
     """User in the system."""
@@ -95,7 +307,21 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message')
+    is_admin = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+    )
+
+    # Set when the account is deleted; the rows it owns are removed
+    # later, in batches, by `User.purge`.
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
+    # Messages, likes and follows are removed by the database's
+    # ON DELETE CASCADE rather than loaded and deleted one by one.
+    messages = db.relationship('Message', passive_deletes=True)
 
     followers = db.relationship(
         "User",
@@ -123,18 +349,347 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.exists(other_user.id, self.id)
 
     def is_following(self, other_user):
-        """Is this user following `other_use`?"""
+        """Is this user following `other_user`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.exists(self.id, other_user.id)
     
-    def liked_messages(self):
-        """Returns a list of messages liked by the user."""
-        return Message.query.join(Likes).filter(Likes.user_id == self.id).all()
+    def add_like(self, message):
+        """Like `message`, bumping its like_count in the same transaction.
+
+        Returns False if this user already likes it. The like is inserted
+        with ON CONFLICT DO NOTHING, so of two concurrent likes only the
+        one whose row was inserted bumps the count.
+        """
+
+        inserted = db.session.execute(
+            insert(Likes.__table__)
+            .values(user_id=self.id, message_id=message.id)
+            .on_conflict_do_nothing()
+            .returning(Likes.__table__.c.message_id)).first()
+        if inserted is None:
+            return False
+
+        (Message
+         .query
+         .filter_by(id=message.id)
+         .update({Message.like_count: Message.like_count + 1},
+                 synchronize_session=False))
+
+        db.session.expire(message, ['like_count', 'liked_by'])
+        db.session.expire(self, ['likes'])
+        return True
+
+    def remove_like(self, message):
+        """Unlike `message`, dropping its like_count in the same transaction.
+
+        Returns False if this user didn't like it.
+        """
+
+        deleted = (Likes
+                   .query
+                   .filter_by(user_id=self.id, message_id=message.id)
+                   .delete(synchronize_session=False))
+        if not deleted:
+            return False
+
+        (Message
+         .query
+         .filter_by(id=message.id)
+         .update({Message.like_count: Message.like_count - 1},
+                 synchronize_session=False))
+
+        db.session.expire(message, ['like_count', 'liked_by'])
+        db.session.expire(self, ['likes'])
+        return True
+
+    def follow_many(self, user_ids=(), usernames=()):
+        """Follow every active user listed by id or username.
+
+        The users are looked up in one query and the follows added with
+        one multi-row INSERT ... ON CONFLICT DO NOTHING, so pairs that
+        already exist are skipped. Returns (found, added): {id: username}
+        of the users matched, and the ids newly followed. The caller
+        commits.
+        """
+
+        found = dict(db.session
+                     .query(User.id, User.username)
+                     .filter(db.or_(User.id.in_(list(user_ids)),
+                                    User.username.in_(list(usernames))),
+                             User.deleted_at.is_(None),
+                             User.id != self.id))
+        if not found:
+            return found, []
+
+        stmt = (insert(Follows.__table__)
+                .values([dict(user_following_id=self.id,
+                              user_being_followed_id=user_id)
+                         for user_id in found])
+                .on_conflict_do_nothing()
+                .returning(Follows.__table__.c.user_being_followed_id))
+        added = [user_id for (user_id,) in db.session.execute(stmt)]
+
+        if added:
+            # no need to suggest people who are now followed
+            (FollowSuggestion
+             .query
+             .filter(FollowSuggestion.user_id == self.id,
+                     FollowSuggestion.suggested_user_id.in_(added))
+             .delete(synchronize_session=False))
+            db.session.expire(self, ['following'])
+
+        return found, added
+
+    def following_ids(self):
+        """Returns the ids of the (not deleted) users this user follows."""
+
+        rows = (db.session
+                .query(Follows.user_being_followed_id)
+                .join(User, User.id == Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == self.id,
+                        User.deleted_at.is_(None))
+                .all())
+        return [user_id for (user_id,) in rows]
+
+    def follow_state(self, users):
+        """Returns the follow relationships between this user and `users`.
+
+        Gives a pair of sets of user ids: those this user follows, and
+        those that follow this user. Uses one query for the whole list,
+        so pages of users don't need an `is_following` call per row.
+        """
+
+        user_ids = [user.id for user in users]
+        if not user_ids:
+            return set(), set()
+
+        rows = (db.session
+                .query(Follows.user_following_id,
+                       Follows.user_being_followed_id)
+                .filter(db.or_(
+                    db.and_(Follows.user_following_id == self.id,
+                            Follows.user_being_followed_id.in_(user_ids)),
+                    db.and_(Follows.user_being_followed_id == self.id,
+                            Follows.user_following_id.in_(user_ids))))
+                .all())
+
+        following = {followed for follower, followed in rows
+                     if follower == self.id}
+        followed_by = {follower for follower, followed in rows
+                       if followed == self.id}
+        return following, followed_by
+
+    def followers_page(self, viewer, after=None, limit=30):
+        """Returns a page of this user's followers; see `_follow_page`."""
+
+        return self._follow_page(viewer, Follows.user_being_followed_id,
+                                 Follows.user_following_id, after, limit)
+
+    def following_page(self, viewer, after=None, limit=30):
+        """Returns a page of users this user follows; see `_follow_page`."""
+
+        return self._follow_page(viewer, Follows.user_following_id,
+                                 Follows.user_being_followed_id, after, limit)
+
+    def _follow_page(self, viewer, own_column, other_column, after, limit):
+        """Returns one page of this user's follow list, in user id order.
+
+        Gives (rows, next_cursor): each row is (user, viewer_follows,
+        follows_viewer), and next_cursor is the `after` value for the
+        following page, or None on the last page. The page and the
+        viewer's follow state come back in a single query that walks
+        the follows index from the cursor.
+        """
+
+        edge = db.aliased(Follows)
+        viewer_follows = db.exists().where(db.and_(
+            Follows.user_following_id == viewer.id,
+            Follows.user_being_followed_id == User.id))
+        follows_viewer = db.exists().where(db.and_(
+            Follows.user_following_id == User.id,
+            Follows.user_being_followed_id == viewer.id))
+
+        own = getattr(edge, own_column.key)
+        other = getattr(edge, other_column.key)
+
+        query = (db.session
+                 .query(User, viewer_follows.label('viewer_follows'),
+                        follows_viewer.label('follows_viewer'))
+                 .join(edge, other == User.id)
+                 .filter(own == self.id, User.deleted_at.is_(None)))
+
+        if after is not None:
+            query = query.filter(other > after)
+
+        rows = query.order_by(other).limit(limit + 1).all()
+
+        if len(rows) > limit:
+            rows = rows[:limit]
+            return rows, rows[-1][0].id
+
+        return rows, None
+
+    def stats(self):
+        """Returns counts of this user's messages, follows and likes.
+
+        Counted in the database with one query, without loading any of
+        the underlying lists. Follows of deleted users, and likes of
+        their messages, aren't counted.
+        """
+
+        def count(column, value, other_user=None):
+            query = db.select([db.func.count()]).where(column == value)
+            if other_user is not None:
+                query = query.where(db.exists().where(db.and_(
+                    User.id == other_user, User.deleted_at.is_(None))))
+            return query.as_scalar()
+
+        liked_author = (db.select([Message.user_id])
+                        .where(Message.id == Likes.message_id)
+                        .as_scalar())
+
+        messages, following, followers, likes = db.session.query(
+            count(Message.user_id, self.id),
+            count(Follows.user_following_id, self.id,
+                  Follows.user_being_followed_id),
+            count(Follows.user_being_followed_id, self.id,
+                  Follows.user_following_id),
+            count(Likes.user_id, self.id, liked_author),
+        ).one()
+
+        return dict(messages=messages, following=following,
+                    followers=followers, likes=likes)
+
+    def liked_page(self, before=None, limit=50):
+        """Returns one page of messages this user liked, newest like first.
+
+        Gives (rows, next_cursor): each row is (message, liked_at), with
+        the message's author loaded, and next_cursor is the `before`
+        value for the following page, a (liked_at, message_id) pair, or
+        None on the last page. The page is an index scan down
+        ix_likes_user_id_created_at from the cursor.
+        """
+
+        query = (db.session
+                 .query(Message, Likes.created_at)
+                 .join(Likes, Likes.message_id == Message.id)
+                 .join(User, User.id == Message.user_id)
+                 .options(db.contains_eager(Message.user))
+                 .filter(Likes.user_id == self.id,
+                         User.deleted_at.is_(None)))
+
+        if before is not None:
+            query = query.filter(
+                db.tuple_(Likes.created_at, Likes.message_id) < before)
+
+        rows = (query
+                .order_by(Likes.created_at.desc(), Likes.message_id.desc())
+                .limit(limit + 1)
+                .all())
+
+        if len(rows) > limit:
+            rows = rows[:limit]
+            message, liked_at = rows[-1]
+            return rows, (liked_at, message.id)
+
+        return rows, None
+
+    def follow_suggestions(self):
+        """Returns the precomputed users this user might want to follow.
+
+        Users followed since the suggestions were computed are left out.
+        """
+
+        followed = (Follows
+                    .query
+                    .filter(Follows.user_following_id == self.id,
+                            Follows.user_being_followed_id == User.id)
+                    .exists())
+
+        return (User
+                .query
+                .join(FollowSuggestion,
+                      FollowSuggestion.suggested_user_id == User.id)
+                .filter(FollowSuggestion.user_id == self.id,
+                        User.deleted_at.is_(None),
+                        ~followed)
+                .order_by(FollowSuggestion.rank)
+                .all())
+
+    def soft_delete(self):
+        """Mark this account deleted.
+
+        It disappears from the site at once; `purge` removes its rows.
+        """
+
+        self.deleted_at = datetime.utcnow()
+        cache.delete(f"user_card:{self.id}")
+
+    @classmethod
+    def active(cls):
+        """Query for users whose accounts haven't been deleted."""
+
+        return cls.query.filter(cls.deleted_at.is_(None))
+
+    @classmethod
+    def purge(cls, user_id, batch_size=1000):
+        """Remove a deleted account and everything it owns, in batches.
+
+        Likes (undoing their like_count), follows in both directions,
+        mentions and messages are each deleted `batch_size` rows at a
+        time, committing after every batch so no statement holds locks
+        on a large share of a table. The user row goes last, and the
+        database cascades whatever is left.
+        """
+
+        while True:
+            message_ids = [message_id for (message_id,) in (db.session
+                           .query(Likes.message_id)
+                           .filter(Likes.user_id == user_id)
+                           .limit(batch_size))]
+            if not message_ids:
+                break
+
+            (Likes
+             .query
+             .filter(Likes.user_id == user_id,
+                     Likes.message_id.in_(message_ids))
+             .delete(synchronize_session=False))
+            (Message
+             .query
+             .filter(Message.id.in_(message_ids))
+             .update({Message.like_count: Message.like_count - 1},
+                     synchronize_session=False))
+            db.session.commit()
+
+        follow_keys = (Follows.user_following_id,
+                       Follows.user_being_followed_id)
+        for column in follow_keys:
+            _delete_in_batches(follow_keys, column == user_id, batch_size)
+
+        _delete_in_batches((Mention.user_id, Mention.message_id),
+                           Mention.user_id == user_id, batch_size)
+        _delete_in_batches((Message.id,), Message.user_id == user_id,
+                           batch_size)
+
+        cls.query.filter_by(id=user_id).delete(synchronize_session=False)
+        db.session.commit()
+
+    @classmethod
+    def purge_deleted(cls, batch_size=1000):
+        """Purge every deleted account. Returns how many there were."""
+
+        user_ids = [user_id for (user_id,) in (db.session
+                    .query(cls.id)
+                    .filter(cls.deleted_at.isnot(None)))]
+
+        for user_id in user_ids:
+            cls.purge(user_id, batch_size)
+
+        return len(user_ids)
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -166,7 +721,7 @@ class User(db.Model):
         If can't find matching user (or if password is wrong), returns False.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.active().filter_by(username=username).first()
 
         if user:
             is_auth = bcrypt.check_password_hash(user.password, password)
@@ -181,8 +736,10 @@ class Message(db.Model):
 
     __tablename__ = 'messages'
 
+    # A serial, or a time-ordered snowflake id (see snowflake.py); either
+    # way newer messages have larger ids, so feeds order by id.
     id = db.Column(
-        db.Integer,
+        db.BigInteger,
         primary_key=True,
     )
 
@@ -194,7 +751,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -203,8 +760,23 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # Kept in step with the likes table by User.add_like/remove_like;
+    # `flask warbler recount-likes` repairs any drift.
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     user = db.relationship('User')
 
+    # Serves per-author timelines and "newest id per author" lookups
+    # straight from the index.
+    __table_args__ = (
+        db.Index('ix_messages_user_id_id', 'user_id', 'id'),
+    )
+
     liked_by = db.relationship(
         'User',
         secondary='likes',
@@ -213,7 +785,146 @@ class Message(db.Model):
 
     def is_liked_by(self, user):
         """Check if the message is liked by a user."""
-        return user in self.liked_by
+        return Likes.exists(user.id, self.id)
+
+    @classmethod
+    def visible(cls):
+        """Query for messages whose authors' accounts haven't been deleted."""
+
+        return (cls.query
+                .join(User, User.id == cls.user_id)
+                .filter(User.deleted_at.is_(None)))
+
+    TAG_PATTERN = re.compile(r"(?<![\w#])#(\w{1,50})")
+    MENTION_PATTERN = re.compile(r"(?<![\w@])@(\w+)")
+
+    @classmethod
+    def index_text(cls, messages):
+        """Write the message_tags and mentions rows for `messages`.
+
+        Mentions of unknown usernames are ignored. Rows that already
+        exist are skipped, so this is safe to re-run. Doesn't commit.
+        """
+
+        tag_rows = [dict(tag=tag.lower(), message_id=msg.id)
+                    for msg in messages
+                    for tag in set(cls.TAG_PATTERN.findall(msg.text))]
+
+        usernames = {username
+                     for msg in messages
+                     for username in cls.MENTION_PATTERN.findall(msg.text)}
+        user_ids = {}
+        if usernames:
+            user_ids = dict(db.session
+                            .query(User.username, User.id)
+                            .filter(User.username.in_(usernames)))
+
+        mention_rows = [dict(user_id=user_ids[username], message_id=msg.id)
+                        for msg in messages
+                        for username in set(cls.MENTION_PATTERN.findall(msg.text))
+                        if username in user_ids]
+
+        if tag_rows:
+            db.session.execute(insert(MessageTag.__table__)
+                               .values(tag_rows)
+                               .on_conflict_do_nothing())
+        if mention_rows:
+            db.session.execute(insert(Mention.__table__)
+                               .values(mention_rows)
+                               .on_conflict_do_nothing())
+
+    @classmethod
+    def backfill_text_index(cls, chunk_size=1000):
+        """Run index_text over every existing message, a chunk at a time.
+
+        Walks the messages in id order, committing after each chunk.
+        Returns the number of messages processed.
+        """
+
+        processed = 0
+        last_id = 0
+
+        while True:
+            chunk = (cls
+                     .query
+                     .filter(cls.id > last_id)
+                     .order_by(cls.id)
+                     .limit(chunk_size)
+                     .all())
+            if not chunk:
+                return processed
+
+            processed += len(chunk)
+            last_id = chunk[-1].id
+
+            cls.index_text(chunk)
+            db.session.commit()
+
+    @classmethod
+    def recount_likes(cls, batch_size=10000):
+        """Recompute like_count for every message from the likes table.
+
+        Works through the messages `batch_size` at a time, in id order,
+        committing after each batch, so no single transaction locks the
+        whole table. Batches are found by walking the ids that exist,
+        since snowflake ids leave huge gaps. Returns the number of
+        messages that were corrected.
+        """
+
+        actual = (db.select([db.func.count()])
+                  .where(Likes.message_id == cls.id)
+                  .as_scalar())
+
+        corrected = 0
+        last_id = None
+        while True:
+            ids = db.session.query(cls.id).order_by(cls.id)
+            if last_id is not None:
+                ids = ids.filter(cls.id > last_id)
+            ids = [message_id for (message_id,) in ids.limit(batch_size)]
+            if not ids:
+                break
+
+            corrected += (cls
+                          .query
+                          .filter(cls.id >= ids[0],
+                                  cls.id <= ids[-1],
+                                  cls.like_count != actual)
+                          .update({cls.like_count: actual},
+                                  synchronize_session=False))
+            db.session.commit()
+            last_id = ids[-1]
+
+        return corrected
+
+
+def _delete_in_batches(keys, condition, batch_size):
+    """Delete rows matching `condition`, `batch_size` at a time.
+
+    `keys` are the primary key columns of the table; each batch is
+    looked up by `condition` and then deleted by key.
+    """
+
+    while True:
+        rows = (db.session
+                .query(*keys)
+                .filter(condition)
+                .limit(batch_size)
+                .all())
+        if not rows:
+            return
+
+        if len(keys) == 1:
+            match = keys[0].in_([key for (key,) in rows])
+        else:
+            match = db.tuple_(*keys).in_(rows)
+
+        (db.session
+         .query(keys[0].class_)
+         .filter(match)
+         .delete(synchronize_session=False))
+        db.session.commit()
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -223,3 +934,4 @@ def connect_db(app):
 
     db.app = app
     db.init_app(app)
+
@@ -0,0 +1,256 @@
+"""Monthly range partitioning of the messages table.
+
+Partitioning is optional, and needs SNOWFLAKE_IDS: messages are
+partitioned by RANGE (id), and since a snowflake id starts with its
+creation time (see snowflake.py), each month is a range of ids,
+[min_id_at(first of the month), min_id_at(first of the next month)).
+Keeping `id` as the partition key keeps it the primary key, so the
+likes, message_tags and mentions foreign keys still point at it.
+
+    flask warbler partition-messages   # once; converts the table
+    flask warbler create-partitions    # monthly, from cron
+    flask warbler archive-messages     # monthly, from cron
+
+`partition_messages` converts an existing table in place: the old table
+becomes partition messages_legacy, holding every id below the first
+month's range (all serial ids, and any snowflake ids up to the end of
+the current month). Inserts fail once they run past the last partition,
+so `create_partitions` keeps a few months ahead; besides the cron job,
+job workers run it every hour (see create_partitions_task in app.py).
+
+Feeds read through `recent_first`, which asks for recent ids first, so
+Postgres prunes every older partition unless the recent ones can't
+fill the page.
+
+`archive_partitions` moves partitions whose month is long past into
+ARCHIVE_TABLESPACE (meant to be on compressed storage) or, without one,
+just rewrites them compactly, then freezes them so vacuum can leave
+them alone. They stay attached, so profile history still reads them.
+"""
+
+import re
+from datetime import datetime
+
+from sqlalchemy import text
+from sqlalchemy.schema import CreateIndex
+
+from models import db, Message
+from snowflake import min_id_at
+
+
+PARENT = 'messages'
+LEGACY = 'messages_legacy'
+
+BOUND_PATTERN = re.compile(r"FROM \('?(\w+)'?\) TO \('?(\w+)'?\)")
+
+
+def month_start(when, months=0):
+    """The first of the month `months` after the month of `when`."""
+
+    month = when.year * 12 + when.month - 1 + months
+    return datetime(month // 12, month % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f"{PARENT}_{month:%Y_%m}"
+
+
+def is_partitioned():
+    """Is the messages table partitioned?"""
+
+    kind = db.session.execute(
+        text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:name)"),
+        {'name': PARENT}).scalar()
+    return kind == 'p'
+
+
+def partitions():
+    """Returns [(name, low id, high id, tablespace, archived)] by id range.
+
+    The low id of messages_legacy is None (MINVALUE).
+    """
+
+    rows = db.session.execute(text("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid),
+               t.spcname, obj_description(c.oid, 'pg_class')
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        LEFT JOIN pg_tablespace t ON t.oid = c.reltablespace
+        WHERE i.inhparent = to_regclass(:name)
+    """), {'name': PARENT})
+
+    result = []
+    for name, bound, tablespace, comment in rows:
+        low, high = BOUND_PATTERN.search(bound).groups()
+        low = None if low == 'MINVALUE' else int(low)
+        result.append((name, low, int(high), tablespace,
+                       (comment or '').startswith('archived')))
+
+    return sorted(result, key=lambda part: part[2])
+
+
+def partition_messages(months_ahead=3, now=None):
+    """Convert the messages table into a partitioned table, in place.
+
+    Runs in one transaction, holding an exclusive lock on messages
+    throughout; attaching the old table and re-pointing the foreign
+    keys each scan a table, so allow for that. The caller commits.
+    """
+
+    now = now or datetime.utcnow()
+    execute = db.session.execute
+
+    execute(text(f"LOCK TABLE {PARENT} IN ACCESS EXCLUSIVE MODE"))
+
+    # Ids from here on get monthly partitions; anything already stored
+    # stays in the legacy partition.
+    newest = execute(text(f"SELECT max(id) FROM {PARENT}")).scalar() or 0
+    first_month = month_start(now)
+    while min_id_at(first_month) <= newest:
+        first_month = month_start(first_month, 1)
+
+    execute(text(f"ALTER TABLE {PARENT} RENAME TO {LEGACY}"))
+    for (index,) in execute(text(
+            "SELECT indexrelid::regclass::text FROM pg_index "
+            "WHERE indrelid = to_regclass(:name)"), {'name': LEGACY}).fetchall():
+        execute(text(f"ALTER INDEX {index} RENAME TO "
+                     f"{index.replace(PARENT, LEGACY, 1)}"))
+
+    execute(text(f"""
+        CREATE TABLE {PARENT} (LIKE {LEGACY} INCLUDING DEFAULTS
+                               INCLUDING CONSTRAINTS INCLUDING STORAGE)
+        PARTITION BY RANGE (id)
+    """))
+    execute(text(f"ALTER TABLE {PARENT} ADD PRIMARY KEY (id)"))
+    for index in Message.__table__.indexes:
+        execute(CreateIndex(index))
+
+    # foreign keys from messages, then to messages
+    outgoing = execute(text(
+        "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE conrelid = to_regclass(:name) AND contype = 'f'"),
+        {'name': LEGACY}).fetchall()
+    for name, definition in outgoing:
+        execute(text(f"ALTER TABLE {PARENT} ADD CONSTRAINT {name} "
+                     f"{definition}"))
+
+    execute(text(f"""
+        ALTER TABLE {PARENT} ATTACH PARTITION {LEGACY}
+        FOR VALUES FROM (MINVALUE) TO ({min_id_at(first_month)})
+    """))
+
+    incoming = execute(text(
+        "SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid) "
+        "FROM pg_constraint "
+        "WHERE confrelid = to_regclass(:name) AND contype = 'f' "
+        "AND conrelid <> to_regclass(:parent)"),
+        {'name': LEGACY, 'parent': PARENT}).fetchall()
+    for table, name, definition in incoming:
+        definition = re.sub(rf"REFERENCES {LEGACY}\b",
+                            f"REFERENCES {PARENT}", definition)
+        execute(text(f"ALTER TABLE {table} DROP CONSTRAINT {name}"))
+        execute(text(f"ALTER TABLE {table} ADD CONSTRAINT {name} "
+                     f"{definition}"))
+
+    execute(text(f"ALTER SEQUENCE IF EXISTS {PARENT}_id_seq "
+                 f"OWNED BY {PARENT}.id"))
+
+    create_partitions(months_ahead, now)
+
+
+def create_partitions(months_ahead=3, now=None):
+    """Make sure there are partitions up to `months_ahead` months from now.
+
+    Returns the names of the partitions created. Concurrent calls take
+    turns, on a transaction-level advisory lock. The caller commits.
+    """
+
+    now = now or datetime.utcnow()
+    db.session.execute(text("SELECT pg_advisory_xact_lock(hashtext(:name))"),
+                       {'name': 'create_partitions'})
+    existing = partitions()
+    covered = max(high for name, low, high, tablespace, archived in existing)
+
+    created = []
+    for months in range(months_ahead + 1):
+        month = month_start(now, months)
+        low, high = min_id_at(month), min_id_at(month_start(month, 1))
+        if high <= covered:
+            continue
+
+        name = partition_name(month)
+        db.session.execute(text(f"""
+            CREATE TABLE {name} PARTITION OF {PARENT}
+            FOR VALUES FROM ({max(low, covered)}) TO ({high})
+        """))
+        covered = high
+        created.append(name)
+
+    return created
+
+
+def archive_partitions(older_than_months=12, tablespace=None, now=None):
+    """Compact and freeze partitions older than `older_than_months` months.
+
+    Each is moved, with its indexes, to `tablespace` if one is given, or
+    else rewritten in place by VACUUM FULL; then frozen, analyzed, and
+    marked archived so later runs skip it. Each partition is locked
+    while it is rewritten. Commits the session first, since the rewrites
+    run on a connection of their own. Returns the names of the
+    partitions archived.
+    """
+
+    cutoff = min_id_at(month_start(now or datetime.utcnow(),
+                                   -older_than_months))
+    cold = [name for name, low, high, space, archived in partitions()
+            if high <= cutoff and not archived]
+
+    # release the session's locks, or the rewrites below would wait on them
+    db.session.commit()
+
+    # VACUUM can't run inside a transaction
+    with db.engine.connect() as conn:
+        conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+
+        for name in cold:
+            if tablespace:
+                conn.execute(f"ALTER TABLE {name} SET TABLESPACE {tablespace}")
+                indexes = conn.execute(text(
+                    "SELECT indexrelid::regclass::text FROM pg_index "
+                    "WHERE indrelid = to_regclass(:name)"), name=name)
+                for (index,) in indexes.fetchall():
+                    conn.execute(f"ALTER INDEX {index} "
+                                 f"SET TABLESPACE {tablespace}")
+            else:
+                conn.execute(f"VACUUM FULL {name}")
+
+            conn.execute(f"VACUUM (FREEZE, ANALYZE) {name}")
+            conn.execute(f"COMMENT ON TABLE {name} IS "
+                         f"'archived {datetime.utcnow():%Y-%m-%d}'")
+
+    return cold
+
+
+def recent_first(query, limit, window):
+    """Yield the newest `limit` messages of `query`, newest first.
+
+    Reads the messages from the last `window` (a timedelta) first, which
+    only touches the newest partitions, and only goes further back if
+    that doesn't fill `limit`. Needs snowflake ids.
+    """
+
+    cutoff = min_id_at(datetime.utcnow() - window)
+    found = 0
+
+    for message in (query
+                    .filter(Message.id >= cutoff)
+                    .order_by(Message.id.desc())
+                    .limit(limit)):
+        found += 1
+        yield message
+
+    if found < limit:
+        yield from (query
+                    .filter(Message.id < cutoff)
+                    .order_by(Message.id.desc())
+                    .limit(limit - found))
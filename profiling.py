@@ -0,0 +1,105 @@
+"""On-demand request profiling for Warbler.
+
+A request is profiled when an admin sends the profiling header, or when
+it is picked by random sampling (PROFILE_SAMPLE_RATE). Only the view
+function is profiled -- that is the handler plus any template rendering
+it does -- since `g.user` has to be loaded before we know whether the
+header is allowed. For a streamed response, the profile also covers
+producing each chunk of the body (but not waiting on the client), and
+is written once the body is done.
+
+Profiles are written in cProfile's format to PROFILE_DIR, named after
+the endpoint and user, e.g. `homepage-user12-1697040000123-4242.prof`.
+They can be turned into flame graphs with tools such as `flameprof` or
+`snakeviz`.
+"""
+
+import cProfile
+import os
+import random
+import time
+
+from flask import Response, g, request
+
+
+class RequestProfiler:
+    """Wraps view dispatch in cProfile for selected requests."""
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PROFILE_DIR', 'profiles')
+        app.config.setdefault('PROFILE_SAMPLE_RATE', 0.0)
+        app.config.setdefault('PROFILE_HEADER', 'X-Warbler-Profile')
+
+        self.app = app
+        dispatch_request = app.dispatch_request
+
+        def profiled_dispatch_request():
+            if not self.should_profile():
+                return dispatch_request()
+
+            profile = cProfile.Profile()
+            path = self.profile_path()
+            try:
+                rv = profile.runcall(dispatch_request)
+            except BaseException:
+                self.save(profile, path)
+                raise
+
+            if isinstance(rv, Response) and rv.is_streamed:
+                rv.response = self._profile_stream(profile, rv.response, path)
+            else:
+                self.save(profile, path)
+            return rv
+
+        app.dispatch_request = profiled_dispatch_request
+
+    def should_profile(self):
+        """Should the current request be profiled?"""
+
+        if request.headers.get(self.app.config['PROFILE_HEADER']):
+            user = g.get('user')
+            if user and user.is_admin:
+                return True
+
+        rate = self.app.config['PROFILE_SAMPLE_RATE']
+        return rate > 0 and random.random() < rate
+
+    def profile_path(self):
+        """Where to write the current request's profile."""
+
+        user = g.get('user')
+        user_tag = f"user{user.id}" if user else "anon"
+        filename = "{}-{}-{}-{}.prof".format(
+            request.endpoint or "unknown",
+            user_tag,
+            int(time.time() * 1000),
+            os.getpid(),
+        )
+
+        return os.path.join(self.app.config['PROFILE_DIR'], filename)
+
+    def save(self, profile, path):
+        """Write `profile` to `path`."""
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        profile.dump_stats(path)
+
+    def _profile_stream(self, profile, chunks, path):
+        """Pass a streamed body through, profiling only its production."""
+
+        chunks = iter(chunks)
+        try:
+            while True:
+                try:
+                    chunk = profile.runcall(next, chunks)
+                except StopIteration:
+                    return
+                yield chunk
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+            self.save(profile, path)
@@ -0,0 +1,110 @@
+"""Publish/subscribe bus for live updates.
+
+`InProcessBroker` delivers events between requests handled by the same
+process. Anything with the same `subscribe`/`unsubscribe`/`publish`
+methods can stand in for it (e.g. a wrapper around Redis or Postgres
+LISTEN/NOTIFY); set PUBSUB_BROKER to "module:Class" to use one.
+
+Each subscription buffers at most `maxsize` events. A slow client that
+falls further behind loses the oldest events and is told so through
+`overflowed`, so it can reload instead of the server buffering without
+bound.
+
+Waiting uses threading.Condition, which gevent/eventlet monkey-patching
+turns into a cooperative wait; run the app under such a worker (e.g.
+`gunicorn -k gevent`) to hold many idle streams without a thread each.
+Otherwise each stream holds a thread, so stream_home caps how many are
+open at once (STREAM_MAX_CONNECTIONS).
+"""
+
+import importlib
+import threading
+from collections import deque
+
+
+class Subscription:
+    """A bounded buffer of events for one listener."""
+
+    def __init__(self, topics, maxsize):
+        self.topics = frozenset(topics)
+        self._events = deque(maxlen=maxsize)
+        self._overflowed = False
+        self._ready = threading.Condition()
+
+    def put(self, event):
+        with self._ready:
+            if len(self._events) == self._events.maxlen:
+                self._overflowed = True
+            self._events.append(event)
+            self._ready.notify()
+
+    def get(self, timeout=None):
+        """Wait up to `timeout` seconds for events.
+
+        Returns (events, overflowed): all buffered events, oldest first,
+        and whether any were dropped since the last call.
+        """
+
+        with self._ready:
+            if not self._events:
+                self._ready.wait(timeout)
+
+            events = list(self._events)
+            overflowed = self._overflowed
+            self._events.clear()
+            self._overflowed = False
+
+        return events, overflowed
+
+
+class InProcessBroker:
+    """Topic-based pub/sub within one process."""
+
+    def __init__(self, maxsize=100):
+        self.maxsize = maxsize
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, topics):
+        """Return a new Subscription to every topic in `topics`."""
+
+        subscription = Subscription(topics, self.maxsize)
+
+        with self._lock:
+            for topic in subscription.topics:
+                self._subscribers.setdefault(topic, set()).add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for topic in subscription.topics:
+                subscribers = self._subscribers.get(topic)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscribers[topic]
+
+    def publish(self, topic, event):
+        """Send `event` to everyone subscribed to `topic`."""
+
+        with self._lock:
+            subscribers = list(self._subscribers.get(topic, ()))
+
+        for subscription in subscribers:
+            subscription.put(event)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(set().union(*self._subscribers.values()))
+
+
+def make_broker(app):
+    """Create the broker named by PUBSUB_BROKER ("module:Class")."""
+
+    path = app.config.setdefault('PUBSUB_BROKER', 'pubsub:InProcessBroker')
+    module_name, class_name = path.split(':')
+    broker_class = getattr(importlib.import_module(module_name), class_name)
+
+    return broker_class(
+        maxsize=app.config.setdefault('PUBSUB_BUFFER_SIZE', 100))
@@ -0,0 +1,191 @@
+"""Token-bucket rate limiting for Warbler's write endpoints.
+
+Each (endpoint, client) pair gets a bucket holding up to `burst` tokens,
+refilled at `rate` tokens per second; a POST takes one token or is
+turned away with a 429 and a Retry-After header. Clients are identified
+by the logged-in user id from the session cookie, or by IP address when
+logged out (signup, login). The check runs before the current user is
+loaded, so rejected requests never touch the database.
+
+Buckets live in this process by default. Set RATELIMIT_STORAGE_URL to a
+redis:// URL to share them between processes (needs the `redis`
+package).
+"""
+
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Response, current_app, request, session
+
+from metrics import metrics
+
+
+# endpoint: (burst, tokens per second)
+DEFAULT_LIMITS = {
+    'signup': (5, 1 / 60),
+    'login': (10, 1 / 6),
+    'messages_add': (20, 1 / 6),
+    'add_like': (60, 1),
+    'add_follow': (30, 1 / 2),
+    'follow_many': (5, 1 / 60),
+}
+
+
+class MemoryBuckets:
+    """Token buckets in a dict, least recently used first.
+
+    A bucket left alone for `idle_seconds` is full again, so it is
+    dropped rather than kept; memory stays proportional to the number of
+    recently active clients.
+    """
+
+    def __init__(self, idle_seconds=600, maxsize=100000):
+        self.idle_seconds = idle_seconds
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, burst, rate, now=None):
+        """Take a token from `key`'s bucket.
+
+        Returns 0 if one was available, or else the seconds until one
+        will be.
+        """
+
+        now = time.monotonic() if now is None else now
+
+        with self._lock:
+            self._evict(now)
+
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / rate
+
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+
+        return wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def _evict(self, now):
+        while self._buckets:
+            tokens, updated = next(iter(self._buckets.values()))
+            if updated + self.idle_seconds > now:
+                break
+            self._buckets.popitem(last=False)
+
+
+class RedisBuckets:
+    """Token buckets shared through Redis, updated atomically in Lua."""
+
+    SCRIPT = """
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+    local burst = tonumber(ARGV[1])
+    local rate = tonumber(ARGV[2])
+    local now = tonumber(ARGV[3])
+    local tokens = tonumber(bucket[1]) or burst
+    local updated = tonumber(bucket[2]) or now
+    local wait = 0
+
+    tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+    if tokens >= 1 then
+        tokens = tokens - 1
+    else
+        wait = (1 - tokens) / rate
+    end
+
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+    redis.call('EXPIRE', KEYS[1], ARGV[4])
+    return tostring(wait)
+    """
+
+    def __init__(self, url, idle_seconds=600):
+        import redis
+
+        self.idle_seconds = idle_seconds
+        self._redis = redis.Redis.from_url(url)
+        self._take = self._redis.register_script(self.SCRIPT)
+
+    def take(self, key, burst, rate, now=None):
+        now = time.time() if now is None else now
+        wait = self._take(keys=[f"ratelimit:{key}"],
+                          args=[burst, rate, now, self.idle_seconds])
+        return float(wait)
+
+    def clear(self):
+        for key in self._redis.scan_iter("ratelimit:*"):
+            self._redis.delete(key)
+
+
+class RateLimiter:
+    """Per-endpoint token-bucket limits on POST requests."""
+
+    def __init__(self, app=None, session_key='curr_user'):
+        self.session_key = session_key
+        self.limits = dict(DEFAULT_LIMITS)
+        self.buckets = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Set up buckets from app config and check every request.
+
+        Call this before registering the hook that loads the current
+        user, so a rejected request stops before any query.
+        """
+
+        app.config.setdefault('RATELIMIT_ENABLED', True)
+        app.config.setdefault('RATELIMIT_STORAGE_URL', None)
+        self.limits.update(app.config.get('RATELIMIT_LIMITS', {}))
+
+        url = app.config['RATELIMIT_STORAGE_URL']
+        self.buckets = RedisBuckets(url) if url else MemoryBuckets()
+
+        app.before_request(self.check)
+
+    def check(self):
+        """Return a 429 response if this request is over its budget."""
+
+        if request.method != 'POST' or \
+                not current_app.config['RATELIMIT_ENABLED']:
+            return None
+
+        limit = self.limits.get(request.endpoint)
+        if limit is None:
+            return None
+
+        user_id = session.get(self.session_key)
+        client = f"user:{user_id}" if user_id else f"ip:{request.remote_addr}"
+
+        burst, rate = limit
+        wait = self.buckets.take(f"{request.endpoint}:{client}", burst, rate)
+        if not wait:
+            return None
+
+        metrics.incr(f"ratelimit:{request.endpoint}")
+        return Response("Too many requests.\n", 429,
+                        {'Retry-After': str(math.ceil(wait))},
+                        mimetype='text/plain')
+
+    def reset(self):
+        """Refill every bucket."""
+
+        self.buckets.clear()
+
+
+limiter = RateLimiter()
@@ -12,7 +12,9 @@ with open('generator/users.csv') as users:
     db.session.bulk_insert_mappings(User, DictReader(users))
 
 with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+    # in time order, so message ids (which feeds sort by) are too
+    db.session.bulk_insert_mappings(
+        Message, sorted(DictReader(messages), key=lambda m: m['timestamp']))
 
 with open('generator/follows.csv') as follows:
     db.session.bulk_insert_mappings(Follows, DictReader(follows))
@@ -0,0 +1,221 @@
+"""Slow query log for Warbler.
+
+Any SQL statement that takes longer than a configurable threshold is
+recorded under a fingerprint of its normalized text, so that e.g. every
+run of the homepage feed query lands in the same row no matter how many
+ids are in its IN (...) list. A sample of slow SELECTs also get their
+EXPLAIN (ANALYZE, BUFFERS) plan captured.
+
+Every statement, slow or not, is also timed into the `sql` and
+`sql:<endpoint>` metrics timers. Statements that fail aren't timed.
+"""
+
+import hashlib
+import random
+import re
+import threading
+import time
+from datetime import datetime
+
+from flask import has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from metrics import metrics
+
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_BIND_PARAM = re.compile(r"%\([^)]*\)s|%s|\?|:\w+")
+_IN_LIST = re.compile(r"\bin\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.IGNORECASE)
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_sql(statement):
+    """Reduce a SQL statement to its shape.
+
+    Literals and bind parameters become `?` and IN lists collapse to a
+    single placeholder, so statements differing only in their values
+    normalize to the same text.
+    """
+
+    sql = _STRING_LITERAL.sub("?", statement)
+    sql = _BIND_PARAM.sub("?", sql)
+    sql = _NUMBER_LITERAL.sub("?", sql)
+    sql = _IN_LIST.sub("IN (?)", sql)
+    return _WHITESPACE.sub(" ", sql).strip().lower()
+
+
+def fingerprint_sql(statement):
+    """Return a short, stable fingerprint for a SQL statement."""
+
+    return _hash(normalize_sql(statement))
+
+
+def _hash(normalized):
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:12]
+
+
+class SlowQuery:
+    """Aggregated stats for one fingerprint."""
+
+    def __init__(self, fingerprint, normalized):
+        self.fingerprint = fingerprint
+        self.normalized = normalized
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.last_seen = None
+        self.example = None
+        self.plan = None
+        self.plan_captured_at = None
+
+    @property
+    def mean_ms(self):
+        return self.total_ms / self.count if self.count else 0.0
+
+
+class SlowQueryLog:
+    """Rolling top-N table of slow statements, keyed by fingerprint.
+
+    When the table is full, the entry with the least total time is
+    evicted to make room, so the table always holds the statements that
+    have cost the most since the process started.
+    """
+
+    def __init__(self, threshold_ms=200, explain_sample_rate=0.1, top_n=50):
+        self.threshold_ms = threshold_ms
+        self.explain_sample_rate = explain_sample_rate
+        self.top_n = top_n
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Configure from `app` and start listening to every engine."""
+
+        self.threshold_ms = app.config.setdefault(
+            'SLOW_QUERY_THRESHOLD_MS', self.threshold_ms)
+        self.explain_sample_rate = app.config.setdefault(
+            'SLOW_QUERY_EXPLAIN_SAMPLE_RATE', self.explain_sample_rate)
+        self.top_n = app.config.setdefault('SLOW_QUERY_TOP_N', self.top_n)
+
+        if not event.contains(Engine, 'before_cursor_execute',
+                              _before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute',
+                         _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute',
+                         _after_cursor_execute)
+
+    def record(self, statement, elapsed_ms, plan=None):
+        """Record one slow execution of `statement`."""
+
+        normalized = normalize_sql(statement)
+        fingerprint = _hash(normalized)
+
+        with self._lock:
+            entry = self._entries.get(fingerprint)
+
+            if entry is None:
+                if len(self._entries) >= self.top_n:
+                    cheapest = min(self._entries.values(),
+                                   key=lambda e: e.total_ms)
+                    if cheapest.total_ms > elapsed_ms:
+                        return
+                    del self._entries[cheapest.fingerprint]
+
+                entry = SlowQuery(fingerprint, normalized)
+                self._entries[fingerprint] = entry
+
+            entry.count += 1
+            entry.total_ms += elapsed_ms
+            entry.max_ms = max(entry.max_ms, elapsed_ms)
+            entry.last_seen = datetime.utcnow()
+            entry.example = statement
+
+            if plan is not None:
+                entry.plan = plan
+                entry.plan_captured_at = entry.last_seen
+
+    def should_explain(self, statement):
+        """Should we capture a plan for this (slow) statement?"""
+
+        sql = statement.lstrip().upper()
+        return (sql.startswith('SELECT')
+                and 'FOR UPDATE' not in sql
+                and random.random() < self.explain_sample_rate)
+
+    def top(self):
+        """Return entries, most expensive first."""
+
+        with self._lock:
+            entries = list(self._entries.values())
+
+        return sorted(entries, key=lambda e: e.total_ms, reverse=True)
+
+    def reset(self):
+        """Forget everything recorded so far."""
+
+        with self._lock:
+            self._entries.clear()
+
+
+slow_query_log = SlowQueryLog()
+
+
+# The start time is kept on the statement's execution context, so it goes
+# away with the statement whether it succeeds or fails. Statements run
+# without a context (e.g. fetching a sequence value for a default) aren't
+# timed.
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if context is not None:
+        context.query_start_time = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    started = getattr(context, 'query_start_time', None)
+    if started is None:
+        return
+
+    elapsed_ms = (time.perf_counter() - started) * 1000
+
+    metrics.observe("sql", elapsed_ms)
+    if has_request_context():
+        metrics.observe(f"sql:{request.endpoint}", elapsed_ms)
+
+    if elapsed_ms < slow_query_log.threshold_ms:
+        return
+
+    plan = None
+    if (conn.dialect.name == 'postgresql' and not executemany
+            and slow_query_log.should_explain(statement)):
+        plan = _explain(conn, statement, parameters)
+
+    slow_query_log.record(statement, elapsed_ms, plan)
+
+
+def _explain(conn, statement, parameters):
+    """Run EXPLAIN (ANALYZE, BUFFERS) for a statement.
+
+    Uses a fresh DBAPI cursor on the same connection, so the caller's
+    pending result set is untouched and no engine events fire for it.
+    The EXPLAIN runs inside a savepoint so a failure can't abort the
+    caller's transaction.
+    """
+
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute("SAVEPOINT slow_query_explain")
+        try:
+            cursor.execute("EXPLAIN (ANALYZE, BUFFERS) " + statement,
+                           parameters)
+            plan = "\n".join(row[0] for row in cursor.fetchall())
+        except Exception as exc:
+            cursor.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+            plan = f"EXPLAIN failed: {exc}"
+        cursor.execute("RELEASE SAVEPOINT slow_query_explain")
+        return plan
+    finally:
+        cursor.close()
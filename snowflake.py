@@ -0,0 +1,180 @@
+"""Time-ordered 64-bit ids for messages ("snowflake" ids).
+
+An id packs, from the high bits down:
+
+    41 bits  milliseconds since EPOCH (good until 2089)
+     5 bits  host id (SNOWFLAKE_HOST_ID)
+     5 bits  process slot on that host
+    12 bits  sequence within the millisecond
+
+so ids sort by creation time, and the primary key alone orders a feed
+and serves as its cursor. Each process claims a free slot by holding an
+exclusive lock on one of 32 lock files in the instance folder for as
+long as it runs, so processes on one host never share a slot; hosts
+must be given distinct SNOWFLAKE_HOST_IDs.
+
+Ids are turned on with SNOWFLAKE_IDS. Serial ids handed out before that
+are all smaller than any snowflake id, so old messages keep sorting
+first; turning it back off would break that, so don't.
+"""
+
+import fcntl
+import os
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import event
+
+
+EPOCH = datetime(2020, 1, 1)
+EPOCH_MS = int((EPOCH - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+HOST_BITS = 5
+SLOT_BITS = 5
+SEQUENCE_BITS = 12
+
+MAX_HOSTS = 1 << HOST_BITS
+MAX_SLOTS = 1 << SLOT_BITS
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+TIME_SHIFT = HOST_BITS + SLOT_BITS + SEQUENCE_BITS
+
+
+class SnowflakeGenerator:
+    """Generates ids for one (host, slot) worker."""
+
+    def __init__(self, host_id, slot, clock=time.time):
+        if not 0 <= host_id < MAX_HOSTS or not 0 <= slot < MAX_SLOTS:
+            raise ValueError(f"Worker ({host_id}, {slot}) out of range")
+
+        self.worker = (host_id << SLOT_BITS | slot) << SEQUENCE_BITS
+        self.clock = clock
+        self._last_ms = -1
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def next_id(self):
+        with self._lock:
+            now = self._now_ms()
+
+            # If the clock stepped back, keep counting from where we were
+            # rather than risk repeating an id.
+            now = max(now, self._last_ms)
+
+            if now == self._last_ms:
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+                if self._sequence == 0:
+                    # 4096 ids this millisecond; wait for the next
+                    while now <= self._last_ms:
+                        now = self._now_ms()
+            else:
+                self._sequence = 0
+
+            self._last_ms = now
+            return (now - EPOCH_MS) << TIME_SHIFT | self.worker | self._sequence
+
+    def _now_ms(self):
+        return int(self.clock() * 1000)
+
+
+def timestamp_of(snowflake_id):
+    """The UTC datetime a snowflake id was generated at."""
+
+    ms = (snowflake_id >> TIME_SHIFT) + EPOCH_MS
+    return datetime.utcfromtimestamp(ms / 1000)
+
+
+def min_id_at(when):
+    """The smallest snowflake id generated at or after datetime `when`."""
+
+    ms = int((when - datetime(1970, 1, 1)).total_seconds() * 1000)
+    return max(0, ms - EPOCH_MS) << TIME_SHIFT
+
+
+def claim_slot(lock_dir):
+    """Lock a free process slot in `lock_dir`. Returns (slot, lock file).
+
+    The lock is held until the returned file is closed or the process
+    exits.
+    """
+
+    os.makedirs(lock_dir, exist_ok=True)
+
+    for slot in range(MAX_SLOTS):
+        lock_file = open(os.path.join(lock_dir, f"slot-{slot}.lock"), 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            continue
+
+        return slot, lock_file
+
+    raise RuntimeError(f"All {MAX_SLOTS} snowflake slots in {lock_dir} are taken")
+
+
+class Snowflakes:
+    """Assigns snowflake ids to new rows of a model, when enabled.
+
+    The slot and generator are set up by the first insert in each
+    process, not at init_app: servers that load the app and then fork
+    workers would otherwise give every worker the same slot.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.host_id = 0
+        self.lock_dir = None
+        self._generator = None
+        self._lock_file = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app, model):
+        app.config.setdefault('SNOWFLAKE_IDS', False)
+        app.config.setdefault('SNOWFLAKE_HOST_ID', 0)
+
+        if not app.config['SNOWFLAKE_IDS']:
+            return
+
+        self.host_id = app.config['SNOWFLAKE_HOST_ID']
+        if not 0 <= self.host_id < MAX_HOSTS:
+            raise ValueError(f"SNOWFLAKE_HOST_ID {self.host_id} out of range")
+
+        self.lock_dir = os.path.join(app.instance_path, 'snowflake')
+        self.enabled = True
+
+        event.listen(model, 'before_insert', self._assign_id)
+
+    @property
+    def generator(self):
+        """This process's generator, claiming a slot on first use."""
+
+        with self._lock:
+            if self._pid != os.getpid():
+                # a forked child shares the parent's slot until it claims
+                # its own; closing its copy leaves the parent's lock held
+                if self._lock_file is not None:
+                    self._lock_file.close()
+
+                slot, self._lock_file = claim_slot(self.lock_dir)
+                self._generator = SnowflakeGenerator(self.host_id, slot)
+                self._pid = os.getpid()
+
+            return self._generator
+
+    def close(self):
+        """Give up this process's slot."""
+
+        with self._lock:
+            if self._lock_file is not None and self._pid == os.getpid():
+                self._lock_file.close()
+            self._lock_file = self._generator = self._pid = None
+
+    def _assign_id(self, mapper, connection, target):
+        if target.id is None:
+            target.id = self.generator.next_id()
+
+
+snowflakes = Snowflakes()
@@ -0,0 +1,72 @@
+/* In-place like/unlike and follow/unfollow buttons.
+ *
+ * Intercepts the POST forms for these actions, sends them with
+ * `Accept: application/json` and swaps the button (and like count) on
+ * the page instead of following the redirect. Without JavaScript, or if
+ * the request fails, the form submits normally.
+ */
+
+(function () {
+  if (!window.fetch) return;
+
+  const ACTIONS = [
+    { pattern: /\/users\/add_like\/(\d+)$/, swap: "remove_like" },
+    { pattern: /\/users\/remove_like\/(\d+)$/, swap: "add_like" },
+    { pattern: /\/users\/follow\/(\d+)$/, swap: "stop-following" },
+    { pattern: /\/users\/stop-following\/(\d+)$/, swap: "follow" },
+  ];
+
+  const BUTTONS = {
+    add_like: ["btn-primary", '<i class="fa fa-thumbs-up"></i> Like'],
+    remove_like: ["btn-secondary", '<i class="fa fa-thumbs-down"></i> Unlike'],
+    follow: ["btn-outline-primary", "Follow"],
+    "stop-following": ["btn-primary", "Unfollow"],
+  };
+
+  function render(form, action, id) {
+    const button = form.querySelector("button");
+    const [cls, html] = BUTTONS[action];
+
+    form.action = "/users/" + action + "/" + id;
+    button.classList.remove("btn-primary", "btn-secondary",
+                            "btn-outline-primary");
+    button.classList.add(cls);
+    button.innerHTML = html;
+  }
+
+  function showLikes(form, count) {
+    const scope = form.closest("li") || document;
+    const label = scope.querySelector(".like-count");
+    if (label) label.textContent = count + (count === 1 ? " like" : " likes");
+  }
+
+  document.addEventListener("submit", function (evt) {
+    const form = evt.target;
+    const path = new URL(form.action, window.location.href).pathname;
+    const action = ACTIONS.find(function (a) { return a.pattern.test(path); });
+    if (!action) return;
+
+    evt.preventDefault();
+    const id = path.match(action.pattern)[1];
+    const button = form.querySelector("button");
+    button.disabled = true;
+
+    fetch(form.action, {
+      method: "POST",
+      headers: { Accept: "application/json" },
+      credentials: "same-origin",
+    })
+      .then(function (resp) {
+        if (!resp.ok) throw new Error(resp.status);
+        return resp.json();
+      })
+      .then(function (data) {
+        render(form, action.swap, id);
+        if ("like_count" in data) showLikes(form, data.like_count);
+        button.disabled = false;
+      })
+      .catch(function () {
+        form.submit();
+      });
+  });
+})();
@@ -0,0 +1,62 @@
+/* Live "new warbles" notice for the home timeline.
+ *
+ * Listens to /stream/home and counts new messages, offering a reload
+ * rather than re-rendering the timeline on every event. Browsers
+ * without EventSource, and clients turned away because the server has
+ * too many streams open, poll /api/timeline/new instead, revalidating
+ * with the last ETag so idle polls come back as empty 304s.
+ */
+
+(function () {
+  const notice = document.getElementById("new-warbles");
+  const timeline = document.getElementById("messages");
+  if (!notice || !timeline) return;
+
+  function show(text) {
+    notice.textContent = text;
+    notice.classList.remove("d-none");
+  }
+
+  function showCount(count) {
+    show(count === 1 ? "1 new warble" : count + " new warbles");
+  }
+
+  function poll() {
+    const since = timeline.dataset.newest || "0";
+    let etag = null;
+
+    setInterval(function () {
+      const headers = etag ? { "If-None-Match": etag } : {};
+      fetch("/api/timeline/new?since=" + since, { headers: headers })
+        .then(function (resp) {
+          if (resp.status !== 200) return;
+          etag = resp.headers.get("ETag");
+          return resp.json().then(function (data) {
+            if (data.count) showCount(data.count);
+          });
+        });
+    }, 30000);
+  }
+
+  if (!window.EventSource) {
+    poll();
+    return;
+  }
+
+  const seen = new Set();
+  const stream = new EventSource("/stream/home");
+
+  // a 503 closes the stream for good, rather than reconnecting
+  stream.addEventListener("error", function () {
+    if (stream.readyState === EventSource.CLOSED) poll();
+  });
+
+  stream.addEventListener("message", function (evt) {
+    seen.add(JSON.parse(evt.data).id_str);
+    showCount(seen.size);
+  });
+
+  stream.addEventListener("reset", function () {
+    show("New warbles available");
+  });
+})();
@@ -0,0 +1,117 @@
+"""Jinja setup for Warbler: bytecode cache and render timing.
+
+Compiled templates are cached on local disk (TEMPLATE_CACHE_DIR), so a
+restarted worker loads bytecode instead of recompiling every template.
+
+Every template render is timed as `template:<name>`, and every block as
+`block:<template>:<block>`. Block timings are inclusive of nested blocks.
+Both count only time spent producing output, so they stay meaningful
+when a template is streamed to a slow client.
+"""
+
+import os
+import time
+
+from flask import (template_rendered, before_render_template, g, current_app,
+                   get_flashed_messages, stream_with_context)
+from flask.templating import Environment
+from jinja2 import FileSystemBytecodeCache
+
+from metrics import metrics
+
+
+class TimedEnvironment(Environment):
+    """Jinja environment that instruments the blocks of loaded templates."""
+
+    def get_template(self, name, parent=None, globals=None):
+        template = super().get_template(name, parent, globals)
+
+        if not getattr(template, '_warbler_timed', False):
+            for block_name, render in list(template.blocks.items()):
+                template.blocks[block_name] = _timed_block(
+                    template.name, block_name, render)
+            template._warbler_timed = True
+
+        return template
+
+
+def _timed_block(template_name, block_name, render):
+    key = f"block:{template_name}:{block_name}"
+
+    def timed_render(context):
+        elapsed = 0.0
+        events = render(context)
+
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    event = next(events)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += time.perf_counter() - started
+
+                yield event
+        finally:
+            metrics.observe(key, elapsed * 1000)
+
+    return timed_render
+
+
+def stream_template(template_name, **context):
+    """Render a template as an iterator of chunks, for a streamed response.
+
+    The counterpart of `render_template`: each part of the page is sent
+    as soon as it's rendered, so the header goes out before the queries
+    behind later parts (e.g. an iterator of rows) have run. Wrap it in a
+    Response.
+    """
+
+    app = current_app._get_current_object()
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+
+    # Take flashed messages out of the session now, while the session
+    # cookie can still be updated; the template gets them from the
+    # request's copy.
+    get_flashed_messages()
+
+    def generate():
+        before_render_template.send(app, template=template, context=context)
+        for chunk in template.generate(context):
+            # leave time spent waiting on the client out of the render timer
+            paused = time.perf_counter()
+            yield chunk
+            g.template_timers[-1] += time.perf_counter() - paused
+        template_rendered.send(app, template=template, context=context)
+
+    return stream_with_context(generate())
+
+
+def init_templating(app):
+    """Install the bytecode cache and render timing on `app`.
+
+    Must run before `app.jinja_env` is first used.
+    """
+
+    cache_dir = app.config.setdefault(
+        'TEMPLATE_CACHE_DIR', os.path.join(app.instance_path, 'jinja-cache'))
+    os.makedirs(cache_dir, exist_ok=True)
+
+    app.jinja_environment = TimedEnvironment
+    app.jinja_options = dict(app.jinja_options,
+                             bytecode_cache=FileSystemBytecodeCache(cache_dir))
+
+    before_render_template.connect(_start_render_timer, app)
+    template_rendered.connect(_stop_render_timer, app)
+
+
+def _start_render_timer(sender, template, context, **extra):
+    g.setdefault('template_timers', []).append(time.perf_counter())
+
+
+def _stop_render_timer(sender, template, context, **extra):
+    started = g.template_timers.pop()
+    metrics.observe(f"template:{template.name}",
+                    (time.perf_counter() - started) * 1000)
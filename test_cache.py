@@ -0,0 +1,48 @@
+"""Cache tests."""
+
+import time
+from unittest import TestCase
+from unittest.mock import patch
+
+from cache import Cache
+
+
+class CacheTestCase(TestCase):
+    """Test the read-through cache."""
+
+    def test_get_or_load(self):
+        """Is the loader only called on a miss?"""
+        cache = Cache()
+        calls = []
+
+        def loader():
+            calls.append(1)
+            return {"id": 1}
+
+        self.assertEqual(cache.get_or_load("message:1", loader), {"id": 1})
+        self.assertEqual(cache.get_or_load("message:1", loader), {"id": 1})
+        self.assertEqual(len(calls), 1)
+
+    def test_negative_caching(self):
+        """Are missing values cached for the shorter negative ttl?"""
+        cache = Cache(ttl=60, negative_ttl=5)
+        cache.get_or_load("message:1", lambda: {"id": 1})
+        cache.get_or_load("message:2", lambda: None)
+        self.assertIsNone(cache.get("message:2", "not cached"))
+
+        later = time.monotonic() + 6
+        with patch("cache.time.monotonic", return_value=later):
+            self.assertEqual(cache.get("message:1"), {"id": 1})
+            self.assertEqual(cache.get("message:2", "expired"), "expired")
+
+    def test_lru_eviction(self):
+        """Is the least recently used entry evicted when full?"""
+        cache = Cache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
@@ -0,0 +1,227 @@
+"""Background job tests."""
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+from unittest.mock import patch
+
+from sqlalchemy.exc import OperationalError
+
+from models import db, Job, User
+
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+import jobs
+from app import app, CURR_USER_KEY
+
+
+db.create_all()
+
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+calls = []
+
+
+@jobs.handler('test_record')
+def record_job(value):
+    calls.append(value)
+
+
+@jobs.handler('test_fail')
+def fail_job():
+    raise ValueError("nope")
+
+
+class JobsTestCase(TestCase):
+    """Test queueing and running jobs."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        calls.clear()
+
+        self.worker = jobs.Worker(app, concurrency=10)
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_run(self):
+        """Are queued jobs run once, with their args?"""
+        jobs.enqueue('test_record', value=1)
+        jobs.enqueue('test_record', value=2)
+        db.session.commit()
+
+        self.assertEqual(self.worker.run_once(), 2)
+        self.assertEqual(sorted(calls), [1, 2])
+        self.assertEqual(jobs.queue_depth(), {'done': 2})
+
+        self.assertEqual(self.worker.run_once(), 0)
+
+    def test_idempotency_key(self):
+        """Is a job only queued once per key?"""
+        jobs.enqueue('test_record', key="once", value=1)
+        jobs.enqueue('test_record', key="once", value=2)
+        db.session.commit()
+
+        self.worker.run_once()
+        self.assertEqual(calls, [1])
+
+    def test_delay(self):
+        """Do delayed jobs wait until they're due?"""
+        jobs.enqueue('test_record', delay=60, value=1)
+        db.session.commit()
+
+        self.assertEqual(self.worker.run_once(), 0)
+        self.assertEqual(jobs.queue_depth(), {'queued': 1})
+
+    def test_retry_with_backoff(self):
+        """Are failed jobs retried later, then given up on?"""
+        jobs.enqueue('test_fail', max_attempts=2)
+        db.session.commit()
+
+        self.worker.run_once()
+        job = Job.query.one()
+        self.assertEqual(job.status, 'queued')
+        self.assertEqual(job.attempts, 1)
+        self.assertIn("nope", job.last_error)
+        self.assertGreater(job.run_at, datetime.utcnow())
+
+        job.run_at = datetime.utcnow()
+        db.session.commit()
+
+        self.worker.run_once()
+        job = Job.query.one()
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(job.attempts, 2)
+
+    def test_expired_lease(self):
+        """Is a job whose worker died claimed again after its lease?"""
+        jobs.enqueue('test_record', value=1)
+        db.session.commit()
+
+        self.assertEqual(len(self.worker.claim(1)), 1)
+        self.assertEqual(self.worker.claim(1), [])
+
+        self.worker.lease_seconds = -1
+        self.assertEqual(self.worker.run_once(), 1)
+        self.assertEqual(calls, [1])
+
+    def test_fenced_by_attempt(self):
+        """Can a worker that lost its lease not overwrite the new attempt?"""
+        jobs.enqueue('test_record', value=1)
+        db.session.commit()
+
+        [(job_id, first)] = self.worker.claim(1)
+        self.worker.lease_seconds = -1
+        [(same_id, second)] = self.worker.claim(1)
+        self.assertEqual((same_id, second), (job_id, first + 1))
+
+        # the first worker finishes late, then the current attempt fails
+        self.worker.run_job(job_id, first)
+        self.assertEqual(Job.query.get(job_id).status, 'running')
+
+        with patch.dict(jobs._handlers, test_record=fail_job):
+            self.worker.run_job(job_id, second)
+        self.assertEqual(Job.query.get(job_id).status, 'queued')
+
+    def test_prune(self):
+        """Are only done jobs past the retention period deleted?"""
+        for value in range(3):
+            jobs.enqueue('test_record', key=f"prune:{value}", value=value)
+        jobs.enqueue('test_record', delay=60, value=3)
+        db.session.commit()
+        self.worker.run_once()
+
+        old = Job.query.filter_by(idempotency_key="prune:0").one()
+        old.finished_at = datetime.utcnow() - timedelta(days=8)
+        db.session.commit()
+
+        self.assertEqual(jobs.prune(retention_days=7, batch_size=1), 1)
+        self.assertEqual(jobs.queue_depth(), {'done': 2, 'queued': 1})
+
+        # its key can be used again
+        jobs.enqueue('test_record', key="prune:0", value=0)
+        db.session.commit()
+        self.assertEqual(self.worker.run_once(), 1)
+
+    def test_housekeeping_on_a_timer(self):
+        """Is the queue depth sampled on a timer, not on every poll?"""
+        self.worker.depth_seconds = 30
+
+        with patch("jobs.queue_depth") as depth, patch("jobs.prune") as prune:
+            prune.return_value = 0
+            for now in (100, 110, 129, 130):
+                self.worker.housekeeping(now=now)
+
+        self.assertEqual(depth.call_count, 2)
+        self.assertEqual(prune.call_count, 1)
+
+    def test_periodic_tasks(self):
+        """Are periodic tasks run on their schedule, and failures contained?"""
+        def tick():
+            calls.append("tick")
+
+        def broken():
+            raise ValueError("nope")
+
+        tasks = {"tick": (10, tick), "broken": (10, broken)}
+        with patch.dict(jobs._periodic, tasks, clear=True):
+            for now in (100, 105, 110):
+                self.worker.housekeeping(now=now)
+
+        self.assertEqual(calls, ["tick", "tick"])
+
+    def test_run_survives_database_errors(self):
+        """Does the worker loop keep polling after a database error?"""
+        worker = jobs.Worker(app, poll_seconds=0.01)
+        polls = []
+
+        def claim(limit):
+            polls.append(limit)
+            if len(polls) == 1:
+                raise OperationalError("SELECT", {}, Exception("restarting"))
+            worker.stop()
+            return []
+
+        with patch.object(worker, "claim", claim), \
+                patch.object(worker, "housekeeping"):
+            worker.run()
+
+        self.assertEqual(len(polls), 2)
+
+    def test_run_deleted_job(self):
+        """Is a claimed job that was deleted since skipped?"""
+        jobs.enqueue('test_record', value=1)
+        db.session.commit()
+
+        [(job_id, attempt)] = self.worker.claim(1)
+        Job.query.filter_by(id=job_id).delete()
+        db.session.commit()
+
+        self.worker.run_job(job_id, attempt)
+        self.assertEqual(calls, [])
+
+    def test_backoff(self):
+        """Does the retry delay double, up to the cap?"""
+        self.assertEqual([jobs.backoff(n) for n in (1, 2, 3)], [5, 10, 20])
+        self.assertEqual(jobs.backoff(30), 3600)
+
+    def test_delete_user_purges_in_background(self):
+        """Does deleting an account queue a purge job?"""
+        user = User.signup("testuser", "test@test.com", "password", None)
+        db.session.commit()
+        user_id = user.id
+
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+        client.post("/users/delete")
+        client.post("/users/delete")
+        self.assertIsNotNone(User.query.get(user_id))
+
+        self.assertEqual(self.worker.run_once(), 1)
+        self.assertIsNone(User.query.get(user_id))
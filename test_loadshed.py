@@ -0,0 +1,195 @@
+"""Load shedding tests."""
+
+import os
+from unittest import TestCase
+from unittest.mock import patch
+
+from sqlalchemy.exc import OperationalError
+
+from loadshed import CircuitBreaker
+
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from loadshed import shedder, STREAM_ERROR
+from models import db, User
+
+
+db.create_all()
+
+
+class CircuitBreakerTestCase(TestCase):
+    """Test the circuit breaker."""
+
+    def test_opens_after_failures(self):
+        """Does the breaker open after enough failures in a row?"""
+        breaker = CircuitBreaker(failure_threshold=2, reset_seconds=10)
+
+        breaker.record_failure(now=0)
+        breaker.record_success()
+        breaker.record_failure(now=0)
+        self.assertTrue(breaker.allow(now=0))
+
+        breaker.record_failure(now=0)
+        self.assertFalse(breaker.allow(now=5))
+
+    def test_half_open_probe(self):
+        """Is one probe let through after the reset time?"""
+        breaker = CircuitBreaker(failure_threshold=1, reset_seconds=10)
+        breaker.record_failure(now=0)
+
+        self.assertTrue(breaker.allow(now=10))
+        self.assertFalse(breaker.allow(now=11))
+
+        # a failed probe re-opens it
+        breaker.record_failure(now=11)
+        self.assertFalse(breaker.allow(now=15))
+
+        self.assertTrue(breaker.allow(now=21))
+        breaker.record_success()
+        self.assertTrue(breaker.allow(now=22))
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+
+class LoadShedViewTestCase(TestCase):
+    """Test shedding load from views."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.user = User.signup(username="testuser",
+                                email="test@test.com",
+                                password="password",
+                                image_url=None)
+        db.session.commit()
+        self.user_id = self.user.id
+
+        shedder.stale.clear()
+        shedder.breaker.record_success()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        shedder.breaker.record_success()
+
+    def trip(self):
+        for _ in range(shedder.breaker.failure_threshold):
+            shedder.breaker.record_failure()
+
+    def test_stale_homepage(self):
+        """Is the last homepage served, marked stale, while the breaker is open?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            resp = c.get("/")
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn("Warbler is busy", str(resp.data))
+
+            self.trip()
+            with patch("app.User") as user:
+                resp = c.get("/")
+                self.assertFalse(user.mock_calls)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Warbler is busy", str(resp.data))
+            self.assertIn("@testuser", str(resp.data))
+            self.assertIn("Stale", resp.headers["Warning"])
+
+            resp = c.get("/users")
+            self.assertEqual(resp.status_code, 503)
+
+    def test_stale_streamed_profile(self):
+        """Is a streamed profile page kept for serving stale too?"""
+
+        with self.client as c:
+            resp = c.get(f"/users/{self.user_id}")
+            self.assertTrue(resp.is_streamed)
+            resp.get_data()
+
+            self.trip()
+            resp = c.get(f"/users/{self.user_id}")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Warbler is busy", str(resp.data))
+            self.assertIn("@testuser", str(resp.data))
+
+    def test_database_error(self):
+        """Do database errors count against the breaker and get a 503?"""
+
+        error = OperationalError("SELECT", {}, Exception("timeout"))
+
+        with patch("app.User.active", side_effect=error):
+            for _ in range(shedder.breaker.failure_threshold):
+                resp = self.client.get(f"/users/{self.user_id}")
+                self.assertEqual(resp.status_code, 503)
+
+        self.assertEqual(shedder.breaker.state, CircuitBreaker.OPEN)
+
+    def test_database_error_mid_stream(self):
+        """Does a database error part way through a streamed page count
+        against the breaker, and cut the page short with an error?"""
+
+        error = OperationalError("SELECT", {}, Exception("timeout"))
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            with patch("app.User.follow_state", side_effect=error):
+                for _ in range(shedder.breaker.failure_threshold):
+                    resp = c.get("/users")
+                    self.assertEqual(resp.status_code, 200)
+                    self.assertTrue(resp.is_streamed)
+
+                    page = resp.get_data(as_text=True)
+                    self.assertIn("<nav", page)
+                    self.assertTrue(page.endswith(STREAM_ERROR))
+
+        self.assertEqual(shedder.breaker.state, CircuitBreaker.OPEN)
+
+    def test_profile_messages_streamed(self):
+        """Is a profile's header sent before its messages are queried?"""
+
+        error = OperationalError("SELECT", {}, Exception("timeout"))
+
+        def failing(query, limit):
+            raise error
+            yield
+
+        with patch("app.newest_messages", failing):
+            resp = self.client.get(f"/users/{self.user_id}")
+            page = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("@testuser", page)
+        self.assertTrue(page.endswith(STREAM_ERROR))
+
+    def test_statement_timeout(self):
+        """Do configured routes run under a statement timeout?"""
+
+        seen = []
+
+        def capture():
+            seen.append(db.session.execute("SHOW statement_timeout").scalar())
+
+        with patch.dict(app.config["STATEMENT_TIMEOUTS"], {"list_users": 1234}):
+            with app.test_request_context("/users"):
+                app.preprocess_request()
+                capture()
+
+        self.assertEqual(seen, ["1234ms"])
+
+    def test_health(self):
+        """Does /health report pool usage, and 503 while the breaker is open?"""
+
+        resp = self.client.get("/health")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json["breaker"], "closed")
+        self.assertIn("checked_out", resp.json)
+
+        self.trip()
+        resp = self.client.get("/health")
+        self.assertEqual(resp.status_code, 503)
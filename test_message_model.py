@@ -1,9 +1,11 @@
 """Message model tests."""
 
 import os
+import threading
+import time
 from unittest import TestCase
 from sqlalchemy.exc import IntegrityError
-from models import db, User, Message, Likes
+from models import db, User, Message, Likes, MessageTag, Mention
 from app import app
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
@@ -51,6 +53,100 @@ class MessageModelTestCase(TestCase):
         """Does is_liked_by successfully detect when a message is not liked by a user?"""
         self.assertFalse(self.message.is_liked_by(self.user))
 
+    def test_add_like_counts(self):
+        """Does add_like bump like_count, once per user?"""
+        self.assertTrue(self.user.add_like(self.message))
+        db.session.commit()
+        self.assertFalse(self.user.add_like(self.message))
+        db.session.commit()
+
+        self.assertEqual(self.message.like_count, 1)
+        self.assertTrue(self.message.is_liked_by(self.user))
+
+    def test_add_like_race(self):
+        """Does a like racing an uncommitted one count once, without error?"""
+        user_id, msg_id = self.user.id, self.message.id
+        liked = threading.Event()
+        results = []
+
+        def like(then_commit):
+            with app.app_context():
+                user, message = User.query.get(user_id), Message.query.get(msg_id)
+                results.append(user.add_like(message))
+                if then_commit:
+                    liked.set()
+                    time.sleep(0.2)
+                db.session.commit()
+
+        first = threading.Thread(target=like, args=(True,))
+        first.start()
+        self.assertTrue(liked.wait(5))
+        # blocks on the first like's row until it commits
+        like(False)
+        first.join()
+
+        self.assertEqual(results, [True, False])
+        db.session.expire_all()
+        self.assertEqual(Message.query.get(msg_id).like_count, 1)
+
+    def test_remove_like_counts(self):
+        """Does remove_like drop like_count, only if liked?"""
+        self.user.add_like(self.message)
+        db.session.commit()
+
+        self.assertTrue(self.user.remove_like(self.message))
+        db.session.commit()
+        self.assertFalse(self.user.remove_like(self.message))
+        db.session.commit()
+
+        self.assertEqual(self.message.like_count, 0)
+        self.assertFalse(self.message.is_liked_by(self.user))
+
+    def test_recount_likes(self):
+        """Does recount_likes repair counts that drifted?"""
+        db.session.add(Likes(user_id=self.user.id, message_id=self.message.id))
+        db.session.commit()
+        self.assertEqual(self.message.like_count, 0)
+
+        self.assertEqual(Message.recount_likes(batch_size=1), 1)
+        db.session.refresh(self.message)
+        self.assertEqual(self.message.like_count, 1)
+
+    def test_recount_likes_sparse_ids(self):
+        """Does recount_likes walk only existing ids, however far apart?"""
+        far = Message(id=2 ** 60, text="Snowflake", user_id=self.user.id)
+        db.session.add(far)
+        db.session.commit()
+        db.session.add(Likes(user_id=self.user.id, message_id=far.id))
+        db.session.commit()
+
+        self.assertEqual(Message.recount_likes(batch_size=1), 1)
+        self.assertEqual(Message.query.get(2 ** 60).like_count, 1)
+
+    def test_index_text(self):
+        """Are #tags and @mentions of known users indexed?"""
+        msg = Message(text="Hi @testuser and @nobody #Flask #python #flask",
+                      user_id=self.user.id)
+        db.session.add(msg)
+        db.session.flush()
+        Message.index_text([msg])
+        db.session.commit()
+
+        tags = {row.tag for row in MessageTag.query.filter_by(message_id=msg.id)}
+        self.assertEqual(tags, {"flask", "python"})
+
+        mentions = Mention.query.filter_by(message_id=msg.id).all()
+        self.assertEqual([m.user_id for m in mentions], [self.user.id])
+
+    def test_backfill_text_index(self):
+        """Does the backfill index existing messages, and is it re-runnable?"""
+        db.session.add(Message(text="old #warble", user_id=self.user.id))
+        db.session.commit()
+
+        self.assertEqual(Message.backfill_text_index(chunk_size=1), 2)
+        self.assertEqual(Message.backfill_text_index(chunk_size=1), 2)
+        self.assertEqual(MessageTag.query.filter_by(tag="warble").count(), 1)
+
     def test_message_creation(self):
         """Does creating a message with valid data succeed?"""
         msg = Message(
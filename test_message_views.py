@@ -16,6 +16,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
 
 from app import app, CURR_USER_KEY
+from cache import cache
 
 
 db.create_all()
@@ -35,6 +36,7 @@ class MessageViewTestCase(TestCase):
 
         User.query.delete()
         Message.query.delete()
+        cache.clear()
 
         self.client = app.test_client()
 
@@ -154,6 +156,155 @@ class MessageViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("Test message", str(resp.data))
 
+    def test_view_missing_message(self):
+        """Does a missing message give a 404, and stay cached as missing?"""
+
+        with self.client as c:
+            resp = c.get("/messages/99999")
+            self.assertEqual(resp.status_code, 404)
+
+        self.assertIsNone(cache.get("message:99999", "not cached"))
+
+    def test_view_message_like_state(self):
+        """Does the message page show the viewer's like state?"""
+
+        msg = Message(
+            text="Test message",
+            user_id=self.testuser.id
+        )
+
+        db.session.add(msg)
+        db.session.commit()
+        self.testuser.likes.append(msg)
+        db.session.commit()
+
+        msg_id, user_id = msg.id, self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            resp = c.get(f"/messages/{msg_id}")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Unlike", str(resp.data))
+
+    def test_delete_message_invalidates_cache(self):
+        """Is a deleted message no longer served from the cache?"""
+
+        msg = Message(
+            text="Test message",
+            user_id=self.testuser.id
+        )
+
+        db.session.add(msg)
+        db.session.commit()
+
+        msg_id, user_id = msg.id, self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            resp = c.get(f"/messages/{msg_id}")
+            self.assertEqual(resp.status_code, 200)
+
+            c.post(f"/messages/{msg_id}/delete")
+
+            resp = c.get(f"/messages/{msg_id}")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_api_message_like_count(self):
+        """Does the message API report the like count?"""
+
+        msg = Message(
+            text="Test message",
+            user_id=self.testuser.id
+        )
+
+        db.session.add(msg)
+        db.session.commit()
+
+        msg_id, user_id = msg.id, self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            c.post(f"/users/add_like/{msg_id}")
+
+            resp = c.get(f"/api/messages/{msg_id}")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json["text"], "Test message")
+            self.assertEqual(resp.json["like_count"], 1)
+
+    def test_like_json(self):
+        """Do like and unlike answer with JSON when asked to?"""
+
+        msg = Message(text="Test message", user_id=self.testuser.id)
+        db.session.add(msg)
+        db.session.commit()
+
+        msg_id, user_id = msg.id, self.testuser.id
+        headers = {"Accept": "application/json"}
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            resp = c.post(f"/users/add_like/{msg_id}", headers=headers)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json, {"message_id": msg_id, "liked": True,
+                                         "like_count": 1})
+
+            resp = c.post(f"/users/remove_like/{msg_id}", headers=headers)
+            self.assertEqual(resp.json, {"message_id": msg_id, "liked": False,
+                                         "like_count": 0})
+
+            # no flashes are left over for the next page
+            with c.session_transaction() as sess:
+                self.assertNotIn("_flashes", sess)
+
+    def test_tag_page(self):
+        """Does a new message show up on its tag pages, with tags linked?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "Learning #Flask <b>today</b>"})
+
+            resp = c.get("/tags/flask")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('<a href="/tags/flask">#Flask</a>', str(resp.data))
+            self.assertIn("&lt;b&gt;today&lt;/b&gt;", str(resp.data))
+
+            resp = c.get("/tags/python")
+            self.assertIn("No messages with this tag", str(resp.data))
+
+    def test_mentions_page(self):
+        """Does a message mentioning a user show on their mentions tab?"""
+
+        other_user = User.signup(username="otheruser",
+                                 email="other@test.com",
+                                 password="otheruser",
+                                 image_url=None)
+        db.session.commit()
+
+        other_id, user_id = other_user.id, self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            c.post("/messages/new", data={"text": "Hello @otheruser"})
+
+            resp = c.get(f"/users/{other_id}/mentions")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Hello @otheruser", str(resp.data))
+
+            resp = c.get(f"/users/{user_id}/mentions")
+            self.assertIn("No mentions yet", str(resp.data))
+
     def test_add_message_without_logging_in(self):
         """Is user prevented from adding a message without logging in?"""
 
@@ -165,6 +316,48 @@ class MessageViewTestCase(TestCase):
             msg = Message.query.filter_by(text="Hello").first()
             self.assertIsNone(msg)
 
+    def test_timeline_new(self):
+        """Does the poll endpoint count newer messages and honor ETags?"""
+
+        other_user = User.signup(username="otheruser",
+                                 email="other@test.com",
+                                 password="otheruser",
+                                 image_url=None)
+        db.session.commit()
+
+        self.testuser.following.append(other_user)
+        old = Message(text="Old", user_id=other_user.id)
+        db.session.add(old)
+        db.session.commit()
+
+        old_id, other_id = old.id, other_user.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.get(f"/api/timeline/new?since={old_id}")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json["count"], 0)
+            etag = resp.headers["ETag"]
+
+            resp = c.get(f"/api/timeline/new?since={old_id}",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 304)
+
+            c.post("/messages/new", data={"text": "Mine"})
+            new = Message(text="New", user_id=other_id)
+            db.session.add(new)
+            db.session.commit()
+            new_id = new.id
+            cache.delete(f"hwm:{other_id}")
+
+            resp = c.get(f"/api/timeline/new?since={old_id}&ids=1",
+                         headers={"If-None-Match": etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json["count"], 2)
+            self.assertEqual(resp.json["ids"][0], new_id)
+
 if __name__ == '__main__':
     import unittest
     unittest.main()
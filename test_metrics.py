@@ -0,0 +1,87 @@
+"""Metrics and template timing tests."""
+
+import os
+from unittest import TestCase
+
+from models import db, User
+
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+
+from app import app, CURR_USER_KEY
+from metrics import Metrics, metrics
+
+
+db.create_all()
+
+
+class MetricsTestCase(TestCase):
+    """Test the metrics registry."""
+
+    def test_observe(self):
+        """Are timings aggregated per name?"""
+        registry = Metrics()
+        registry.observe("sql", 2)
+        registry.observe("sql", 4)
+        registry.observe("template:home.html", 1)
+
+        sql, template = registry.timers()
+        self.assertEqual(sql.name, "sql")
+        self.assertEqual(sql.count, 2)
+        self.assertEqual(sql.mean_ms, 3)
+        self.assertEqual(sql.max_ms, 4)
+        self.assertEqual(template.name, "template:home.html")
+
+
+class TemplateTimingTestCase(TestCase):
+    """Test that template and SQL costs are recorded per request."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        self.admin = User.signup("admin", "admin@test.com", "password", None)
+        self.admin.is_admin = True
+        db.session.commit()
+
+        self.admin_id = self.admin.id
+
+        metrics.reset()
+
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+        db.session.rollback()
+        db.drop_all()
+        db.create_all()
+
+    def test_homepage_timings(self):
+        """Are the homepage's template, blocks and SQL all timed?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.admin_id
+
+            resp = c.get("/")
+            self.assertEqual(resp.status_code, 200)
+
+        names = {timer.name for timer in metrics.timers()}
+        self.assertIn("template:home.html", names)
+        self.assertIn("block:home.html:content", names)
+        self.assertIn("sql:homepage", names)
+
+    def test_admin_metrics(self):
+        """Can an admin see the metrics page?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.admin_id
+
+            c.get("/")
+            resp = c.get("/admin/metrics")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("template:home.html", str(resp.data))
@@ -0,0 +1,177 @@
+"""Message partitioning tests."""
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from sqlalchemy import text
+
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+import jobs
+from models import db, Likes, Message, User
+import partitions
+from snowflake import SnowflakeGenerator, min_id_at
+
+
+db.create_all()
+
+
+class PartitionsTestCase(TestCase):
+    """Test partitioning, feeds and archiving of messages."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        user = User.signup("testuser", "test@test.com", "password", None)
+        db.session.commit()
+        self.user_id = user.id
+        db.session.add(Message(text="Serial", user_id=self.user_id))
+        db.session.commit()
+
+        self.now = datetime.utcnow()
+        self.start = partitions.month_start(self.now, -5)
+        partitions.partition_messages(months_ahead=6, now=self.start)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        db.drop_all()
+        db.create_all()
+
+    def add_message(self, when, text):
+        """Add a message with a snowflake id from time `when`."""
+
+        generator = SnowflakeGenerator(
+            0, 0, clock=lambda: (when - datetime(1970, 1, 1)).total_seconds())
+        msg = Message(id=generator.next_id(), text=text, timestamp=when,
+                      user_id=self.user_id)
+        db.session.add(msg)
+        db.session.commit()
+        return msg.id
+
+    def partition_of(self, message_id):
+        return db.session.execute(
+            text("SELECT tableoid::regclass::text FROM messages WHERE id = :id"),
+            {'id': message_id}).scalar()
+
+    def test_partition_messages(self):
+        """Is the table split by month, with old rows kept in place?"""
+
+        self.assertTrue(partitions.is_partitioned())
+
+        names = [name for name, *rest in partitions.partitions()]
+        self.assertEqual(names[0], partitions.LEGACY)
+        self.assertEqual(names[1:], [
+            partitions.partition_name(partitions.month_start(self.start, n))
+            for n in range(7)])
+
+        serial = Message.query.filter_by(text="Serial").one()
+        self.assertEqual(self.partition_of(serial.id), partitions.LEGACY)
+
+        month_ago = self.now - timedelta(days=31)
+        old_id = self.add_message(month_ago, "Last month")
+        new_id = self.add_message(self.now, "Now")
+        self.assertEqual(self.partition_of(old_id),
+                         partitions.partition_name(month_ago))
+        self.assertEqual(self.partition_of(new_id),
+                         partitions.partition_name(self.now))
+
+    def test_foreign_keys(self):
+        """Do likes still reference messages, and cascade?"""
+
+        msg_id = self.add_message(self.now, "Liked")
+        db.session.add(Likes(user_id=self.user_id, message_id=msg_id))
+        db.session.commit()
+
+        db.session.add(Likes(user_id=self.user_id, message_id=min_id_at(self.now)))
+        with self.assertRaises(Exception):
+            db.session.commit()
+        db.session.rollback()
+
+        Message.query.filter_by(id=msg_id).delete()
+        db.session.commit()
+        self.assertEqual(Likes.query.count(), 0)
+
+    def test_new_serial_ids(self):
+        """Do messages without snowflake ids still insert, into the legacy partition?"""
+
+        msg = Message(text="Another serial", user_id=self.user_id)
+        db.session.add(msg)
+        db.session.commit()
+
+        self.assertEqual(self.partition_of(msg.id), partitions.LEGACY)
+
+    def test_create_partitions(self):
+        """Are only missing months added?"""
+
+        self.assertEqual(partitions.create_partitions(months_ahead=1), [])
+
+        created = partitions.create_partitions(months_ahead=3)
+        self.assertEqual(created, [partitions.partition_name(
+            partitions.month_start(self.now, n)) for n in (2, 3)])
+
+    def test_workers_create_partitions(self):
+        """Do job workers keep partitions ahead without the cron job?"""
+
+        jobs.Worker(app).housekeeping()
+
+        names = [name for name, *rest in partitions.partitions()]
+        self.assertEqual(names[-1], partitions.partition_name(
+            partitions.month_start(self.now, 3)))
+
+    def test_recent_first(self):
+        """Are recent messages read from recent partitions first?"""
+
+        old_id = self.add_message(self.now - timedelta(days=100), "Old")
+        new_id = self.add_message(self.now - timedelta(minutes=1), "New")
+        query = Message.query.filter(Message.user_id == self.user_id)
+
+        messages = partitions.recent_first(query, 2, timedelta(days=7))
+        self.assertEqual([msg.id for msg in messages], [new_id, old_id])
+
+        messages = partitions.recent_first(query, 1, timedelta(days=7))
+        self.assertEqual([msg.id for msg in messages], [new_id])
+
+        # the recent read prunes everything older than the window
+        cutoff = min_id_at(self.now - timedelta(days=7))
+        recent = query.filter(Message.id >= cutoff).order_by(Message.id.desc())
+        sql = recent.statement.compile(compile_kwargs={'literal_binds': True})
+        plan = '\n'.join(row[0] for row in
+                         db.session.execute(text(f"EXPLAIN {sql}")))
+
+        self.assertNotIn(partitions.LEGACY, plan)
+        self.assertNotIn(partitions.partition_name(
+            partitions.month_start(self.now, -2)), plan)
+
+    def test_archive_partitions(self):
+        """Are old partitions archived once, and still readable?"""
+
+        old_id = self.add_message(self.now - timedelta(days=120), "Old")
+
+        archived = partitions.archive_partitions(older_than_months=2)
+        self.assertEqual(archived, [partitions.LEGACY] + [
+            partitions.partition_name(partitions.month_start(self.start, n))
+            for n in range(3)])
+        self.assertTrue(all(done for name, low, high, space, done
+                            in partitions.partitions()[:4]))
+        self.assertFalse(partitions.partitions()[4][4])
+
+        self.assertEqual(partitions.archive_partitions(older_than_months=2), [])
+        self.assertEqual(Message.query.get(old_id).text, "Old")
+
+    def test_partition_command_needs_snowflakes(self):
+        """Does the CLI refuse to partition without snowflake ids?"""
+
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=['warbler', 'partition-messages'])
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn("SNOWFLAKE_IDS", result.output)
+
+        result = runner.invoke(args=['warbler', 'create-partitions',
+                                     '--months-ahead', '1'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("Created 0 partitions.", result.output)
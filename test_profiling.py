@@ -0,0 +1,88 @@
+"""Request profiler tests."""
+
+import os
+import tempfile
+from unittest import TestCase
+
+from models import db, User
+
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+
+from app import app, CURR_USER_KEY
+
+
+db.create_all()
+
+
+class RequestProfilerTestCase(TestCase):
+    """Test which requests get profiled."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        self.user = User.signup("testuser", "test@test.com", "password", None)
+        self.admin = User.signup("admin", "admin@test.com", "password", None)
+        self.admin.is_admin = True
+        db.session.commit()
+
+        self.user_id = self.user.id
+        self.admin_id = self.admin.id
+
+        self.profile_dir = tempfile.TemporaryDirectory()
+        app.config['PROFILE_DIR'] = self.profile_dir.name
+
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+        db.session.rollback()
+        db.drop_all()
+        db.create_all()
+        self.profile_dir.cleanup()
+
+    def test_admin_header_profiles_request(self):
+        """Does an admin's profiling header write a profile for the endpoint?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.admin_id
+
+            resp = c.get("/", headers={"X-Warbler-Profile": "1"})
+            self.assertEqual(resp.status_code, 200)
+
+        [filename] = os.listdir(self.profile_dir.name)
+        self.assertTrue(filename.startswith(f"homepage-user{self.admin_id}-"))
+        self.assertTrue(filename.endswith(".prof"))
+
+    def test_header_ignored_for_non_admin(self):
+        """Is the profiling header ignored for ordinary users?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            resp = c.get("/", headers={"X-Warbler-Profile": "1"})
+            self.assertEqual(resp.status_code, 200)
+
+        self.assertEqual(os.listdir(self.profile_dir.name), [])
+
+    def test_streamed_page_profiled_when_done(self):
+        """Is a streamed page's profile written once its body is sent?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.admin_id
+
+            resp = c.get("/users", headers={"X-Warbler-Profile": "1"})
+            self.assertTrue(resp.is_streamed)
+            self.assertEqual(os.listdir(self.profile_dir.name), [])
+
+            self.assertIn("@testuser", resp.get_data(as_text=True))
+
+        [filename] = os.listdir(self.profile_dir.name)
+        self.assertTrue(filename.startswith(f"list_users-user{self.admin_id}-"))
@@ -0,0 +1,153 @@
+"""Pub/sub and live stream tests."""
+
+import json
+import os
+import threading
+from unittest import TestCase
+from unittest.mock import patch
+
+from flask import g
+
+from models import db, User, Follows
+
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+
+from app import app, broker, stream_home, CURR_USER_KEY
+from pubsub import InProcessBroker
+
+
+db.create_all()
+
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class InProcessBrokerTestCase(TestCase):
+    """Test the in-process broker."""
+
+    def test_publish_to_topic(self):
+        """Are events delivered only to subscribers of their topic?"""
+        bus = InProcessBroker()
+        first = bus.subscribe(["user:1", "user:2"])
+        second = bus.subscribe(["user:3"])
+
+        bus.publish("user:2", {"id": 10})
+
+        self.assertEqual(first.get(timeout=0), ([{"id": 10}], False))
+        self.assertEqual(second.get(timeout=0), ([], False))
+
+    def test_bounded_buffer(self):
+        """Does a full buffer drop the oldest events and report it?"""
+        bus = InProcessBroker(maxsize=2)
+        subscription = bus.subscribe(["user:1"])
+
+        for message_id in range(3):
+            bus.publish("user:1", {"id": message_id})
+
+        self.assertEqual(subscription.get(timeout=0),
+                         ([{"id": 1}, {"id": 2}], True))
+        self.assertEqual(subscription.get(timeout=0), ([], False))
+
+    def test_unsubscribe(self):
+        """Does unsubscribing remove the listener from every topic?"""
+        bus = InProcessBroker()
+        subscription = bus.subscribe(["user:1", "user:2"])
+        self.assertEqual(bus.subscriber_count(), 1)
+
+        bus.unsubscribe(subscription)
+        self.assertEqual(bus.subscriber_count(), 0)
+
+
+class StreamViewTestCase(TestCase):
+    """Test the home timeline stream."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        self.u1 = User.signup("testuser1", "test1@test.com", "password", None)
+        self.u2 = User.signup("testuser2", "test2@test.com", "password", None)
+        self.u3 = User.signup("testuser3", "test3@test.com", "password", None)
+        db.session.commit()
+
+        self.u1_id, self.u2_id, self.u3_id = self.u1.id, self.u2.id, self.u3.id
+
+        db.session.add(Follows(user_following_id=self.u1_id, user_being_followed_id=self.u2_id))
+        db.session.commit()
+
+        app.config['STREAM_HEARTBEAT_SECONDS'] = 0
+
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+        db.session.rollback()
+        db.drop_all()
+        db.create_all()
+        app.config['STREAM_HEARTBEAT_SECONDS'] = 15
+
+    def test_stream_followed_messages(self):
+        """Are new messages from followed users streamed as SSE events?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/stream/home", buffered=False)
+            self.assertEqual(resp.mimetype, "text/event-stream")
+
+            chunks = iter(resp.response)
+            self.assertEqual(next(chunks), b"retry: 5000\n\n")
+
+            broker.publish(f"user:{self.u3_id}", {"id": 1, "user_id": self.u3_id})
+            broker.publish(f"user:{self.u2_id}", {"id": 2, "user_id": self.u2_id})
+
+            event = next(chunks).decode()
+            resp.close()
+
+        self.assertIn("event: message", event)
+        data = json.loads(event.split("data: ")[1])
+        self.assertEqual(data, {"id": 2, "user_id": self.u2_id})
+        self.assertEqual(broker.subscriber_count(), 0)
+
+    def test_stream_not_iterated(self):
+        """Is nothing left subscribed if the stream is never sent?"""
+
+        with app.test_request_context("/stream/home"):
+            g.user = User.query.get(self.u1_id)
+            resp = stream_home()
+            self.assertEqual(resp.mimetype, "text/event-stream")
+
+        self.assertEqual(broker.subscriber_count(), 0)
+        resp.close()
+
+    def test_stream_cap(self):
+        """Are streams past the cap turned away until one closes?"""
+
+        with self.client as c, \
+                patch("app.stream_slots", threading.BoundedSemaphore(1)):
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            first = c.get("/stream/home", buffered=False)
+            self.assertEqual(first.status_code, 200)
+
+            resp = c.get("/stream/home", buffered=False)
+            self.assertEqual(resp.status_code, 503)
+            self.assertEqual(resp.headers["Retry-After"], "30")
+
+            first.close()
+            resp = c.get("/stream/home", buffered=False)
+            self.assertEqual(resp.status_code, 200)
+            resp.close()
+
+    def test_stream_logged_out(self):
+        """Is the stream closed to logged-out users?"""
+
+        with self.client as c:
+            resp = c.get("/stream/home", follow_redirects=True)
+            self.assertIn("Access unauthorized", str(resp.data))
@@ -0,0 +1,88 @@
+"""Rate limiter tests."""
+
+import os
+from unittest import TestCase
+from unittest.mock import patch
+
+from ratelimit import MemoryBuckets
+
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+from ratelimit import limiter
+
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class MemoryBucketsTestCase(TestCase):
+    """Test the in-process token buckets."""
+
+    def test_burst_then_refill(self):
+        """Are `burst` takes allowed at once, then one per refill?"""
+        buckets = MemoryBuckets()
+
+        for _ in range(3):
+            self.assertEqual(buckets.take("k", 3, 0.5, now=100), 0)
+
+        self.assertEqual(buckets.take("k", 3, 0.5, now=100), 2)
+        self.assertEqual(buckets.take("k", 3, 0.5, now=102), 0)
+        self.assertGreater(buckets.take("k", 3, 0.5, now=102), 0)
+
+    def test_keys_are_separate(self):
+        """Does one client's bucket leave another's alone?"""
+        buckets = MemoryBuckets()
+
+        buckets.take("a", 1, 1, now=0)
+        self.assertGreater(buckets.take("a", 1, 1, now=0), 0)
+        self.assertEqual(buckets.take("b", 1, 1, now=0), 0)
+
+    def test_idle_eviction(self):
+        """Are idle buckets dropped?"""
+        buckets = MemoryBuckets(idle_seconds=10)
+
+        buckets.take("a", 1, 1, now=0)
+        buckets.take("b", 1, 1, now=5)
+        buckets.take("c", 1, 1, now=12)
+
+        self.assertEqual(len(buckets), 2)
+
+
+class RateLimitViewTestCase(TestCase):
+    """Test rate limiting of views."""
+
+    def setUp(self):
+        limiter.reset()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        limiter.reset()
+
+    def test_login_limited(self):
+        """Is a client over its login budget rejected before any query?"""
+
+        with patch.dict(limiter.limits, {'login': (1, 1 / 60)}):
+            data = {"username": "nobody", "password": "password"}
+            resp = self.client.post("/login", data=data)
+            self.assertEqual(resp.status_code, 200)
+
+            with patch("app.User") as user:
+                resp = self.client.post("/login", data=data)
+                self.assertFalse(user.mock_calls)
+
+            self.assertEqual(resp.status_code, 429)
+            self.assertEqual(resp.headers["Retry-After"], "60")
+
+            # reading the page is not limited
+            self.assertEqual(self.client.get("/login").status_code, 200)
+
+    def test_disabled(self):
+        """Can rate limiting be switched off?"""
+
+        with patch.dict(limiter.limits, {'login': (1, 1 / 60)}), \
+                patch.dict(app.config, {'RATELIMIT_ENABLED': False}):
+            data = {"username": "nobody", "password": "password"}
+            for _ in range(3):
+                resp = self.client.post("/login", data=data)
+                self.assertEqual(resp.status_code, 200)
@@ -0,0 +1,118 @@
+"""Follow recommendation tests."""
+
+import os
+from unittest import TestCase
+
+from models import db, User, Follows, FollowSuggestion
+
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+
+from app import app, CURR_USER_KEY
+from recommendations import FollowGraph, rebuild_suggestions
+
+
+db.create_all()
+
+
+class FollowGraphTestCase(TestCase):
+    """Test scoring on the in-memory graph."""
+
+    def setUp(self):
+        # 1 follows 2 and 3; 2 and 3 both follow 4; 3 follows 5; 6 follows 1
+        edges = [(1, 2), (1, 3), (2, 4), (3, 4), (3, 5), (6, 1)]
+        self.graph = FollowGraph([a for a, b in edges], [b for a, b in edges])
+
+    def node(self, user_id):
+        return list(self.graph.user_ids).index(user_id)
+
+    def suggested_ids(self, user_id, k=5):
+        return [(int(self.graph.user_ids[node]), score)
+                for node, score in self.graph.suggest(self.node(user_id), k)]
+
+    def test_csr_adjacency(self):
+        """Does the CSR layout give back each user's follows?"""
+        following = self.graph.following(self.node(3))
+        self.assertEqual(sorted(self.graph.user_ids[following]), [4, 5])
+
+        followers = self.graph.followers(self.node(4))
+        self.assertEqual(sorted(self.graph.user_ids[followers]), [2, 3])
+
+    def test_suggest_scores(self):
+        """Are friends-of-friends and would-be mutuals ranked by score?"""
+        self.assertEqual(self.suggested_ids(1),
+                         [(4, 2.0), (6, 2.0), (5, 1.0)])
+
+    def test_suggest_excludes_followed_and_self(self):
+        """Are already-followed users and the user themselves excluded?"""
+        suggested = [user_id for user_id, score in self.suggested_ids(6)]
+        self.assertNotIn(6, suggested)
+        self.assertNotIn(1, suggested)
+        self.assertEqual(suggested, [2, 3])
+
+    def test_suggest_top_k(self):
+        """Are only the top k suggestions returned?"""
+        self.assertEqual(len(self.suggested_ids(1, k=1)), 1)
+
+
+class FollowSuggestionViewTestCase(TestCase):
+    """Test stored suggestions and the homepage widget."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        self.u1 = User.signup("testuser1", "test1@test.com", "password", None)
+        self.u2 = User.signup("testuser2", "test2@test.com", "password", None)
+        self.u3 = User.signup("testuser3", "test3@test.com", "password", None)
+        db.session.commit()
+
+        self.u1_id, self.u2_id, self.u3_id = self.u1.id, self.u2.id, self.u3.id
+
+        db.session.add_all([
+            Follows(user_following_id=self.u1_id, user_being_followed_id=self.u2_id),
+            Follows(user_following_id=self.u2_id, user_being_followed_id=self.u3_id),
+        ])
+        db.session.commit()
+
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+        db.session.rollback()
+        db.drop_all()
+        db.create_all()
+
+    def test_rebuild_suggestions(self):
+        """Are suggestions stored for each user?"""
+        rebuild_suggestions(k=5)
+
+        suggestion = FollowSuggestion.query.filter_by(user_id=self.u1_id).one()
+        self.assertEqual(suggestion.suggested_user_id, self.u3_id)
+        self.assertEqual(suggestion.rank, 0)
+
+    def test_followed_since(self):
+        """Are users followed after the rebuild no longer suggested?"""
+        rebuild_suggestions(k=5)
+        self.assertEqual(self.u1.follow_suggestions(), [self.u3])
+
+        db.session.add(Follows(user_following_id=self.u1_id,
+                               user_being_followed_id=self.u3_id))
+        db.session.commit()
+        self.assertEqual(self.u1.follow_suggestions(), [])
+
+    def test_homepage_widget(self):
+        """Does the homepage show the stored suggestions?"""
+        rebuild_suggestions(k=5)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            resp = c.get("/")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Who to follow", str(resp.data))
+            self.assertIn("@testuser3", str(resp.data))
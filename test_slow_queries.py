@@ -0,0 +1,118 @@
+"""Slow query log tests."""
+
+import os
+from unittest import TestCase
+
+from sqlalchemy.exc import ProgrammingError
+
+from models import db, User
+
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+
+from app import app, CURR_USER_KEY
+from slow_queries import SlowQueryLog, fingerprint_sql, normalize_sql, slow_query_log
+
+
+db.create_all()
+
+
+class SlowQueryLogTestCase(TestCase):
+    """Test fingerprinting and the rolling top-N table."""
+
+    def test_normalize_collapses_in_lists(self):
+        """Do IN lists of any length normalize to the same text?"""
+        short = "SELECT * FROM messages WHERE user_id IN (%(p_1)s, %(p_2)s)"
+        long = "SELECT * FROM messages WHERE user_id IN (1, 2, 3, 4)"
+        self.assertEqual(normalize_sql(short), normalize_sql(long))
+        self.assertEqual(fingerprint_sql(short), fingerprint_sql(long))
+
+    def test_normalize_strips_literals(self):
+        """Are string literals replaced by placeholders?"""
+        sql = "SELECT * FROM users WHERE username LIKE '%abc%'"
+        self.assertEqual(normalize_sql(sql),
+                         "select * from users where username like ?")
+
+    def test_record_aggregates_by_fingerprint(self):
+        """Are repeated statements aggregated into one entry?"""
+        log = SlowQueryLog(top_n=5)
+        log.record("SELECT * FROM users WHERE id = 1", 250)
+        log.record("SELECT * FROM users WHERE id = 2", 350)
+
+        [entry] = log.top()
+        self.assertEqual(entry.count, 2)
+        self.assertEqual(entry.total_ms, 600)
+        self.assertEqual(entry.max_ms, 350)
+
+    def test_record_evicts_cheapest(self):
+        """Is the cheapest entry evicted when the table is full?"""
+        log = SlowQueryLog(top_n=2)
+        log.record("SELECT * FROM users", 300)
+        log.record("SELECT * FROM messages", 250)
+        log.record("SELECT * FROM follows", 400)
+
+        self.assertEqual([e.normalized for e in log.top()],
+                         ["select * from follows", "select * from users"])
+
+
+class SlowQueryViewTestCase(TestCase):
+    """Test the admin slow query page."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        self.user = User.signup("testuser", "test@test.com", "password", None)
+        self.admin = User.signup("admin", "admin@test.com", "password", None)
+        self.admin.is_admin = True
+        db.session.commit()
+
+        self.user_id = self.user.id
+        self.admin_id = self.admin.id
+
+        slow_query_log.reset()
+
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+        db.session.rollback()
+        db.drop_all()
+        db.create_all()
+        slow_query_log.reset()
+
+    def test_slow_queries_admin(self):
+        """Can an admin see recorded slow queries?"""
+        slow_query_log.record("SELECT * FROM messages WHERE user_id IN (1, 2)", 500)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.admin_id
+
+            resp = c.get("/admin/slow-queries")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("select * from messages where user_id in (?)", str(resp.data))
+
+    def test_failed_statements_forgotten(self):
+        """Is nothing left behind on the connection when a statement fails?"""
+        with db.engine.connect() as conn:
+            for _ in range(3):
+                with self.assertRaises(ProgrammingError):
+                    conn.execute("SELECT * FROM no_such_table")
+            conn.execute("SELECT 1")
+
+            self.assertNotIn('query_start_time', conn.info)
+
+    def test_slow_queries_not_admin(self):
+        """Are non-admins kept out of the slow query page?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            resp = c.get("/admin/slow-queries", follow_redirects=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Access unauthorized", str(resp.data))
@@ -0,0 +1,166 @@
+"""Snowflake id tests."""
+
+import os
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+
+from sqlalchemy import event
+
+from snowflake import (SnowflakeGenerator, Snowflakes, claim_slot, min_id_at,
+                       timestamp_of, MAX_SLOTS)
+
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+from models import db, Message, User
+
+
+db.create_all()
+
+
+class FakeClock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class SnowflakeGeneratorTestCase(TestCase):
+    """Test generating ids."""
+
+    def test_ordered_and_unique(self):
+        """Do ids increase, and encode their time?"""
+        clock = FakeClock(1700000000.0)
+        generator = SnowflakeGenerator(host_id=1, slot=2, clock=clock)
+
+        first = generator.next_id()
+        second = generator.next_id()
+        clock.now += 0.001
+        third = generator.next_id()
+
+        self.assertLess(first, second)
+        self.assertLess(second, third)
+        self.assertEqual(timestamp_of(first),
+                         datetime.utcfromtimestamp(1700000000.0))
+        self.assertEqual(second - first, 1)
+        self.assertLess(third.bit_length(), 64)
+
+    def test_workers_differ(self):
+        """Do two workers never produce the same id at the same time?"""
+        clock = FakeClock(1700000000.0)
+        a = SnowflakeGenerator(0, 0, clock=clock)
+        b = SnowflakeGenerator(0, 1, clock=clock)
+
+        self.assertNotEqual(a.next_id(), b.next_id())
+
+        with self.assertRaises(ValueError):
+            SnowflakeGenerator(0, MAX_SLOTS)
+
+    def test_clock_going_backwards(self):
+        """Do ids keep increasing if the clock steps back?"""
+        clock = FakeClock(1700000000.0)
+        generator = SnowflakeGenerator(0, 0, clock=clock)
+
+        first = generator.next_id()
+        clock.now -= 5
+        self.assertGreater(generator.next_id(), first)
+
+    def test_sequence_overflow(self):
+        """Does the generator wait for the next millisecond after 4096 ids?"""
+        times = iter([1700000000.0] * 4097 + [1700000000.001] * 2)
+        generator = SnowflakeGenerator(0, 0, clock=lambda: next(times))
+
+        ids = [generator.next_id() for _ in range(4097)]
+        self.assertEqual(len(set(ids)), 4097)
+        self.assertEqual(ids, sorted(ids))
+
+    def test_min_id_at(self):
+        """Is min_id_at a lower bound for ids from that time on?"""
+        clock = FakeClock(1700000000.0)
+        generator = SnowflakeGenerator(3, 3, clock=clock)
+
+        when = datetime.utcfromtimestamp(1700000000.0)
+        self.assertLessEqual(min_id_at(when), generator.next_id())
+        self.assertGreater(min_id_at(when), SnowflakeGenerator(
+            3, 3, clock=FakeClock(1699999999.0)).next_id())
+
+    def test_claim_slot(self):
+        """Do concurrent claimants get different slots?"""
+        with tempfile.TemporaryDirectory() as lock_dir:
+            slot_a, lock_a = claim_slot(lock_dir)
+            slot_b, lock_b = claim_slot(lock_dir)
+            self.assertNotEqual(slot_a, slot_b)
+
+            lock_a.close()
+            slot_c, lock_c = claim_slot(lock_dir)
+            self.assertEqual(slot_c, slot_a)
+
+            lock_b.close()
+            lock_c.close()
+
+
+class SnowflakeModelTestCase(TestCase):
+    """Test snowflake ids on messages."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.user = User.signup("testuser", "test@test.com", "password", None)
+        db.session.commit()
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.snowflakes = Snowflakes()
+        app.config.update(SNOWFLAKE_IDS=True)
+        app.instance_path, old_path = self.tmp.name, app.instance_path
+        try:
+            self.snowflakes.init_app(app, Message)
+        finally:
+            app.instance_path = old_path
+            app.config.update(SNOWFLAKE_IDS=False)
+
+    def tearDown(self):
+        db.session.rollback()
+        event.remove(Message, 'before_insert', self.snowflakes._assign_id)
+        self.snowflakes.close()
+        self.tmp.cleanup()
+
+    def test_forked_workers_get_own_slots(self):
+        """Does a process forked after init_app claim a slot of its own?"""
+        parent_worker = self.snowflakes.generator.worker
+
+        read_end, write_end = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(read_end)
+                os.write(write_end,
+                         str(self.snowflakes.generator.worker).encode())
+            finally:
+                os._exit(0)
+
+        os.close(write_end)
+        with os.fdopen(read_end) as pipe:
+            child_worker = int(pipe.read())
+        os.waitpid(pid, 0)
+
+        self.assertNotEqual(child_worker, parent_worker)
+        self.assertEqual(self.snowflakes.generator.worker, parent_worker)
+
+    def test_new_messages_get_snowflake_ids(self):
+        """Are new messages given time-ordered 64-bit ids?"""
+        old = Message(text="Before", user_id=self.user.id)
+        db.session.add(old)
+        db.session.commit()
+
+        new = Message(text="After", user_id=self.user.id)
+        db.session.add(new)
+        db.session.commit()
+
+        self.assertGreater(new.id, 2 ** 32)
+        self.assertLessEqual(abs((timestamp_of(new.id) -
+                                  datetime.utcnow()).total_seconds()), 60)
+        self.assertEqual(Message.query.order_by(Message.id.desc()).first(), new)
@@ -0,0 +1,108 @@
+"""Trending tests."""
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message
+
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+
+from app import app, CURR_USER_KEY
+from trending import TrendingCounter, trending
+
+
+db.create_all()
+
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class TrendingCounterTestCase(TestCase):
+    """Test the sliding-window counters."""
+
+    def setUp(self):
+        self.counter = TrendingCounter(refresh_seconds=0)
+        self.now = 1000000 * 60
+
+    def test_top(self):
+        """Are messages ranked by likes within the window?"""
+        self.counter.add(1, now=self.now)
+        self.counter.add(2, now=self.now)
+        self.counter.add(2, now=self.now + 1)
+
+        self.assertEqual(self.counter.top('hour', now=self.now + 2),
+                         [(2, 2), (1, 1)])
+
+    def test_unlike(self):
+        """Do unlikes take likes back out of the totals?"""
+        self.counter.add(1, now=self.now)
+        self.counter.add(1, -1, now=self.now)
+
+        self.assertEqual(self.counter.top('hour', now=self.now), [])
+
+    def test_window_slides(self):
+        """Do old likes drop out of the hour but stay in the day?"""
+        self.counter.add(1, now=self.now)
+        self.counter.add(2, now=self.now + 30 * 60)
+
+        later = self.now + 61 * 60
+        self.assertEqual(self.counter.top('hour', now=later), [(2, 1)])
+        self.assertEqual(sorted(self.counter.top('day', now=later)), [(1, 1), (2, 1)])
+
+        much_later = self.now + 25 * 60 * 60
+        self.assertEqual(self.counter.top('day', now=much_later), [])
+
+
+class TrendingViewTestCase(TestCase):
+    """Test the trending page and API."""
+
+    def setUp(self):
+        """Create test client, add sample data."""
+
+        db.drop_all()
+        db.create_all()
+        trending.clear()
+
+        self.client = app.test_client()
+
+        self.user = User.signup("testuser", "test@test.com", "password", None)
+        db.session.commit()
+        self.msg = Message(text="popular warble", user_id=self.user.id)
+        db.session.add(self.msg)
+        db.session.commit()
+
+        self.user_id, self.msg_id = self.user.id, self.msg.id
+
+    def tearDown(self):
+        """Clean up any fouled transaction."""
+        db.session.rollback()
+        db.drop_all()
+        db.create_all()
+        trending.clear()
+
+    def test_like_shows_on_trending(self):
+        """Does liking a message put it on the trending page and API?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user_id
+
+            c.post(f"/users/add_like/{self.msg_id}")
+
+            resp = c.get("/trending")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("popular warble", str(resp.data))
+
+            resp = c.get("/api/trending?window=day")
+            self.assertEqual(resp.json["window"], "day")
+            self.assertEqual(resp.json["messages"][0]["id"], self.msg_id)
+            self.assertEqual(resp.json["messages"][0]["likes"], 1)
+
+    def test_unknown_window(self):
+        """Is an unknown window a 404?"""
+
+        with self.client as c:
+            resp = c.get("/api/trending?window=year")
+            self.assertEqual(resp.status_code, 404)
@@ -2,10 +2,11 @@
 
 
 import os
+from datetime import datetime
 from unittest import TestCase
 from sqlalchemy.exc import IntegrityError
 
-from models import db, User, Message, Follows
+from models import db, User, Message, Follows, Likes
 
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
@@ -64,6 +65,119 @@ class UserModelTestCase(TestCase):
         """Does is_followed_by successfully detect when user1 is not followed by user2?"""
         self.assertFalse(self.user1.is_followed_by(self.user2))
 
+    def test_follow_state(self):
+        """Does follow_state report both directions for a list of users?"""
+        user3 = User.signup("testuser3", "test3@test.com", "password", None)
+        db.session.commit()
+
+        self.user1.following.append(self.user2)
+        self.user2.following.append(self.user1)
+        user3.following.append(self.user1)
+        db.session.commit()
+
+        following, followed_by = self.user1.follow_state([self.user2, user3])
+        self.assertEqual(following, {self.user2.id})
+        self.assertEqual(followed_by, {self.user2.id, user3.id})
+
+    def test_follow_state_empty(self):
+        """Does follow_state handle an empty list of users?"""
+        self.assertEqual(self.user1.follow_state([]), (set(), set()))
+
+    def test_followers_page(self):
+        """Does followers_page paginate and report the viewer's follow state?"""
+        others = [User.signup(f"follower{i}", f"follower{i}@test.com", "password", None)
+                  for i in range(3)]
+        db.session.commit()
+
+        for other in others:
+            other.following.append(self.user1)
+        self.user2.following.append(others[0])
+        others[0].following.append(self.user2)
+        db.session.commit()
+
+        rows, next_cursor = self.user1.followers_page(self.user2, limit=2)
+        self.assertEqual([user.id for user, _, _ in rows], [others[0].id, others[1].id])
+        self.assertEqual(rows[0][1:], (True, True))
+        self.assertEqual(rows[1][1:], (False, False))
+        self.assertEqual(next_cursor, others[1].id)
+
+        rows, next_cursor = self.user1.followers_page(self.user2, after=next_cursor, limit=2)
+        self.assertEqual([user.id for user, _, _ in rows], [others[2].id])
+        self.assertIsNone(next_cursor)
+
+    def test_following_page(self):
+        """Does following_page list the users this user follows?"""
+        self.user1.following.append(self.user2)
+        db.session.commit()
+
+        rows, next_cursor = self.user1.following_page(self.user1)
+        self.assertEqual(rows, [(self.user2, True, False)])
+        self.assertIsNone(next_cursor)
+
+    def test_stats(self):
+        """Does stats count messages, follows and likes?"""
+        msg = Message(text="Hello", user_id=self.user2.id)
+        db.session.add(msg)
+        self.user1.following.append(self.user2)
+        self.user1.likes.append(msg)
+        db.session.commit()
+
+        self.assertEqual(self.user1.stats(),
+                         dict(messages=0, following=1, followers=0, likes=1))
+        self.assertEqual(self.user2.stats(),
+                         dict(messages=1, following=0, followers=1, likes=0))
+
+    def test_soft_delete(self):
+        """Is a deleted user hidden but their rows kept until purged?"""
+        self.user1.following.append(self.user2)
+        self.user1.soft_delete()
+        db.session.commit()
+
+        self.assertEqual(User.active().all(), [self.user2])
+        self.assertFalse(User.authenticate("testuser1", "password"))
+        self.assertEqual(self.user2.followers_page(self.user2), ([], None))
+        self.assertEqual(self.user2.stats()["followers"], 0)
+        self.assertEqual(Follows.query.count(), 1)
+
+    def test_purge(self):
+        """Does purging remove the account's rows and undo its likes?"""
+        user1_id, user2_id = self.user1.id, self.user2.id
+        mine = Message(text="Mine", user_id=user1_id)
+        theirs = Message(text="Theirs", user_id=user2_id)
+        db.session.add_all([mine, theirs])
+        db.session.commit()
+
+        self.user1.following.append(self.user2)
+        self.user2.following.append(self.user1)
+        self.user1.add_like(theirs)
+        self.user2.add_like(mine)
+        self.user1.soft_delete()
+        db.session.commit()
+
+        self.assertEqual(User.purge_deleted(batch_size=1), 1)
+
+        self.assertIsNone(User.query.get(user1_id))
+        self.assertEqual(Message.query.all(), [theirs])
+        self.assertEqual(theirs.like_count, 0)
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(Follows.query.count(), 0)
+
+    def test_follow_many(self):
+        """Does follow_many resolve ids and usernames and skip existing follows?"""
+        user3 = User.signup("testuser3", "test3@test.com", "password", None)
+        db.session.commit()
+        self.user1.following.append(self.user2)
+        db.session.commit()
+
+        found, added = self.user1.follow_many(
+            [self.user2.id, self.user1.id, 999], ["testuser3", "nobody"])
+        db.session.commit()
+
+        self.assertEqual(found, {self.user2.id: "testuser2",
+                                 user3.id: "testuser3"})
+        self.assertEqual(added, [user3.id])
+        self.assertEqual(Follows.query.count(), 2)
+
     def test_signup(self):
         """Does User.signup successfully create a new user given valid credentials?"""
         user = User.signup("testuser3", "test3@test.com", "password", None)
@@ -99,6 +213,48 @@ class UserModelTestCase(TestCase):
         """Does User.authenticate fail to return a user when the password is invalid?"""
         self.assertFalse(User.authenticate("testuser1", "wrongpassword"))
 
+    def test_liked_page(self):
+        """Does liked_page page through likes, most recent first?"""
+        msgs = [Message(text=f"Warble {n}", user_id=self.user2.id)
+                for n in range(5)]
+        db.session.add_all(msgs)
+        db.session.commit()
+
+        # liked in reverse order of posting, two at the same instant
+        liked_at = [datetime(2026, 1, 1, 12, 0, n) for n in (4, 3, 2, 2, 0)]
+        db.session.add_all([Likes(user_id=self.user1.id, message_id=msg.id,
+                                  created_at=when)
+                            for msg, when in zip(msgs, liked_at)])
+        db.session.commit()
+        expected = [msgs[0].id, msgs[1].id, msgs[3].id, msgs[2].id, msgs[4].id]
+
+        rows, cursor = self.user1.liked_page(limit=2)
+        self.assertEqual([msg.id for msg, when in rows], expected[:2])
+        self.assertEqual(rows[0][1], liked_at[0])
+        self.assertEqual(cursor, (liked_at[1], msgs[1].id))
+
+        rows, cursor = self.user1.liked_page(before=cursor, limit=2)
+        self.assertEqual([msg.id for msg, when in rows], expected[2:4])
+
+        rows, cursor = self.user1.liked_page(before=cursor, limit=2)
+        self.assertEqual([msg.id for msg, when in rows], expected[4:])
+        self.assertIsNone(cursor)
+
+        self.assertEqual(self.user2.liked_page(), ([], None))
+
+    def test_like_created_at_default(self):
+        """Do likes get a creation time from the database?"""
+        msg = Message(text="Warble", user_id=self.user2.id)
+        db.session.add(msg)
+        db.session.commit()
+
+        before = datetime.utcnow()
+        db.session.add(Likes(user_id=self.user1.id, message_id=msg.id))
+        db.session.commit()
+
+        like = Likes.query.get((self.user1.id, msg.id))
+        self.assertLessEqual(abs((like.created_at - before).total_seconds()), 5)
+
 if __name__ == '__main__':
     import unittest
     unittest.main()
\ No newline at end of file
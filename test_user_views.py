@@ -1,7 +1,10 @@
 """User views tests."""
 
+import json
 import os
+from datetime import datetime
 from unittest import TestCase
+from unittest.mock import patch
 from sqlalchemy.exc import IntegrityError
 from models import db, User, Message, Likes, Follows
 
@@ -9,6 +12,8 @@ from models import db, User, Message, Likes, Follows
 os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
 from app import app, CURR_USER_KEY
+from cache import cache
+from ratelimit import limiter
 
 
 db.create_all()
@@ -27,6 +32,7 @@ class UserViewTestCase(TestCase):
         db.create_all()
 
         self.client = app.test_client()
+        cache.clear()
 
         self.testuser1 = User.signup(username="testuser1",
                                     email="test1@test.com",
@@ -129,6 +135,235 @@ class UserViewTestCase(TestCase):
             follow = Follows.query.filter_by(user_being_followed_id=self.testuser2.id, user_following_id=self.testuser1.id).first()
             self.assertIsNotNone(follow)
 
+    def test_delete_user(self):
+        """Is a deleted account logged out and hidden straight away?"""
+
+        user1_id = self.testuser1.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user1_id
+
+            resp = c.post("/users/delete")
+            self.assertEqual(resp.status_code, 302)
+
+            resp = c.get(f"/users/{user1_id}")
+            self.assertEqual(resp.status_code, 404)
+            self.assertNotIn("testuser1", str(c.get("/users").data))
+
+        self.assertIsNotNone(User.query.get(user1_id).deleted_at)
+
+    def test_deleted_users_messages_hidden(self):
+        """Are a deleted user's messages gone from feeds and pages?"""
+
+        user1_id, user2_id = self.testuser1.id, self.testuser2.id
+        msg = Message(text="Hello #birds @testuser1", user_id=user2_id)
+        db.session.add(msg)
+        self.testuser1.following.append(self.testuser2)
+        db.session.flush()
+        Message.index_text([msg])
+        db.session.commit()
+        msg_id = msg.id
+
+        pages = ["/", "/tags/birds", f"/users/{user1_id}/mentions"]
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user1_id
+
+            for page in pages + [f"/messages/{msg_id}"]:
+                self.assertIn("Hello", str(c.get(page).data))
+
+            User.query.get(user2_id).soft_delete()
+            db.session.commit()
+
+            for page in pages:
+                self.assertNotIn("Hello", str(c.get(page).data))
+            self.assertEqual(c.get(f"/messages/{msg_id}").status_code, 404)
+            self.assertEqual(c.get(f"/api/messages/{msg_id}").status_code,
+                             404)
+
+    def test_follow_many(self):
+        """Can a user follow a list of users in one request?"""
+
+        user1_id, user2_id = self.testuser1.id, self.testuser2.id
+        limiter.reset()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user1_id
+
+            resp = c.post("/api/follows",
+                          json={"user_ids": [user2_id, 999],
+                                "usernames": ["testuser2", "nobody"]})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.json, {"followed": [user2_id],
+                                         "already_following": [],
+                                         "not_found": [999, "nobody"]})
+
+            resp = c.post("/api/follows", json={"usernames": ["testuser2"]})
+            self.assertEqual(resp.json["already_following"], [user2_id])
+
+            resp = c.post("/api/follows", json={"user_ids": "all"})
+            self.assertEqual(resp.status_code, 400)
+
+        self.assertTrue(Follows.exists(user1_id, user2_id))
+
+    def test_export(self):
+        """Can a user download their data as NDJSON or CSV, and resume?"""
+
+        user1_id, user2_id = self.testuser1.id, self.testuser2.id
+        mine = Message(text="Mine, with a, comma", user_id=user1_id)
+        theirs = Message(text="Theirs", user_id=user2_id)
+        db.session.add_all([mine, theirs])
+        db.session.commit()
+        mine_id, theirs_id = mine.id, theirs.id
+
+        db.session.add_all([Likes(user_id=user1_id, message_id=theirs_id),
+                            Follows(user_following_id=user1_id,
+                                    user_being_followed_id=user2_id)])
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user1_id
+
+            resp = c.get("/users/export")
+            self.assertEqual(resp.status_code, 200)
+            self.assertTrue(resp.is_streamed)
+            records = [json.loads(line) for line in resp.data.splitlines()]
+            self.assertEqual([(r["type"], r["id"]) for r in records],
+                             [("message", mine_id), ("like", theirs_id),
+                              ("following", user2_id)])
+            self.assertEqual(records[0]["text"], "Mine, with a, comma")
+
+            resp = c.get("/users/export?after=like:0")
+            records = [json.loads(line) for line in resp.data.splitlines()]
+            self.assertEqual([r["type"] for r in records], ["like", "following"])
+
+            resp = c.get("/users/export?format=csv")
+            self.assertEqual(resp.mimetype, "text/csv")
+            lines = resp.data.decode().splitlines()
+            self.assertEqual(lines[0], "type,id,username,text,timestamp")
+            self.assertIn('"Mine, with a, comma"', lines[1])
+            self.assertEqual(lines[3], f"following,{user2_id},testuser2,,")
+
+            resp = c.get("/users/export?after=bogus")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_export_filename(self):
+        """Is the export's file name safe whatever the username?"""
+
+        user = User.query.get(self.testuser1.id)
+        user.username = 'b"ad; ünïcode'
+        db.session.commit()
+        user_id = user.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user_id
+
+            resp = c.get("/users/export?format=csv")
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.headers["Content-Disposition"],
+                             f'attachment; filename="warbler-{user_id}.csv"')
+
+    def test_streamed_pages(self):
+        """Are the profile and user list pages streamed, with flashes shown once?"""
+
+        user1_id, user2_id = self.testuser1.id, self.testuser2.id
+        db.session.add(Message(text="Streamed hello", user_id=user2_id))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user1_id
+                sess["_flashes"] = [("info", "Just once")]
+
+            resp = c.get(f"/users/{user2_id}")
+            self.assertTrue(resp.is_streamed)
+            html = resp.get_data(as_text=True)
+            self.assertLess(html.index("@testuser2"), html.index("Streamed hello"))
+            self.assertIn("Just once", html)
+
+            resp = c.get("/users")
+            self.assertTrue(resp.is_streamed)
+            html = resp.get_data(as_text=True)
+            self.assertIn("testuser2", html)
+            self.assertNotIn("Just once", html)
+
+            resp = c.get("/users?q=nobody")
+            self.assertIn("Sorry, no users found", str(resp.data))
+
+    def test_follow_json(self):
+        """Do follow and unfollow answer with JSON when asked to?"""
+
+        user1_id, user2_id = self.testuser1.id, self.testuser2.id
+        headers = {"Accept": "application/json"}
+
+        with self.client as c:
+            resp = c.post(f"/users/follow/{user2_id}", headers=headers)
+            self.assertEqual(resp.status_code, 401)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user1_id
+
+            for _ in range(2):
+                resp = c.post(f"/users/follow/{user2_id}", headers=headers)
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.json,
+                                 {"user_id": user2_id, "following": True})
+            self.assertTrue(Follows.exists(user1_id, user2_id))
+
+            resp = c.post(f"/users/stop-following/{user2_id}", headers=headers)
+            self.assertEqual(resp.json,
+                             {"user_id": user2_id, "following": False})
+            self.assertFalse(Follows.exists(user1_id, user2_id))
+
+            resp = c.post("/users/follow/99999", headers=headers)
+            self.assertEqual(resp.status_code, 404)
+            self.assertEqual(resp.json, {"error": "Not found."})
+
+    def test_show_liked_messages_paginated(self):
+        """Does the liked page show likes newest first, a page at a time?"""
+
+        msgs = [Message(text=f"Liked warble {n} #liked", user_id=self.testuser2.id)
+                for n in range(3)]
+        db.session.add_all(msgs)
+        db.session.commit()
+        user1_id = self.testuser1.id
+        msg_ids = [msg.id for msg in msgs]
+        db.session.add_all([
+            Likes(user_id=user1_id, message_id=msg.id,
+                  created_at=datetime(2026, 1, n + 1))
+            for n, msg in enumerate(msgs)])
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = user1_id
+
+            with patch('app.MESSAGE_PAGE_SIZE', 2):
+                resp = c.get(f"/users/{user1_id}/liked")
+                html = resp.get_data(as_text=True)
+                self.assertEqual(resp.status_code, 200)
+                self.assertLess(html.index("Liked warble 2"),
+                                html.index("Liked warble 1"))
+                self.assertNotIn("Liked warble 0", html)
+                self.assertIn("Unlike", html)
+                self.assertIn('<a href="/tags/liked">#liked</a>', html)
+                self.assertIn("before=2026-01-02T00%3A00%3A00~", html)
+
+                resp = c.get(f"/users/{user1_id}/liked"
+                             f"?before=2026-01-02T00:00:00~{msg_ids[1]}")
+                html = resp.get_data(as_text=True)
+                self.assertIn("Liked warble 0", html)
+                self.assertNotIn("Liked warble 1", html)
+                self.assertNotIn("Older", html)
+
+                resp = c.get(f"/users/{user1_id}/liked?before=garbage")
+                self.assertEqual(resp.status_code, 200)
+
 
 class AuthViewTestCase(TestCase):
     """Test views for authorization and authentication."""
@@ -175,6 +410,65 @@ class AuthViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("Following", str(resp.data))
 
+    def test_followers_badges(self):
+        """Do follower cards show mutual and "follows you" badges?"""
+
+        testuser3 = User.signup(username="testuser3",
+                                email="test3@test.com",
+                                password="password",
+                                image_url=None)
+        db.session.commit()
+
+        db.session.add_all([
+            Follows(user_being_followed_id=self.testuser1.id, user_following_id=self.testuser2.id),
+            Follows(user_being_followed_id=self.testuser2.id, user_following_id=self.testuser1.id),
+            Follows(user_being_followed_id=self.testuser1.id, user_following_id=testuser3.id),
+        ])
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser1.id
+
+            resp = c.get(f"/users/{self.testuser1.id}/followers")
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("Mutual", str(resp.data))
+            self.assertIn("Follows you", str(resp.data))
+
+    def test_followers_pagination(self):
+        """Are followers pages cut at the page size with a link to the next page?"""
+
+        followers = [User.signup(username=f"follower{i}",
+                                 email=f"follower{i}@test.com",
+                                 password="password",
+                                 image_url=None)
+                     for i in range(3)]
+        db.session.commit()
+
+        db.session.add_all([
+            Follows(user_being_followed_id=self.testuser2.id, user_following_id=follower.id)
+            for follower in followers
+        ])
+        db.session.commit()
+
+        testuser1_id, testuser2_id = self.testuser1.id, self.testuser2.id
+        follower1_id = followers[1].id
+
+        with patch('app.FOLLOW_PAGE_SIZE', 2):
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = testuser1_id
+
+                resp = c.get(f"/users/{testuser2_id}/followers")
+                self.assertIn("@follower0", str(resp.data))
+                self.assertIn("@follower1", str(resp.data))
+                self.assertNotIn("@follower2", str(resp.data))
+                self.assertIn(f"after={follower1_id}", str(resp.data))
+
+                resp = c.get(f"/users/{testuser2_id}/followers?after={follower1_id}")
+                self.assertNotIn("@follower1", str(resp.data))
+                self.assertIn("@follower2", str(resp.data))
+
     def test_view_followers_logged_out(self):
         """When you're logged out, are you disallowed from visiting a user's follower/following pages?"""
 
@@ -285,6 +579,7 @@ class AuthViewTestCase(TestCase):
             msg = Message.query.get(msg.id)
             self.assertIsNotNone(msg)
 
+
 if __name__ == '__main__':
     import unittest
-    unittest.main()
\ No newline at end of file
+    unittest.main()
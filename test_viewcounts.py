@@ -0,0 +1,203 @@
+"""View count tests."""
+
+import json
+import os
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, Message, MessageStats, User
+
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from metrics import metrics
+from viewcounts import HyperLogLog, ViewCounter
+
+
+db.create_all()
+
+
+class HyperLogLogTestCase(TestCase):
+    """Test the unique viewer sketch."""
+
+    def test_small_counts(self):
+        """Are a few viewers counted (nearly) exactly, and repeats ignored?"""
+        sketch = HyperLogLog()
+        for viewer in range(20):
+            sketch.add(f"user:{viewer}")
+            sketch.add(f"user:{viewer}")
+
+        self.assertEqual(sketch.count(), 20)
+        self.assertEqual(HyperLogLog().count(), 0)
+
+    def test_large_counts(self):
+        """Is a large count within 10%?"""
+        sketch = HyperLogLog()
+        for viewer in range(50000):
+            sketch.add(viewer)
+
+        self.assertAlmostEqual(sketch.count(), 50000, delta=5000)
+
+    def test_merge(self):
+        """Does merging count the union?"""
+        a, b = HyperLogLog(), HyperLogLog()
+        for viewer in range(3000):
+            a.add(viewer)
+        for viewer in range(2000, 5000):
+            b.add(viewer)
+
+        a.merge(b)
+        self.assertAlmostEqual(a.count(), 5000, delta=500)
+        self.assertEqual(HyperLogLog(bytes(a)).count(), a.count())
+
+
+class ViewCounterTestCase(TestCase):
+    """Test counting and flushing views."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        user = User.signup("testuser", "test@test.com", "password", None)
+        db.session.commit()
+        self.user_id = user.id
+
+        msgs = [Message(text=f"Warble {n}", user_id=self.user_id)
+                for n in range(2)]
+        db.session.add_all(msgs)
+        db.session.commit()
+        self.msg_ids = [msg.id for msg in msgs]
+
+        self.counter = self.make_counter()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def make_counter(self, uniques=True, max_messages=100):
+        counter = ViewCounter()
+        counter.enabled = True
+        counter.uniques = uniques
+        counter.max_messages = max_messages
+        return counter
+
+    def test_record_and_flush(self):
+        """Are views coalesced per message and written in one go?"""
+        msg_id, other_id = self.msg_ids
+        for viewer in ("user:1", "user:2", "user:1"):
+            self.counter.record(msg_id, viewer)
+        self.counter.record(other_id, "user:1")
+
+        self.assertEqual(MessageStats.query.count(), 0)
+        self.assertEqual(self.counter.stats(msg_id), (3, 2))
+
+        self.assertEqual(self.counter.flush(), 2)
+        self.assertEqual(self.counter.flush(), 0)
+        self.assertEqual(MessageStats.query.get(msg_id).views, 3)
+        self.assertEqual(self.counter.stats(msg_id), (3, 2))
+        self.assertEqual(self.counter.stats(other_id), (1, 1))
+
+    def test_workers_add_up(self):
+        """Do flushes from separate counters add to each other?"""
+        msg_id = self.msg_ids[0]
+        other = self.make_counter()
+
+        for viewer in range(300):
+            self.counter.record(msg_id, viewer)
+        for viewer in range(200, 400):
+            other.record(msg_id, viewer)
+        self.counter.flush()
+        other.flush()
+
+        views, viewers = self.counter.stats(msg_id)
+        self.assertEqual(views, 500)
+        self.assertAlmostEqual(viewers, 400, delta=40)
+
+    def test_without_uniques(self):
+        """Are only totals kept when unique viewers are off?"""
+        counter = self.make_counter(uniques=False)
+        counter.record(self.msg_ids[0], "user:1")
+        counter.record(self.msg_ids[0], "user:1")
+        counter.flush()
+
+        self.assertEqual(counter.stats(self.msg_ids[0]), (2, None))
+        self.assertIsNone(MessageStats.query.get(self.msg_ids[0]).viewers)
+
+    def test_bounded(self):
+        """Are views of messages past the limit dropped until a flush?"""
+        counter = self.make_counter(max_messages=1)
+        metrics.reset()
+
+        counter.record(self.msg_ids[0])
+        counter.record(self.msg_ids[1])
+        counter.record(self.msg_ids[0])
+        self.assertEqual(metrics.counters()["views:dropped"], 1)
+
+        counter.flush()
+        counter.record(self.msg_ids[1])
+        counter.flush()
+        self.assertEqual(counter.stats(self.msg_ids[0])[0], 2)
+        self.assertEqual(counter.stats(self.msg_ids[1])[0], 1)
+
+    def test_skips_deleted_messages(self):
+        """Does a flush skip messages deleted in the meantime?"""
+        msg_id, other_id = self.msg_ids
+        self.counter.record(msg_id)
+        self.counter.record(other_id)
+        Message.query.filter_by(id=msg_id).delete()
+        db.session.commit()
+
+        self.counter.flush()
+        self.assertEqual([row.message_id for row in MessageStats.query],
+                         [other_id])
+
+    def test_flusher_per_process(self):
+        """Is the flusher started on first use, in each forked worker?"""
+        counter = ViewCounter()
+        with patch.dict(app.config, VIEW_COUNTS=True, VIEW_FLUSH_SECONDS=60):
+            counter.init_app(app)
+        self.assertIsNone(counter._thread)
+
+        counter.record(self.msg_ids[0])
+        self.assertTrue(counter._thread.is_alive())
+
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                counter.record(self.msg_ids[1])
+                report = [counter._thread.is_alive(), sorted(counter._pending)]
+                os.write(write, json.dumps(report).encode())
+            finally:
+                os._exit(0)
+
+        os.close(write)
+        with os.fdopen(read) as pipe:
+            alive, pending = json.loads(pipe.read())
+        os.waitpid(pid, 0)
+
+        self.assertTrue(alive)
+        self.assertEqual(pending, [self.msg_ids[1]])
+        self.assertEqual(sorted(counter._pending), [self.msg_ids[0]])
+
+    def test_disabled(self):
+        """Is nothing counted when view counts are off?"""
+        counter = ViewCounter()
+        counter.record(self.msg_ids[0])
+        self.assertEqual(counter.flush(), 0)
+
+    def test_views(self):
+        """Do the message page and homepage count views?"""
+        msg_id = self.msg_ids[0]
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        with patch("app.viewcounter", self.counter):
+            client.get("/")
+            resp = client.get(f"/messages/{msg_id}")
+            self.assertIn("2 views by about 1 person", str(resp.data))
+
+            # streamed, so counted as the page is sent
+            client.get(f"/users/{self.user_id}").get_data()
+            self.assertEqual(self.counter.stats(msg_id), (3, 1))
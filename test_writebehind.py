@@ -0,0 +1,255 @@
+"""Write-behind buffer tests."""
+
+import fcntl
+import json
+import os
+import tempfile
+import threading
+from unittest import TestCase
+from unittest.mock import patch
+
+from models import db, Follows, Likes, Message, User
+
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from writebehind import WriteBehindBuffer
+
+
+db.create_all()
+
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class WriteBehindTestCase(TestCase):
+    """Test buffering likes and follows."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.user1 = User.signup("testuser1", "test1@test.com", "password", None)
+        self.user2 = User.signup("testuser2", "test2@test.com", "password", None)
+        db.session.commit()
+
+        self.msg = Message(text="Hello", user_id=self.user2.id)
+        db.session.add(self.msg)
+        db.session.commit()
+
+        self.user1_id, self.user2_id = self.user1.id, self.user2.id
+        self.msg_id = self.msg.id
+
+        self.tmp = tempfile.TemporaryDirectory()
+        self.buffer = WriteBehindBuffer()
+        self.buffer.open(self.tmp.name)
+        self.log_path = self.buffer.log_path
+
+    def tearDown(self):
+        db.session.rollback()
+        self.tmp.cleanup()
+
+    def test_read_your_writes(self):
+        """Are unflushed changes visible to the user who made them?"""
+        self.assertTrue(self.buffer.set_like(self.user1_id, self.msg_id, True))
+        self.assertFalse(self.buffer.set_like(self.user1_id, self.msg_id, True))
+        self.assertTrue(self.buffer.set_follow(self.user1_id, self.user2_id, True))
+
+        self.assertTrue(self.buffer.likes(self.user1_id, self.msg_id))
+        self.assertTrue(self.buffer.follows(self.user1_id, self.user2_id))
+        self.assertEqual(self.buffer.overlay('like', self.user1_id),
+                         ({self.msg_id}, set()))
+        self.assertEqual(self.buffer.like_delta(self.msg_id), 1)
+
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(Follows.query.count(), 0)
+
+    def test_flush(self):
+        """Are pending changes written in batches, with like counts?"""
+        self.buffer.set_like(self.user1_id, self.msg_id, True)
+        self.buffer.set_like(self.user2_id, self.msg_id, True)
+        self.buffer.set_follow(self.user1_id, self.user2_id, True)
+        self.buffer.set_follow(self.user2_id, self.user1_id, True)
+
+        self.assertEqual(self.buffer.flush(), 4)
+
+        self.assertEqual(Likes.query.count(), 2)
+        self.assertEqual(Follows.query.count(), 2)
+        self.assertEqual(Message.query.get(self.msg_id).like_count, 2)
+        self.assertEqual(self.buffer.like_delta(self.msg_id), 0)
+
+        self.buffer.set_like(self.user1_id, self.msg_id, False)
+        self.buffer.set_follow(self.user2_id, self.user1_id, False)
+        self.buffer.flush()
+
+        self.assertEqual(Likes.query.count(), 1)
+        self.assertEqual(Follows.query.count(), 1)
+        self.assertEqual(Message.query.get(self.msg_id).like_count, 1)
+
+        with open(self.log_path) as log:
+            self.assertEqual(log.read(), "")
+
+    def test_like_then_unlike(self):
+        """Does undoing an unflushed like leave everything unchanged?"""
+        self.buffer.set_like(self.user1_id, self.msg_id, True)
+        self.buffer.set_like(self.user1_id, self.msg_id, False)
+        self.buffer.flush()
+
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(Message.query.get(self.msg_id).like_count, 0)
+
+    def test_skips_deleted_rows(self):
+        """Is a like of a since-deleted message dropped, not an error?"""
+        self.buffer.set_like(self.user1_id, self.msg_id, True)
+        Message.query.filter_by(id=self.msg_id).delete()
+        db.session.commit()
+
+        self.buffer.flush()
+        self.assertEqual(Likes.query.count(), 0)
+
+    def test_replay(self):
+        """Are unflushed changes replayed from the log after a crash?"""
+        self.buffer.set_like(self.user1_id, self.msg_id, True)
+        self.buffer.set_follow(self.user1_id, self.user2_id, True)
+        with open(self.log_path, "a") as log:
+            log.write('["like", 1')  # torn write
+        self.buffer._log.close()  # the process dies, releasing its lock
+
+        replayed = WriteBehindBuffer()
+        replayed.open(self.tmp.name)
+        self.assertEqual(replayed.flush(), 2)
+
+        self.assertTrue(Likes.exists(self.user1_id, self.msg_id))
+        self.assertTrue(Follows.exists(self.user1_id, self.user2_id))
+        self.assertEqual(Message.query.get(self.msg_id).like_count, 1)
+
+    def test_other_processes_logs(self):
+        """Are only the logs of dead processes taken over?"""
+        self.buffer._log.close()
+
+        other_path = os.path.join(self.tmp.name, "write-behind-999999.log")
+        other_log = open(other_path, "w")
+        fcntl.flock(other_log, fcntl.LOCK_EX)
+        other_log.write(json.dumps(["like", self.user1_id, self.msg_id, True])
+                        + "\n")
+        other_log.flush()
+
+        live = WriteBehindBuffer()
+        live.open(self.tmp.name)
+        self.assertEqual(live.flush(), 0)
+        self.assertTrue(os.path.exists(other_path))
+        live._log.close()
+
+        other_log.close()  # the other process dies
+        taking_over = WriteBehindBuffer()
+        taking_over.open(self.tmp.name)
+        self.assertFalse(os.path.exists(other_path))
+        self.assertEqual(taking_over.flush(), 1)
+        self.assertTrue(Likes.exists(self.user1_id, self.msg_id))
+
+    def test_flushes_serialized(self):
+        """Does a second flush wait for one already writing?"""
+        self.buffer.set_like(self.user1_id, self.msg_id, True)
+
+        writing, release = threading.Event(), threading.Event()
+        execute = db.session.execute
+
+        def slow_execute(*args, **kwargs):
+            writing.set()
+            release.wait(5)
+            return execute(*args, **kwargs)
+
+        def flush():
+            with app.app_context():
+                self.buffer.flush()
+
+        with patch.object(db.session, "execute", slow_execute):
+            first = threading.Thread(target=flush)
+            first.start()
+            writing.wait(5)
+
+            self.buffer.set_follow(self.user1_id, self.user2_id, True)
+            second = threading.Thread(target=flush)
+            second.start()
+            second.join(0.2)
+
+            self.assertTrue(second.is_alive())
+            # the batch being written is still read back
+            self.assertTrue(self.buffer.likes(self.user1_id, self.msg_id))
+            self.assertEqual(self.buffer.overlay('like', self.user1_id),
+                             ({self.msg_id}, set()))
+            self.assertEqual(self.buffer.like_delta(self.msg_id), 1)
+
+            release.set()
+            first.join()
+            second.join()
+
+        self.assertTrue(Likes.exists(self.user1_id, self.msg_id))
+        self.assertTrue(Follows.exists(self.user1_id, self.user2_id))
+        with open(self.log_path) as log:
+            self.assertEqual(log.read(), "")
+
+    def test_started_on_first_use(self):
+        """Is the log opened, and the flusher started, only when first used?"""
+        buffer = WriteBehindBuffer()
+        with patch.dict(app.config, WRITE_BEHIND=True,
+                        WRITE_BEHIND_LOG_DIR=self.tmp.name):
+            buffer.init_app(app)
+
+        self.assertTrue(buffer.enabled)
+        self.assertIsNone(buffer._thread)
+        self.assertIsNone(buffer.log_path)
+
+        self.assertEqual(buffer.overlay('like', self.user1_id), (set(), set()))
+        self.assertTrue(buffer._thread.is_alive())
+        self.assertEqual(os.path.basename(buffer.log_path),
+                         f"write-behind-{os.getpid()}.log")
+
+    def test_forked_workers_get_own_logs(self):
+        """Does a forked worker get its own log, without the parent's changes?"""
+        self.buffer._record('like', self.user1_id, self.msg_id, True)
+
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                overlay = self.buffer.overlay('like', self.user1_id)
+                report = [self.buffer.log_path, sorted(overlay[0])]
+                os.write(write, json.dumps(report).encode())
+            finally:
+                os._exit(0)
+
+        os.close(write)
+        with os.fdopen(read) as pipe:
+            child_log, child_likes = json.loads(pipe.read())
+        os.waitpid(pid, 0)
+
+        self.assertEqual(child_likes, [])
+        self.assertEqual(os.path.basename(child_log),
+                         f"write-behind-{pid}.log")
+        self.assertEqual(self.buffer.overlay('like', self.user1_id),
+                         ({self.msg_id}, set()))
+        with open(self.log_path) as log:
+            self.assertEqual(len(log.readlines()), 1)
+
+    def test_views(self):
+        """Do the like and follow views use the buffer when it's on?"""
+        client = app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user1_id
+
+        with patch("app.writebehind", self.buffer):
+            resp = client.post(f"/users/add_like/{self.msg_id}",
+                               headers={"Accept": "application/json"})
+            self.assertEqual(resp.json["like_count"], 1)
+
+            client.post(f"/users/follow/{self.user2_id}")
+            self.assertEqual(Follows.query.count(), 0)
+
+            resp = client.get("/")
+            self.assertIn("Hello", str(resp.data))
+            self.assertIn("Unlike", str(resp.data))
+
+        self.buffer.flush()
+        self.assertTrue(Likes.exists(self.user1_id, self.msg_id))
@@ -0,0 +1,123 @@
+"""Trending warbles from sliding-window like counters.
+
+Likes and unlikes are counted as they happen into per-minute buckets.
+For each window (last hour, last day) we keep a running total per
+message: new likes are added as they arrive, and a bucket's counts are
+subtracted once it slides out of the window. The top-N list for a window
+is taken from those totals with a heap, and reused for a few seconds, so
+serving /trending never touches the likes table.
+
+Counts live in the process that saw the like; behind several workers
+each one ranks from its own share of the traffic, which is fine for
+picking what's popular but not for exact counts.
+"""
+
+import heapq
+import threading
+import time
+from collections import Counter, OrderedDict
+
+
+WINDOWS = {
+    'hour': 60 * 60,
+    'day': 24 * 60 * 60,
+}
+
+
+class TrendingCounter:
+    """Like counts per message over sliding time windows."""
+
+    def __init__(self, windows=WINDOWS, bucket_seconds=60, top_n=50,
+                 refresh_seconds=5):
+        self.windows = dict(windows)
+        self.bucket_seconds = bucket_seconds
+        self.top_n = top_n
+        self.refresh_seconds = refresh_seconds
+
+        self._buckets = OrderedDict()
+        self._totals = {window: Counter() for window in self.windows}
+        self._oldest = {window: None for window in self.windows}
+        self._top = {}
+        self._lock = threading.Lock()
+
+    def add(self, message_id, delta=1, now=None):
+        """Count `delta` likes of `message_id` at time `now`."""
+
+        now = time.time() if now is None else now
+        bucket = int(now // self.bucket_seconds)
+
+        with self._lock:
+            self._advance(bucket)
+            self._buckets.setdefault(bucket, Counter())[message_id] += delta
+
+            for totals in self._totals.values():
+                totals[message_id] += delta
+                if totals[message_id] == 0:
+                    del totals[message_id]
+
+    def top(self, window, n=None, now=None):
+        """Return up to `n` (message_id, likes) pairs, most liked first."""
+
+        now = time.time() if now is None else now
+        n = self.top_n if n is None else n
+
+        with self._lock:
+            cached = self._top.get(window)
+            if cached is None or cached[0] + self.refresh_seconds <= now:
+                self._advance(int(now // self.bucket_seconds))
+                best = heapq.nlargest(
+                    self.top_n,
+                    ((count, message_id)
+                     for message_id, count in self._totals[window].items()
+                     if count > 0))
+                cached = self._top[window] = (
+                    now, [(message_id, count) for count, message_id in best])
+
+        return cached[1][:n]
+
+    def forget(self, message_id):
+        """Drop `message_id`, e.g. because it was deleted."""
+
+        with self._lock:
+            for counts in self._buckets.values():
+                counts.pop(message_id, None)
+            for totals in self._totals.values():
+                totals.pop(message_id, None)
+            self._top.clear()
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+            for window in self.windows:
+                self._totals[window].clear()
+                self._oldest[window] = None
+            self._top.clear()
+
+    def _advance(self, current_bucket):
+        """Slide every window forward so it ends at `current_bucket`."""
+
+        for window, seconds in self.windows.items():
+            first = current_bucket - seconds // self.bucket_seconds + 1
+            oldest = self._oldest[window]
+
+            if oldest is not None and oldest < first:
+                totals = self._totals[window]
+                for bucket, counts in self._buckets.items():
+                    if bucket >= first:
+                        break
+                    if bucket >= oldest:
+                        totals.subtract(counts)
+
+                for message_id in [m for m, c in totals.items() if c == 0]:
+                    del totals[message_id]
+
+            if oldest is None or oldest < first:
+                self._oldest[window] = first
+
+        # buckets older than the longest window are no longer needed
+        first_kept = min(self._oldest.values())
+        while self._buckets and next(iter(self._buckets)) < first_kept:
+            self._buckets.popitem(last=False)
+
+
+trending = TrendingCounter()
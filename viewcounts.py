@@ -0,0 +1,288 @@
+"""Batched view counts for messages.
+
+Showing a message, or a feed containing it, counts as a view. Rather
+than an UPDATE per view, views are added up in memory per message and a
+background thread writes them every VIEW_FLUSH_SECONDS in one bulk
+upsert into message_stats:
+
+    INSERT ... ON CONFLICT (message_id)
+    DO UPDATE SET views = message_stats.views + excluded.views
+
+Since each flush adds to what's stored, any number of processes can
+count and flush side by side; rows are upserted in message id order so
+concurrent flushes can't deadlock.
+
+With VIEW_UNIQUES on, each message also gets a HyperLogLog sketch of
+who viewed it (user id, or IP address when logged out), for a unique
+viewer count within about 3%. Sketches are merged register by register,
+in memory and in the upsert, so they combine across flushes and
+processes too.
+
+At most VIEW_MAX_MESSAGES messages are counted between flushes (about
+1KB each with VIEW_UNIQUES); views of further messages are dropped, and
+counted in the `views:dropped` metric, until the next flush. Unflushed
+views are lost if the process dies.
+
+The flush thread is started by the first view counted in each process,
+not at init_app, so workers forked from a process that loaded the app
+each flush their own counts.
+"""
+
+import atexit
+import hashlib
+import math
+import os
+import threading
+
+from sqlalchemy import text
+
+from metrics import metrics
+from models import db, MessageStats
+
+
+PRECISION = 10
+REGISTERS = 1 << PRECISION
+
+UPSERT_STATS = text("""
+    INSERT INTO message_stats (message_id, views, viewers)
+    SELECT v.message_id, v.views, v.viewers
+    FROM unnest(CAST(:message_ids AS bigint[]), CAST(:views AS bigint[]),
+                CAST(:viewers AS bytea[])) AS v(message_id, views, viewers)
+    JOIN messages ON messages.id = v.message_id
+    ORDER BY v.message_id
+    ON CONFLICT (message_id) DO UPDATE SET
+        views = message_stats.views + excluded.views,
+        viewers = CASE
+            WHEN message_stats.viewers IS NULL THEN excluded.viewers
+            WHEN excluded.viewers IS NULL THEN message_stats.viewers
+            ELSE (SELECT string_agg(
+                      set_byte(decode('00', 'hex'), 0,
+                               greatest(get_byte(message_stats.viewers, i),
+                                        get_byte(excluded.viewers, i))),
+                      ''::bytea ORDER BY i)
+                  FROM generate_series(0, length(excluded.viewers) - 1) AS i)
+        END
+""")
+
+
+class HyperLogLog:
+    """An approximate count of distinct values, in REGISTERS bytes."""
+
+    def __init__(self, registers=None):
+        self.registers = bytearray(registers or REGISTERS)
+
+    def add(self, value):
+        digest = hashlib.blake2b(str(value).encode(), digest_size=8).digest()
+        hashed = int.from_bytes(digest, 'big')
+
+        # the first PRECISION bits pick a register, which keeps the most
+        # leading zeros seen in the rest
+        index = hashed >> (64 - PRECISION)
+        rest = hashed & ((1 << (64 - PRECISION)) - 1)
+        rank = 64 - PRECISION - rest.bit_length() + 1
+
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        """Add everything counted by `other` to this sketch."""
+
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self):
+        alpha = 0.7213 / (1 + 1.079 / REGISTERS)
+        estimate = (alpha * REGISTERS * REGISTERS /
+                    sum(2.0 ** -rank for rank in self.registers))
+
+        # small counts are more accurate from the number of empty registers
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * REGISTERS and zeros:
+            estimate = REGISTERS * math.log(REGISTERS / zeros)
+
+        return round(estimate)
+
+    def __bytes__(self):
+        return bytes(self.registers)
+
+
+class ViewCounter:
+    """Per-message view counts, flushed to message_stats in batches.
+
+    Pending counts are kept as {message_id: [views, HyperLogLog or None]}.
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.uniques = False
+        self.max_messages = 10000
+        self.flush_seconds = 10
+        self._pending = {}
+        self._flushing = {}
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = None
+        self.app = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Start counting, if VIEW_COUNTS is on; see `_started`."""
+
+        app.config.setdefault('VIEW_COUNTS', False)
+        app.config.setdefault('VIEW_UNIQUES', False)
+        app.config.setdefault('VIEW_FLUSH_SECONDS', 10)
+        app.config.setdefault('VIEW_MAX_MESSAGES', 10000)
+
+        if not app.config['VIEW_COUNTS']:
+            return
+
+        self.enabled = True
+        self.uniques = app.config['VIEW_UNIQUES']
+        self.flush_seconds = app.config['VIEW_FLUSH_SECONDS']
+        self.max_messages = app.config['VIEW_MAX_MESSAGES']
+        self.app = app
+        atexit.register(self._flush_at_exit, app)
+
+    def record(self, message_id, viewer=None):
+        """Count a view of `message_id` by `viewer` (any hashable id)."""
+
+        if not self.enabled:
+            return
+
+        self._started()
+        with self._lock:
+            counts = self._pending.get(message_id)
+            if counts is None:
+                if len(self._pending) >= self.max_messages:
+                    metrics.incr("views:dropped")
+                    self._wake.set()
+                    return
+
+                counts = self._pending[message_id] = [
+                    0, HyperLogLog() if self.uniques else None]
+                if len(self._pending) >= self.max_messages // 2:
+                    self._wake.set()
+
+            counts[0] += 1
+            if counts[1] is not None and viewer is not None:
+                counts[1].add(viewer)
+
+    def counted(self, messages, viewer=None):
+        """Yield `messages`, counting a view of each as it goes."""
+
+        for message in messages:
+            self.record(message.id, viewer)
+            yield message
+
+    def stats(self, message_id):
+        """Returns (views, approximate unique viewers) of a message.
+
+        Includes views not flushed yet by this process. Unique viewers
+        is None unless VIEW_UNIQUES is on.
+        """
+
+        row = (db.session
+               .query(MessageStats.views, MessageStats.viewers)
+               .filter_by(message_id=message_id)
+               .first())
+        views, sketch = row or (0, None)
+        viewers = HyperLogLog(sketch) if self.uniques else None
+
+        with self._lock:
+            for pending in (self._flushing, self._pending):
+                counts = pending.get(message_id)
+                if counts is None:
+                    continue
+
+                views += counts[0]
+                if viewers is not None and counts[1] is not None:
+                    viewers.merge(counts[1])
+
+        return views, viewers.count() if viewers is not None else None
+
+    def flush(self):
+        """Write all pending counts. Returns how many messages were written."""
+
+        with self._lock:
+            batch = self._flushing = self._pending
+            self._pending = {}
+
+        if not batch:
+            return 0
+
+        message_ids = sorted(batch)
+        params = dict(
+            message_ids=message_ids,
+            views=[batch[message_id][0] for message_id in message_ids],
+            viewers=[bytes(batch[message_id][1])
+                     if batch[message_id][1] is not None else None
+                     for message_id in message_ids],
+        )
+
+        try:
+            db.session.execute(UPSERT_STATS, params)
+            db.session.commit()
+
+        except Exception:
+            db.session.rollback()
+            with self._lock:
+                for message_id, (views, viewers) in batch.items():
+                    counts = self._pending.setdefault(message_id,
+                                                      [0, viewers])
+                    if counts[1] is not viewers:
+                        counts[1].merge(viewers)
+                    counts[0] += views
+                self._flushing = {}
+            raise
+
+        with self._lock:
+            self._flushing = {}
+
+        return len(batch)
+
+    def _started(self):
+        """Start this process's flush thread, once per process.
+
+        A forked worker drops the counts it inherited; they're the
+        parent's to flush.
+        """
+
+        if self._pid == os.getpid():
+            return
+
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+
+            self._pending = {}
+            self._flushing = {}
+            if self.app is not None:
+                self._thread = threading.Thread(
+                    target=self._run, args=(self.app,), name='view-counts',
+                    daemon=True)
+                self._thread.start()
+            self._pid = os.getpid()
+
+    def _run(self, app):
+        while True:
+            self._wake.wait(self.flush_seconds)
+            self._wake.clear()
+
+            with app.app_context():
+                try:
+                    self.flush()
+                except Exception:
+                    app.logger.exception("View count flush failed")
+
+    def _flush_at_exit(self, app):
+        if self._pid != os.getpid():
+            return  # nothing counted in this process
+
+        with app.app_context():
+            self.flush()
+
+
+viewcounter = ViewCounter()
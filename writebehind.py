@@ -0,0 +1,409 @@
+"""Optional write-behind buffering of likes and follows.
+
+With WRITE_BEHIND on, liking/unliking and following/unfollowing don't
+touch the likes and follows tables during the request. The change is
+appended to a local log, kept in memory, and acknowledged; a background
+thread then writes everything pending in a few set-based statements
+(multi-row INSERT ... ON CONFLICT DO NOTHING, DELETE ... USING), every
+WRITE_BEHIND_FLUSH_MS milliseconds or as soon as WRITE_BEHIND_FLUSH_ITEMS
+changes are waiting. like_count is adjusted from the rows the statements
+actually inserted or deleted.
+
+Until a change is flushed, `likes`, `follows` and `overlay` answer from
+memory, so users see their own writes straight away; other users (and
+other processes) see them after the flush.
+
+Each change is written to the process's own log, write-behind-<pid>.log
+in WRITE_BEHIND_LOG_DIR, before it is acknowledged, and the log is
+rewritten to just the unflushed changes after each flush. A process
+holds an exclusive flock on its log while it runs, so on start-up any
+log nobody holds was left by a process that died: its changes are taken
+over, replayed and flushed. The log is flushed to the OS on every write
+but not fsynced, so it survives the process dying, not the machine.
+
+The log is opened, and the flush thread started, on first use in each
+process rather than at init_app, so servers that load the app and then
+fork workers give every worker a log and a flusher of its own.
+"""
+
+import atexit
+import fcntl
+import glob
+import json
+import os
+import threading
+from collections import Counter, OrderedDict
+
+from sqlalchemy import text
+
+from models import db, Follows, Likes
+
+
+INSERT_LIKES = text("""
+    WITH added AS (
+        INSERT INTO likes (user_id, message_id)
+        SELECT v.user_id, v.message_id
+        FROM unnest(CAST(:user_ids AS integer[]),
+                    CAST(:other_ids AS bigint[])) AS v(user_id, message_id)
+        JOIN users ON users.id = v.user_id
+        JOIN messages ON messages.id = v.message_id
+        ON CONFLICT DO NOTHING
+        RETURNING message_id
+    )
+    UPDATE messages SET like_count = messages.like_count + added.n
+    FROM (SELECT message_id, count(*) AS n
+          FROM added GROUP BY message_id) AS added
+    WHERE messages.id = added.message_id
+""")
+
+DELETE_LIKES = text("""
+    WITH removed AS (
+        DELETE FROM likes
+        USING unnest(CAST(:user_ids AS integer[]),
+                     CAST(:other_ids AS bigint[])) AS v(user_id, message_id)
+        WHERE likes.user_id = v.user_id AND likes.message_id = v.message_id
+        RETURNING likes.message_id
+    )
+    UPDATE messages SET like_count = messages.like_count - removed.n
+    FROM (SELECT message_id, count(*) AS n
+          FROM removed GROUP BY message_id) AS removed
+    WHERE messages.id = removed.message_id
+""")
+
+INSERT_FOLLOWS = text("""
+    INSERT INTO follows (user_following_id, user_being_followed_id)
+    SELECT v.follower_id, v.followed_id
+    FROM unnest(CAST(:user_ids AS integer[]),
+                CAST(:other_ids AS integer[])) AS v(follower_id, followed_id)
+    JOIN users AS follower ON follower.id = v.follower_id
+    JOIN users AS followed ON followed.id = v.followed_id
+    ON CONFLICT DO NOTHING
+""")
+
+DELETE_FOLLOWS = text("""
+    DELETE FROM follows
+    USING unnest(CAST(:user_ids AS integer[]),
+                 CAST(:other_ids AS integer[])) AS v(follower_id, followed_id)
+    WHERE follows.user_following_id = v.follower_id
+      AND follows.user_being_followed_id = v.followed_id
+""")
+
+STATEMENTS = {
+    ('like', True): INSERT_LIKES,
+    ('like', False): DELETE_LIKES,
+    ('follow', True): INSERT_FOLLOWS,
+    ('follow', False): DELETE_FOLLOWS,
+}
+
+
+class WriteBehindBuffer:
+    """Pending likes and follows, flushed to the database in batches.
+
+    A pending change is keyed by (kind, user_id, other_id), where kind is
+    'like' (other_id is a message) or 'follow' (other_id is the followed
+    user), and holds the state to write: True to add the row, False to
+    remove it.
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.log_dir = None
+        self.log_path = None
+        self.flush_items = 500
+        self.flush_seconds = 0.2
+        self._pending = OrderedDict()
+        self._by_user = {}
+        self._like_deltas = Counter()
+        # the batch being written, kept visible until it's committed
+        self._flushing = {}
+        self._flushing_by_user = {}
+        self._flushing_deltas = Counter()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._log = None
+        self._thread = None
+        self._pid = None
+        self.app = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Turn buffering on, if WRITE_BEHIND is; see `_started`."""
+
+        app.config.setdefault('WRITE_BEHIND', False)
+        app.config.setdefault('WRITE_BEHIND_LOG_DIR', os.path.join(
+            app.instance_path, 'write-behind'))
+        app.config.setdefault('WRITE_BEHIND_FLUSH_MS', 200)
+        app.config.setdefault('WRITE_BEHIND_FLUSH_ITEMS', 500)
+
+        if not app.config['WRITE_BEHIND']:
+            return
+
+        self.flush_seconds = app.config['WRITE_BEHIND_FLUSH_MS'] / 1000
+        self.flush_items = app.config['WRITE_BEHIND_FLUSH_ITEMS']
+        self.log_dir = app.config['WRITE_BEHIND_LOG_DIR']
+        self.app = app
+        self.enabled = True
+        atexit.register(self._flush_at_exit, app)
+
+    def open(self, log_dir):
+        """Start buffering, logging to a file of this process's in `log_dir`.
+
+        Takes over the logs of processes that died, replaying them.
+        """
+
+        self.log_dir = log_dir
+        self.log_path = os.path.join(log_dir, f"write-behind-{os.getpid()}.log")
+        os.makedirs(log_dir, exist_ok=True)
+
+        orphans = []
+        for path in sorted(glob.glob(os.path.join(log_dir, 'write-behind*.log'))):
+            log = open(path)
+            try:
+                fcntl.flock(log, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                log.close()  # a live process's log
+                continue
+
+            for line in log:
+                try:
+                    kind, user_id, other_id, state = json.loads(line)
+                except ValueError:
+                    continue  # torn last line from a crash
+                self._pending[(kind, user_id, other_id)] = state
+            orphans.append((path, log))
+
+        self._index()
+
+        # the taken-over changes are in our own log before theirs go
+        self._rewrite_log()
+        for path, log in orphans:
+            if path != self.log_path:
+                os.unlink(path)
+            log.close()
+
+        self._pid = os.getpid()
+        self.enabled = True
+
+    def set_like(self, user_id, message_id, liked):
+        """Record that `user_id` likes (or no longer likes) `message_id`.
+
+        Returns False if that's already the case.
+        """
+
+        if self.likes(user_id, message_id) == liked:
+            return False
+
+        self._record('like', user_id, message_id, liked)
+        return True
+
+    def set_follow(self, follower_id, followed_id, following):
+        """Record that `follower_id` follows (or stops following) someone.
+
+        Returns False if that's already the case.
+        """
+
+        if self.follows(follower_id, followed_id) == following:
+            return False
+
+        self._record('follow', follower_id, followed_id, following)
+        return True
+
+    def likes(self, user_id, message_id):
+        """Does `user_id` like `message_id`, counting unflushed changes?"""
+
+        self._started()
+        state = self._state(('like', user_id, message_id))
+        if state is None:
+            return Likes.exists(user_id, message_id)
+        return state
+
+    def follows(self, follower_id, followed_id):
+        """Does `follower_id` follow `followed_id`, counting unflushed changes?"""
+
+        self._started()
+        state = self._state(('follow', follower_id, followed_id))
+        if state is None:
+            return Follows.exists(follower_id, followed_id)
+        return state
+
+    def overlay(self, kind, user_id):
+        """Returns (added, removed) sets of other ids pending for a user."""
+
+        self._started()
+        added, removed = set(), set()
+
+        with self._lock:
+            pending = dict(self._flushing_by_user.get((kind, user_id), {}))
+            pending.update(self._by_user.get((kind, user_id), {}))
+            for other_id, state in pending.items():
+                (added if state else removed).add(other_id)
+
+        return added, removed
+
+    def like_delta(self, message_id):
+        """Change in `message_id`'s like_count that isn't flushed yet."""
+
+        self._started()
+        with self._lock:
+            return (self._flushing_deltas.get(message_id, 0) +
+                    self._like_deltas.get(message_id, 0))
+
+    def flush(self):
+        """Write all pending changes. Returns how many were written.
+
+        Flushes run one at a time, whether from the background thread or
+        a request, so a batch being written is never hidden or dropped
+        from the log by another.
+        """
+
+        self._started()
+        with self._flush_lock:
+            return self._flush()
+
+    def _started(self):
+        """Open this process's log and start its flusher, once per process.
+
+        A forked worker drops the state it inherited (the parent's to
+        flush) and takes over no one's log but dead processes'.
+        """
+
+        if not self.enabled or self._pid == os.getpid():
+            return
+
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+
+            # closing our copy leaves the parent's lock on its log held
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+            self._pending = OrderedDict()
+            self._by_user = {}
+            self._like_deltas = Counter()
+            self._done_flushing()
+
+            self.open(self.log_dir)
+
+            if self.app is not None:
+                self._thread = threading.Thread(
+                    target=self._run, args=(self.app,), name='write-behind',
+                    daemon=True)
+                self._thread.start()
+                # flush whatever was taken over straight away
+                self._wake.set()
+
+    def _flush(self):
+        with self._lock:
+            batch = self._flushing = self._pending
+            deltas = self._flushing_deltas = self._like_deltas
+            self._flushing_by_user = self._by_user
+            self._pending = OrderedDict()
+            self._by_user = {}
+            self._like_deltas = Counter()
+
+        if not batch:
+            return 0
+
+        groups = {}
+        for (kind, user_id, other_id), state in batch.items():
+            user_ids, other_ids = groups.setdefault((kind, state), ([], []))
+            user_ids.append(user_id)
+            other_ids.append(other_id)
+
+        try:
+            for key, (user_ids, other_ids) in groups.items():
+                db.session.execute(STATEMENTS[key], dict(user_ids=user_ids,
+                                                         other_ids=other_ids))
+            db.session.commit()
+
+        except Exception:
+            db.session.rollback()
+            with self._lock:
+                # changes made since the swap are newer; keep those
+                for key, state in batch.items():
+                    self._pending.setdefault(key, state)
+                self._index()
+                self._like_deltas.update(deltas)
+                self._done_flushing()
+            raise
+
+        with self._lock:
+            self._done_flushing()
+            self._rewrite_log()
+
+        return len(batch)
+
+    def _done_flushing(self):
+        self._flushing = {}
+        self._flushing_by_user = {}
+        self._flushing_deltas = Counter()
+
+    def _record(self, kind, user_id, other_id, state):
+        key = (kind, user_id, other_id)
+
+        with self._lock:
+            self._log.write(json.dumps([kind, user_id, other_id, state]) + '\n')
+            self._log.flush()
+
+            self._pending[key] = state
+            self._by_user.setdefault((kind, user_id), {})[other_id] = state
+
+            if kind == 'like':
+                self._like_deltas[other_id] += 1 if state else -1
+                if not self._like_deltas[other_id]:
+                    del self._like_deltas[other_id]
+
+            if len(self._pending) >= self.flush_items:
+                self._wake.set()
+
+    def _state(self, key):
+        # a batch being written isn't in the database yet either
+        state = self._pending.get(key)
+        if state is None:
+            state = self._flushing.get(key)
+        return state
+
+    def _index(self):
+        self._by_user = {}
+        for (kind, user_id, other_id), state in self._pending.items():
+            self._by_user.setdefault((kind, user_id), {})[other_id] = state
+
+    def _rewrite_log(self):
+        # Locked before it's renamed into place, so another process
+        # starting up never sees it unlocked and takes it over.
+        tmp = open(self.log_path + '.tmp', 'w')
+        fcntl.flock(tmp, fcntl.LOCK_EX)
+        for (kind, user_id, other_id), state in self._pending.items():
+            tmp.write(json.dumps([kind, user_id, other_id, state]) + '\n')
+        tmp.flush()
+
+        os.replace(tmp.name, self.log_path)
+        if self._log is not None:
+            self._log.close()
+        self._log = tmp
+
+    def _run(self, app):
+        while True:
+            self._wake.wait(self.flush_seconds)
+            self._wake.clear()
+
+            with app.app_context():
+                try:
+                    self.flush()
+                except Exception:
+                    app.logger.exception("Write-behind flush failed")
+
+    def _flush_at_exit(self, app):
+        if self._pid != os.getpid():
+            return  # never used in this process
+
+        with app.app_context():
+            self.flush()
+
+
+writebehind = WriteBehindBuffer()